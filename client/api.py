@@ -1,20 +1,116 @@
+import os
+import base64
+import itertools
 import rsa
 import socket
+import threading
+from framing import CHAT, DATA
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+except ImportError:
+    # Without cryptography the client falls back to RSA-only mode
+    ChaCha20Poly1305 = None
+    InvalidTag = rsa.pkcs1.DecryptionError
 
 class API:
+    SESSION_CIPHER = "chacha20poly1305"
+
+    # Raised by recv when a message cannot be decrypted
+    DECRYPTION_ERRORS = (rsa.pkcs1.DecryptionError, InvalidTag)
+
+    def choose_cipher(ciphers: list, pub_key):
+        """
+        Pick a cipher from the ciphers offered by the server.
+        Returns the cipher message for the server and the session key, or None for RSA-only mode.
+        """
+        if API.SESSION_CIPHER in ciphers and ChaCha20Poly1305 is not None:
+            key = os.urandom(32)
+            # Only the server can decrypt the session key
+            encrypted = base64.b64encode(rsa.encrypt(key, pub_key)).decode()
+            return {"type": "cipher", "cipher": API.SESSION_CIPHER, "key": encrypted}, key
+        return {"type": "cipher", "cipher": "rsa"}, None
+
+    def connection(conn=None):
+        """The given connection, or the one of the chat window"""
+        if conn is None:
+            from network import conn
+        return conn
+
     class Chat:
-        def __init__(self, priv_key, pub_key) -> None:
+        def __init__(self, priv_key, pub_key, conn=None, buffer: int = 1024) -> None:
             self.priv_key = priv_key
             self.pub_key = pub_key
+            # Defaults to the connection of the chat window
+            self.conn = conn
+            # Longest message that fits in one RSA block, the keys have buffer bits
+            self.max_message_size = buffer // 8 - 11
+            # Longest file chunk that still fits next to its 20-byte header
+            self.max_chunk_size = self.max_message_size - 20
+
+        def send(self, msg, frame_type: int = CHAT):
+            if isinstance(msg, str):
+                msg = msg.encode()
+            API.connection(self.conn).send_frame(rsa.encrypt(msg, self.pub_key), frame_type)
+
+        def recv(self, buffer: int = None):
+            return self.recv_frame()[1]
+
+        def recv_frame(self):
+            """Next message and its frame type, DATA frames stay bytes"""
+            frame_type, msg = API.connection(self.conn).recv_frame()
+            if frame_type is None:
+                raise ConnectionResetError("Connection closed by server")
+            msg = rsa.decrypt(msg, self.priv_key)
+            return frame_type, msg if frame_type == DATA else msg.decode()
+
+    class SessionChat:
+        # Same interface as Chat, messages are sealed with the session key
+        max_chunk_size = 64 * 1024
+        max_message_size = 64 * 1024
+
+        # Nonce prefixes, one per direction so a nonce is never reused
+        SERVER = b"\x00\x00\x00\x01"
+        CLIENT = b"\x00\x00\x00\x02"
+
+        def __init__(self, key: bytes, conn=None) -> None:
+            # Data streams prove with it that they belong to this login
+            self.key = key
+            self.aead = ChaCha20Poly1305(key)
+            self.counter = itertools.count()
+            # File transfers send from other threads, the nonces must leave in order
+            self.send_lock = threading.Lock()
+            # Counter of the last message from the server, replays never exceed it
+            self.peer_counter = -1
+            self.conn = conn
+
+        def send(self, msg, frame_type: int = CHAT):
+            if isinstance(msg, str):
+                msg = msg.encode()
+            conn = API.connection(self.conn)
+            with self.send_lock:
+                nonce = self.CLIENT + next(self.counter).to_bytes(8, "big")
+                # The frame type is authenticated, it cannot be swapped on the way
+                conn.send_frame(nonce + self.aead.encrypt(nonce, msg, bytes([frame_type])), frame_type)
 
-        def send(self, msg: str):
-            from network import s
-            s.send(rsa.encrypt(msg.encode(), self.pub_key))
+        def recv(self, buffer: int = None):
+            return self.recv_frame()[1]
 
-        def recv(self, buffer: int):
-            from network import s
-            msg = s.recv(buffer)
-            return rsa.decrypt(msg, self.priv_key).decode()
+        def recv_frame(self):
+            frame_type, msg = API.connection(self.conn).recv_frame()
+            if frame_type is None:
+                raise ConnectionResetError("Connection closed by server")
+            nonce = msg[:12]
+            if nonce[:4] != self.SERVER:
+                raise InvalidTag()
+            counter = int.from_bytes(nonce[4:], "big")
+            if counter <= self.peer_counter:
+                # Replayed
+                raise InvalidTag()
+            msg = self.aead.decrypt(nonce, msg[12:], bytes([frame_type]))
+            self.peer_counter = counter
+            return frame_type, msg if frame_type == DATA else msg.decode()
 
     class Load_keys:
         def __init__(self, pub_key, priv_key) -> None:
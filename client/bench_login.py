@@ -0,0 +1,82 @@
+"""
+Login latency benchmark.
+
+Opens many connections to a running server and measures the time from
+connect() to the decrypted welcome message, the same path as the chat
+window. Run it right after restarting the server to see how fast a
+reconnect storm clears.
+
+    python bench_login.py 127.0.0.1 8889 --clients 1000 --concurrency 200
+"""
+
+import argparse
+import hashlib
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from framing import FrameSocket
+from handshake import login
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def one_login(host, port, nickname, password_hash):
+    start = time.perf_counter()
+    sock = socket.create_connection((host, port))
+    conn = FrameSocket(sock)
+    try:
+        chat_api = login(conn, nickname, password_hash)
+        chat_api.recv()  # Welcome message
+        return time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure login latency")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--clients", type=int, default=200, help="Number of logins")
+    parser.add_argument("--concurrency", type=int, default=50, help="Logins in flight at once")
+    parser.add_argument("--password", default="test")
+    args = parser.parse_args()
+
+    password_hash = hashlib.md5(args.password.encode()).hexdigest()
+    prefix = f"bench-{os.getpid()}"
+
+    latencies = []
+    errors = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [
+            pool.submit(one_login, args.host, args.port, f"{prefix}-{i}", password_hash)
+            for i in range(args.clients)
+        ]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                name = type(e).__name__
+                errors[name] = errors.get(name, 0) + 1
+
+    total = time.perf_counter() - start
+
+    print(f"Logins: {len(latencies)}/{args.clients} in {total:.2f}s ({len(latencies) / total:.0f}/s)")
+    for p in (50, 90, 99):
+        print(f"p{p}: {percentile(latencies, p) * 1000:.1f} ms")
+    print(f"max: {max(latencies, default=0) * 1000:.1f} ms")
+    for name, count in errors.items():
+        print(f"Errors: {name} x{count}")
+
+
+if __name__ == "__main__":
+    main()
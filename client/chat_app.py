@@ -2,17 +2,18 @@ import os
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, filedialog
 import threading
-import rsa
-import zlib
 import hashlib
 import time
 import base64
+import json
  
 from constants import *
 from login_window import LoginWindow
 from api import API
-from network import s
-from file_utils import upload_file, send_file_data, save_received_file, process_file_chunk, complete_file_transfer
+from network import s, conn
+from handshake import login, LoginError
+from framing import FILE, COMMAND, HISTORY, DATA
+from file_utils import upload_file, send_file_data, save_received_file, process_file_chunk, complete_file_transfer, read_data_frame, address, TransferWindow, DataStreams, load_transfer_state, pending_transfers, missing_ranges, format_ranges, MAX_RESUME_RANGES
 
 class ChatApp:
     def __init__(self, root):
@@ -35,46 +36,27 @@ class ChatApp:
         self.receiver_thread = None
         self.shared_files = {}
         self.file_transfers = {}  # To track ongoing file transfers
+        self.outgoing = {}  # Flow control windows of the files we are sending
+        # Data streams for file chunks, opened with the first file transfer
+        self.streams = None
+        self.streams_lock = threading.Lock()
+        # Chunks arrive on the receiver thread and the data stream threads
+        self.transfer_lock = threading.Lock()
+        # Cursor of the oldest message shown, /history continues from it
+        self.history_cursor = None
+        self.history_started = False
     
     def on_login(self, server_ip, server_port, username, username_styled, password_hash):
         self.username = username
         self.username_styled = username_styled
+        self.server_address = (server_ip, server_port)
         
         try:
             # Connect to server
             s.connect((server_ip, server_port))
             
-            # Check if password protected
-            is_protected = s.recv(BUFFER_SIZE).decode()
-            if is_protected == "protected":
-                s.send(password_hash.encode())
-                confirm = s.recv(BUFFER_SIZE).decode()
-                if confirm != "/accepted":
-                    messagebox.showerror("Authentication Failed", "Incorrect password")
-                    s.close()
-                    return
-            
-            # Send username
-            s.send(username.encode())
-            confirm = s.recv(BUFFER_SIZE).decode()
-            if confirm != "/accepted":
-                messagebox.showerror("Authentication Failed", "Username already exists")
-                s.close()
-                return
-            
-            # Get buffer size
-            buffer_size = int(s.recv(BUFFER_SIZE).decode())
-            
-            # Get encryption keys
-            public_key = zlib.decompress(s.recv(buffer_size))
-            private_key = zlib.decompress(s.recv(buffer_size))
-            
-            # Load keys
-            client_key = API.Load_keys(public_key, private_key)
-            private_key, public_key = client_key.load_all()
-            
-            # Create API
-            self.chat_api = API.Chat(private_key, public_key)
+            # Login, parameters and keys in one round trip
+            self.chat_api = login(conn, username, password_hash)
             
             # Initialize chat interface
             self.initialize_chat_ui()
@@ -83,9 +65,20 @@ class ChatApp:
             welcome_msg = self.chat_api.recv(BUFFER_SIZE)
             self.display_message(welcome_msg)
             
+            # Scrollback of the room, the server sends it again on /join and /part
+            self.chat_api.send("/history", COMMAND)
+            
+            # Downloads the last session did not finish
+            for state in pending_transfers():
+                self.display_message(f"<System> Resuming download of {state['filename']}")
+                self.request_file(state['code'])
+            
             # Start receiving thread
             self.start_receiver()
             
+        except LoginError as e:
+            messagebox.showerror("Authentication Failed", str(e))
+            s.close()
         except Exception as e:
             messagebox.showerror("Connection Failed", f"Error: {str(e)}")
     
@@ -230,6 +223,32 @@ class ChatApp:
         elif cmd == "/exit":
             self.on_close()
         
+        elif cmd in ("/join", "/part", "/rooms", "/search"):
+            # Rooms and the history are kept by the server
+            try:
+                self.chat_api.send(command, COMMAND)
+            except Exception as e:
+                self.display_message(f"Error sending command: {str(e)}")
+        
+        elif cmd == "/history":
+            # Older messages, unless a cursor or page size was given
+            if len(cmd_parts) == 1:
+                if not self.history_cursor:
+                    self.display_message("<System> No older messages")
+                    return
+                command = f"/history before {self.history_cursor}"
+            try:
+                self.chat_api.send(command, COMMAND)
+            except Exception as e:
+                self.display_message(f"Error sending command: {str(e)}")
+        
+        elif cmd == "/admin":
+            # Admin commands are executed by the server
+            try:
+                self.chat_api.send(command, COMMAND)
+            except Exception as e:
+                self.display_message(f"Error sending command: {str(e)}")
+        
         elif cmd == "/get":
             # New command to download shared files
             if len(cmd_parts) < 2:
@@ -249,61 +268,140 @@ class ChatApp:
         """Request a file from another client using the file code"""
         self.display_message(f"<System> Requesting file with code #{file_code}...")
         
-        # Send a file request through the chat
+        # A transfer still running is continued from its saved state
+        transfer = self.file_transfers.pop(file_code, None)
+        if transfer:
+            transfer['sink'].suspend()
+        
+        # The server passes the request to the sharer, who answers us only
         request_msg = f"{self.username_styled} [b]Requesting file:[/b] #{file_code}"
-        self.chat_api.send(request_msg)
+        # The server puts our name in front of it
+        max_size = self.chat_api.max_message_size - len(f"@{self.username} ".encode())
+        
+        state = load_transfer_state(file_code)
+        if state:
+            # Only the missing chunks, as many ranges as fit in one message
+            bitmap = base64.b64decode(state['bitmap'])
+            for limit in range(MAX_RESUME_RANGES, 0, -1):
+                ranges = format_ranges(missing_ranges(bitmap, state['chunk_count'], limit))
+                resume_msg = f"{request_msg}:{state['chunk_size']}:{ranges}"
+                if len(resume_msg.encode()) <= max_size:
+                    request_msg = resume_msg
+                    break
+        self.chat_api.send(request_msg, FILE)
     
-    def process_file_request(self, message):
-        """Process incoming file request messages"""
+    def process_file_request(self, message, sender=None):
+        """Process incoming file request messages, the answer goes to sender only"""
         try:
             # Extract the file code
             parts = message.split("[b]Requesting file:[/b] #")
             if len(parts) > 1:
-                file_code = parts[1].strip()
+                # A resume adds the chunk size and the missing ranges
+                file_code, _, resume = parts[1].strip().partition(":")
+                chunk_size, _, ranges = resume.partition(":")
                 
                 # Check if we have this file in our shared files
                 if file_code in self.shared_files:
                     file_info = self.shared_files[file_code]
                     
-                    # Send direct message with file data
-                    send_file_data(file_code, file_info, self.display_message, 
-                                  self.username_styled, self.chat_api)
+                    # Send the file data from its own thread, the acknowledgements
+                    # arrive on this one
+                    args = (file_code, file_info, int(chunk_size) if chunk_size else None, ranges or None, sender)
+                    threading.Thread(target=self.send_file, args=args, daemon=True).start()
         except Exception as e:
             print(f"Error processing file request: {str(e)}")
     
+    def data_streams(self):
+        """
+        The open data streams, an empty list when the server or the cipher
+        has none. Opening them blocks, never call it on the receiver thread.
+        """
+        with self.streams_lock:
+            if self.streams is None:
+                # RSA-only sessions have no key to attach streams with
+                key = getattr(self.chat_api, 'key', None)
+                streams = DataStreams(self.server_address, self.username, key, TRANSFER_STREAMS,
+                                      lambda payload: self.handle_file_result(read_data_frame(payload)))
+                self.streams = streams if key and streams.open() else False
+            return self.streams.streams if self.streams else []
+    
+    def send_file(self, file_code, file_info, chunk_size=None, ranges=None, to=None):
+        # Only transfers of more than a window of chunks are striped
+        chunk_count = -(-file_info['size'] // self.chat_api.max_chunk_size)
+        streams = self.data_streams() if chunk_count > TRANSFER_WINDOW else []
+        # A window for every connection the chunks go over
+        window = TransferWindow(TRANSFER_WINDOW * max(1, len(streams)))
+        # One window per requester, several may download the same file
+        self.outgoing[(file_code, to)] = window
+        try:
+            send_file_data(file_code, file_info, 
+                          lambda msg: self.root.after(0, lambda: self.display_message(msg)),
+                          self.username_styled, self.chat_api, window, chunk_size, ranges, to, list(streams))
+        finally:
+            self.outgoing.pop((file_code, to), None)
+    
+    def process_file_ack(self, message, sender=None):
+        """The receiver got this many chunks, the sender may go on"""
+        try:
+            code, received = message.split("[b]File ack:[/b] #")[1].strip().split(":")
+            window = self.outgoing.get((code, sender))
+            if window:
+                window.ack(int(received))
+        except ValueError:
+            pass
+    
     def process_file_data(self, message):
         """Process and save incoming file data"""
         save_received_file(message, self.display_message)
     
-    def process_file_message(self, message):
+    def process_file_message(self, message, sender=None):
         result = save_received_file(message, self.display_message)
-        
+        if result and result['type'] == 'start':
+            # Acknowledgements go back to the sender only
+            result['sender'] = sender
+        self.handle_file_result(result)
+    
+    def handle_file_result(self, result):
         if result:
             if result['type'] == 'start':
                 # Start a new file transfer
                 self.file_transfers[result['code']] = result
                 self.root.after(0, lambda: self.display_message(f"<System> Starting file transfer: {result['filename']}"))
+                # The sender stripes more than a window of chunks, the streams
+                # open in the background and take over the chunks once attached
+                if result['total_chunks'] - result['chunks_received'] > TRANSFER_WINDOW:
+                    threading.Thread(target=self.data_streams, daemon=True).start()
+                # The acknowledgement that lets the sender go
+                self.chat_api.send(address(f"{self.username_styled} [b]File ack:[/b] #{result['code']}:0", result.get('sender')), FILE)
             
             elif result['type'] == 'chunk':
                 # Process a chunk of an ongoing transfer
-                if result['code'] in self.file_transfers:
-                    updated_data = process_file_chunk(
-                        self.file_transfers[result['code']], 
-                        result, 
-                        self.display_message
-                    )
+                with self.transfer_lock:
+                    updated_data = None
+                    if result['code'] in self.file_transfers:
+                        updated_data = process_file_chunk(
+                            self.file_transfers[result['code']], 
+                            result, 
+                            self.display_message
+                        )
                     if updated_data:
                         self.file_transfers[result['code']] = updated_data
+                        # Acknowledge every half window, the sender never waits for a full stop
+                        arrived = updated_data['chunks_arrived']
+                        if arrived % (TRANSFER_WINDOW // 2) == 0 or updated_data['sink'].complete():
+                            self.chat_api.send(address(f"{self.username_styled} [b]File ack:[/b] #{result['code']}:{arrived}", updated_data.get('sender')), FILE)
             
             elif result['type'] == 'end':
                 # Complete a file transfer
                 if result['code'] in self.file_transfers:
                     transfer_data = self.file_transfers[result['code']]
-                    if transfer_data['chunks_received'] == transfer_data['total_chunks']:
-                        complete_file_transfer(transfer_data, self.display_message)
+                    if transfer_data['sink'].complete():
+                        complete_file_transfer(transfer_data, self.display_message, result['sha256'])
                     else:
+                        # Kept on disk, a later request only asks for the missing chunks
+                        transfer_data['sink'].suspend()
                         self.root.after(0, lambda: self.display_message(
-                            f"<System> File transfer incomplete: received {transfer_data['chunks_received']} of {transfer_data['total_chunks']} chunks"
+                            f"<System> File transfer incomplete: received {transfer_data['chunks_received']} of {transfer_data['total_chunks']} chunks. Type /get #{result['code']} to resume it."
                         ))
                     # Clean up
                     del self.file_transfers[result['code']]
@@ -312,17 +410,47 @@ class ChatApp:
                 # Old-style transfer already completed
                 pass
     
+    def show_history(self, message):
+        """Display one HISTORY frame, a page can span several"""
+        page = json.loads(message)
+        if not self.history_started:
+            self.display_message(f"--- History of #{page['room']} ---")
+            self.history_started = True
+        
+        for timestamp, username, content in page["messages"]:
+            self.display_message(f"[{timestamp}] {content}")
+        
+        if page["last"]:
+            self.history_started = False
+            self.history_cursor = page["before"]
+            if page["before"]:
+                self.display_message("--- /history for older messages ---")
+            else:
+                self.display_message("--- Start of history ---")
+    
     def receive_messages(self):
         while True:
             try:
-                message = self.chat_api.recv(BUFFER_SIZE)
-                if message:
+                frame_type, message = self.chat_api.recv_frame()
+                if frame_type == HISTORY:
+                    self.root.after(0, lambda msg=message: self.show_history(msg))
+                elif frame_type == DATA:
+                    # Binary file chunk
+                    self.handle_file_result(read_data_frame(message))
+                elif message:
+                    # The server names the user a file message came from
+                    sender = None
+                    if frame_type == FILE and message.startswith("@"):
+                        sender, _, message = message[1:].partition(" ")
+                    # Handle acknowledgements of the files we send
+                    if "[b]File ack:[/b] #" in message:
+                        self.process_file_ack(message, sender)
                     # Handle file transfers
-                    if "[b]File start:[/b] #" in message or "[b]File chunk:[/b] #" in message or "[b]File end:[/b] #" in message or "[b]File data:[/b] #" in message:
-                        self.process_file_message(message)
+                    elif "[b]File start:[/b] #" in message or "[b]File chunk:[/b] #" in message or "[b]File end:[/b] #" in message or "[b]File data:[/b] #" in message:
+                        self.process_file_message(message, sender)
                     # Handle file requests
                     elif "[b]Requesting file:[/b] #" in message:
-                        self.process_file_request(message)
+                        self.process_file_request(message, sender)
                     # Handle other messages like "file too large"
                     elif "[b]File too large:[/b]" in message:
                         # Just display as a normal message
@@ -330,13 +458,24 @@ class ChatApp:
                     else:
                         # Regular chat message
                         self.root.after(0, lambda msg=message: self.display_message(msg))
-            except rsa.pkcs1.DecryptionError:
+            except API.DECRYPTION_ERRORS:
                 pass
             except Exception as e:
+                self.suspend_transfers()
                 if self.root:  # Check if the application is still running
                     self.root.after(0, lambda err=e: self.display_message(f"<System> Connection error: {str(err)}"))
                 break
     
+    def suspend_transfers(self):
+        """Save the state of every running download, they resume on the next login"""
+        for code in list(self.file_transfers):
+            transfer = self.file_transfers.pop(code, None)
+            if transfer:
+                try:
+                    transfer['sink'].suspend()
+                except OSError:
+                    pass
+    
     def start_receiver(self):
         self.receiver_thread = threading.Thread(target=self.receive_messages)
         self.receiver_thread.daemon = True
@@ -345,9 +484,13 @@ class ChatApp:
     def on_close(self):
         if messagebox.askokcancel("Confirm Exit", "Are you sure you want to exit?"):
             try:
-                s.send("/exit".encode())
+                if self.chat_api:
+                    self.chat_api.send("/exit", COMMAND)
             except:
                 pass
+            self.suspend_transfers()
+            if self.streams:
+                self.streams.close()
             s.close()
             self.root.destroy()
    
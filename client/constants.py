@@ -1,3 +1,5 @@
+import os
+
 # Global constants for the application
 
 # Socket buffer size
@@ -38,12 +40,30 @@ HELP_TEXT = """Available commands:
 /upload - Upload a file
 /clear - Clear the chat window
 /get #code - Download a file someone shared (use the code they shared)
+/join room - Move to another room, messages only reach its members
+/part - Go back to the default room
+/rooms - List the rooms and how many are in them
+/history - Show older messages of the room
+/search words - Search the room history (from:user in:room|all after:date before:date page:n)
 /exit - Exit the chat
 File sharing tips:
 1. When someone shares a file, note the code (e.g., #a1b2c3d4)
 2. Type /get #a1b2c3d4 to download the file
-3. Maximum file size for direct transfer: 100KB"""
+3. Maximum file size for direct transfer: 10MB"""
 
 # File upload limits
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB for upload
-DIRECT_TRANSFER_LIMIT = 100 * 1024  # 100KB for direct transfer
\ No newline at end of file
+DIRECT_TRANSFER_LIMIT = MAX_FILE_SIZE  # Everything that can be uploaded can be sent
+
+# File transfers send binary chunks, at most TRANSFER_WINDOW of them before
+# the receiver acknowledges. A sender gives up after TRANSFER_ACK_TIMEOUT
+# seconds without one, that includes the receiver picking where to save
+TRANSFER_WINDOW = 16
+TRANSFER_ACK_TIMEOUT = 60
+
+# Partial downloads keep their state here, a restarted client resumes them
+TRANSFER_STATE_DIR = os.path.join(os.path.expanduser("~"), ".darkroom", "transfers")
+
+# Large transfers also go over up to TRANSFER_STREAMS extra connections,
+# chat messages keep the main one to themselves
+TRANSFER_STREAMS = 4
\ No newline at end of file
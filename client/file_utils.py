@@ -1,9 +1,338 @@
 import os
 import base64
 import hashlib
+import json
+import socket
+import struct
+import threading
 import time
 from tkinter import filedialog
-from constants import MAX_FILE_SIZE, DIRECT_TRANSFER_LIMIT, BUFFER_SIZE
+from constants import MAX_FILE_SIZE, DIRECT_TRANSFER_LIMIT, TRANSFER_WINDOW, TRANSFER_ACK_TIMEOUT, TRANSFER_STATE_DIR
+from framing import FrameSocket, FILE, COMMAND, DATA
+from handshake import attach, LoginError
+from api import API
+
+# Header of a binary file chunk (DATA frame): file code, chunk index, chunk digest
+CHUNK_HEADER = struct.Struct("!8sI8s")
+
+# Partial transfers write their state to disk at least every CHECKPOINT_BYTES
+CHECKPOINT_BYTES = 1024 * 1024
+
+# Ranges a resume request names, the last one is left open beyond that
+MAX_RESUME_RANGES = 8
+
+# Hex digits of the SHA-256 a transfer is verified with, short enough
+# for the end message of an RSA-only sender
+CONTENT_HASH_LENGTH = 32
+
+class TransferWindow:
+    """
+    Flow control of one outgoing transfer: the sender may be at most size
+    chunks ahead of what the receiver acknowledged. Shared by the threads
+    of a transfer striped over data streams.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.sent = 0
+        self.acked = 0
+        # The receiver acknowledges the start message too
+        self.started = False
+        self.condition = threading.Condition()
+
+    def reserve(self, timeout):
+        """Block until one more chunk may be sent and count it, False on timeout"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sent - self.acked < self.size, timeout):
+                return False
+            self.sent += 1
+            return True
+
+    def wait_started(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.started, timeout)
+
+    def wait_acked(self, timeout):
+        """Block until every chunk sent was acknowledged"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.acked >= self.sent, timeout)
+
+    def ack(self, received):
+        with self.condition:
+            self.started = True
+            if received > self.acked:
+                self.acked = received
+            self.condition.notify_all()
+
+class DataStreams:
+    """
+    Extra connections to the server that only carry file chunks, attached
+    to our login. A large transfer is striped over them: several TCP
+    windows fill a high-latency link that one cannot, and chat messages on
+    the main connection never queue behind chunks.
+    """
+
+    def __init__(self, address, nickname, session_key, count, on_chunk):
+        self.address = address
+        self.nickname = nickname
+        self.session_key = session_key
+        self.count = count
+        # Called with every chunk that arrives, from the reader threads
+        self.on_chunk = on_chunk
+        self.streams = []
+
+    def open(self):
+        """Connect the streams, False when the server takes none"""
+        for _ in range(self.count):
+            sock = None
+            try:
+                sock = socket.create_connection(self.address, timeout=10)
+                sock.settimeout(None)
+                stream = attach(FrameSocket(sock), self.nickname, self.session_key)
+            except (OSError, ValueError, LoginError):
+                if sock is not None:
+                    sock.close()
+                break
+            self.streams.append(stream)
+            threading.Thread(target=self._reader, args=(stream,), daemon=True).start()
+        return bool(self.streams)
+
+    def _reader(self, stream):
+        while True:
+            try:
+                frame_type, payload = stream.recv_frame()
+            except API.DECRYPTION_ERRORS:
+                continue
+            except Exception:
+                break
+            if frame_type == DATA:
+                self.on_chunk(payload)
+        if stream in self.streams:
+            self.streams.remove(stream)
+
+    def close(self):
+        for stream in list(self.streams):
+            stream.conn.close()
+
+class FileSink:
+    """
+    Receiving end of a transfer, every chunk is written at its offset as
+    soon as it arrives, so memory use does not depend on the file size.
+    The data goes to path + ".part", preallocated to the final size, a
+    bitmap with one bit per chunk tracks what arrived.
+
+    Chunks are checked against their digest on arrival, the whole file
+    against the SHA-256 in the end message before it is moved into place. A checkpoint saves
+    the bitmap to the state directory, after a disconnect the transfer
+    resumes from there and only the missing chunks are sent again.
+    """
+
+    def __init__(self, path, size, chunk_count, chunk_size=0, code=None, filename=None):
+        self.path = path
+        self.part_path = path + ".part"
+        self.size = size
+        self.chunk_count = chunk_count
+        # 0 for senders that did not announce it, taken from the first chunk
+        self.chunk_size = chunk_size
+        self.code = code
+        self.filename = filename or os.path.basename(path)
+        self.bitmap = bytearray((chunk_count + 7) // 8)
+        self.received = 0
+        self.corrupt = 0
+        self.unsaved = 0
+        self.file = open(self.part_path, 'wb')
+        self.file.truncate(size)
+        # A state from the start, a client that dies before the first
+        # checkpoint still finds the transfer again
+        self.checkpoint()
+
+    def resume(state):
+        """Reopen a partial transfer from its saved state, None when the data is gone"""
+        if not os.path.exists(state['path'] + ".part"):
+            return None
+        sink = FileSink.__new__(FileSink)
+        sink.path = state['path']
+        sink.part_path = state['path'] + ".part"
+        sink.size = state['size']
+        sink.chunk_count = state['chunk_count']
+        sink.chunk_size = state['chunk_size']
+        sink.code = state['code']
+        sink.filename = state['filename']
+        sink.bitmap = bytearray(base64.b64decode(state['bitmap']))
+        sink.received = sum(bin(byte).count("1") for byte in sink.bitmap)
+        sink.corrupt = 0
+        sink.unsaved = 0
+        sink.file = open(sink.part_path, 'r+b')
+        return sink
+
+    def has(self, index):
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def write(self, index, data, digest=None):
+        """Store one chunk, returns False for duplicates and corrupt chunks"""
+        if not 0 <= index < self.chunk_count:
+            raise ValueError(f"Chunk {index} out of range")
+        if self.has(index):
+            return False
+        if digest is not None and chunk_digest(data) != digest:
+            # Left missing, the next resume asks for it again
+            self.corrupt += 1
+            return False
+        if not self.chunk_size:
+            self.chunk_size = len(data)
+        
+        offset = index * self.chunk_size
+        if offset + len(data) > self.size:
+            raise ValueError(f"Chunk {index} past the end of the file")
+        self.file.seek(offset)
+        self.file.write(data)
+        
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.received += 1
+        self.unsaved += len(data)
+        if self.unsaved >= CHECKPOINT_BYTES:
+            self.checkpoint()
+        return True
+
+    def complete(self):
+        return self.received == self.chunk_count
+
+    def missing_ranges(self, limit=MAX_RESUME_RANGES):
+        return missing_ranges(self.bitmap, self.chunk_count, limit)
+
+    def checkpoint(self):
+        """Make the written chunks durable, then record them in the state file"""
+        if self.code is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        save_transfer_state(self.code, {
+            'code': self.code,
+            'filename': self.filename,
+            'path': self.path,
+            'size': self.size,
+            'chunk_count': self.chunk_count,
+            'chunk_size': self.chunk_size,
+            'bitmap': base64.b64encode(bytes(self.bitmap)).decode(),
+        })
+        self.unsaved = 0
+
+    def suspend(self):
+        """Keep the partial file and its state for a later resume"""
+        self.checkpoint()
+        self.file.close()
+
+    def finish(self, sha256=None):
+        """
+        Close the file and move it into place, only once every chunk arrived.
+        Returns False and removes the data when the file hash does not match.
+        """
+        self.file.close()
+        if sha256 and file_sha256(self.part_path)[:len(sha256)] != sha256:
+            self.discard()
+            return False
+        os.replace(self.part_path, self.path)
+        remove_transfer_state(self.code)
+        return True
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        remove_transfer_state(self.code)
+
+def missing_ranges(bitmap, chunk_count, limit=MAX_RESUME_RANGES):
+    """Inclusive (first, last) ranges of the chunks missing in a bitmap, at most limit of them"""
+    ranges = []
+    index = 0
+    while index < chunk_count:
+        if index & 7 == 0 and bitmap[index >> 3] == 0xFF:
+            # Skip complete bytes of the bitmap
+            index += 8
+            continue
+        if bitmap[index >> 3] & (1 << (index & 7)):
+            index += 1
+            continue
+        first = index
+        while index < chunk_count and not bitmap[index >> 3] & (1 << (index & 7)):
+            index += 1
+        if len(ranges) == limit - 1:
+            # Out of room, ask for everything from here on
+            ranges.append((first, chunk_count - 1))
+            break
+        ranges.append((first, index - 1))
+    return ranges
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+def file_sha256(path):
+    """SHA-256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def pack_chunk(file_code, index, data):
+    return CHUNK_HEADER.pack(file_code.encode(), index, chunk_digest(data)) + data
+
+def unpack_chunk(payload):
+    """Returns (file_code, index, digest, data) of a DATA frame"""
+    code, index, digest = CHUNK_HEADER.unpack_from(payload)
+    return code.decode(), index, digest, payload[CHUNK_HEADER.size:]
+
+def address(message, to):
+    """A file message for one user only, the server routes it there"""
+    return f"@{to} {message}" if to else message
+
+def address_chunk(payload, to):
+    """A DATA frame for one requester only, the server takes the name off"""
+    return b"@" + to.encode() + b" " + payload if to else payload
+
+def format_ranges(ranges):
+    return ",".join(f"{first}-{last}" for first, last in ranges)
+
+def parse_ranges(text, chunk_count):
+    """Chunk indexes of a "0-15,40-159" range list, in order"""
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        first, last = int(first), int(last or first)
+        yield from range(max(first, 0), min(last, chunk_count - 1) + 1)
+
+def transfer_state_path(code):
+    return os.path.join(TRANSFER_STATE_DIR, f"{code}.json")
+
+def save_transfer_state(code, state):
+    os.makedirs(TRANSFER_STATE_DIR, exist_ok=True)
+    path = transfer_state_path(code)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(state, f)
+    # Never a half written state, the old one stays until the new one is complete
+    os.replace(path + ".tmp", path)
+
+def load_transfer_state(code):
+    try:
+        with open(transfer_state_path(code), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def remove_transfer_state(code):
+    if code is not None and os.path.exists(transfer_state_path(code)):
+        os.remove(transfer_state_path(code))
+
+def pending_transfers():
+    """Saved states of the transfers that did not finish"""
+    if not os.path.isdir(TRANSFER_STATE_DIR):
+        return []
+    states = []
+    for name in sorted(os.listdir(TRANSFER_STATE_DIR)):
+        if name.endswith(".json"):
+            state = load_transfer_state(name[:-5])
+            if state:
+                states.append(state)
+    return states
 
 def format_size(size_bytes):
     """Format file size in KB or MB"""
@@ -36,18 +365,25 @@ def upload_file(display_message, username_styled, chat_api, username=None):
     
     display_message(f"<System> Preparing to share {filename} ({format_size(filesize)})...")
     
-    # Create a unique file code for the message
-    file_code = hashlib.md5(f"{filename}_{time.time()}".encode()).hexdigest()[:8]
+    # The code follows from the content, sharing the same file again after
+    # a restart gives the same code and downloads of it can resume
+    sha256 = file_sha256(file_path)
+    file_code = hashlib.sha256(f"{username}:{sha256}".encode()).hexdigest()[:8]
     
     try:
         # Share file info in chat
         message = f"{username_styled} [b]Shared file:[/b] {filename} ({format_size(filesize)}) | Code: #{file_code}"
         chat_api.send(message)
         
+        # A server with a file store keeps a copy, requests are then answered
+        # without us, servers without one ignore it
+        chat_api.send(f"/store #{file_code} {filesize} {sha256[:CONTENT_HASH_LENGTH]}", COMMAND)
+        
         file_info = {
             'path': file_path,
             'name': filename,
             'size': filesize,
+            'sha256': sha256,
             'shared_by': username if username else "You"  # Use provided username or default to "You"
         }
         
@@ -59,55 +395,105 @@ def upload_file(display_message, username_styled, chat_api, username=None):
         display_message(f"<System> Error sharing file: {str(e)}")
         return None
 
-def send_file_data(file_code, file_info, display_message, username_styled, chat_api):
-    """Send file data to the requester"""
+def send_file_data(file_code, file_info, display_message, username_styled, chat_api, window=None,
+                   chunk_size=None, ranges=None, to=None, streams=None):
+    """
+    Send file data to the requester as binary DATA frames, read from
+    disk one chunk at a time. With a window the pace is set by the
+    receiver's acknowledgements, otherwise by the socket.
+
+    A resuming receiver names the chunk size it started with and the
+    ranges it is missing, only those chunks are sent again. The messages
+    and the chunks are addressed to the requester, the server passes them
+    to that user only.
+    More than a window of chunks is striped over the data streams, one
+    thread per stream.
+    """
     try:
         file_path = file_info['path']
         filename = file_info['name']
         filesize = file_info['size']
         
+        if filesize > DIRECT_TRANSFER_LIMIT:
+            display_message(f"<System> File {filename} is too large for direct transfer")
+            chat_api.send(address(f"{username_styled} [b]File too large:[/b] {filename} is too big for direct transfer. Please use an alternative method.", to), FILE)
+            return
+        
         display_message(f"<System> Sending file {filename} to requester...")
+        started = time.monotonic()
         
-        # For smaller files, send directly through chat
-        # But keep the message small enough to avoid buffer problems with RSA encryption
-        # RSA has limitations on message size vs key size
-        safe_limit = 50 * 1024  # 50KB is safer for most RSA key sizes
+        # RSA-only mode fits about 100 bytes per chunk,
+        # session mode sends 64 KB chunks
+        max_chunk_size = chat_api.max_chunk_size
+        if getattr(chat_api, 'key', None) is None:
+            # The requester's name goes in front of every chunk, in the same RSA block
+            max_chunk_size -= len(address_chunk(b"", to))
+        if not chunk_size or chunk_size > max_chunk_size:
+            # Chunks this big do not fit, the receiver starts over
+            chunk_size = max_chunk_size
+            ranges = None
+        chunk_count = (filesize + chunk_size - 1) // chunk_size
+        indexes = list(parse_ranges(ranges, chunk_count)) if ranges else range(chunk_count)
         
-        if filesize <= safe_limit:
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-                encoded_data = base64.b64encode(file_data).decode('utf-8')
-            
-            # Calculate max message size for RSA (usually around 100-200 bytes depending on key size)
-            # We need to account for the overhead of the message format
-            max_chunk_size = 80  # Conservative estimate for RSA encryption with common key sizes
-            
-            # Split the encoded data into chunks that fit within RSA limits
-            data_chunks = [encoded_data[i:i+max_chunk_size] for i in range(0, len(encoded_data), max_chunk_size)]
-            
-            # Send file metadata first
-            meta_msg = f"{username_styled} [b]File start:[/b] #{file_code}:{filename}:{filesize}:{len(data_chunks)}"
-            chat_api.send(meta_msg)
-            
-            # Send chunks one by one
-            for i, chunk in enumerate(data_chunks):
-                chunk_msg = f"{username_styled} [b]File chunk:[/b] #{file_code}:{i}:{chunk}"
-                chat_api.send(chunk_msg)
-                # Small delay to avoid flooding
-                time.sleep(0.1)
-            
-            # Send completion message
-            end_msg = f"{username_styled} [b]File end:[/b] #{file_code}"
-            chat_api.send(end_msg)
-            
-            display_message(f"<System> File {filename} sent successfully in {len(data_chunks)} chunks")
+        # Send file metadata first, the filename may contain colons so it is not last
+        meta_msg = f"{username_styled} [b]File start:[/b] #{file_code}:{filename}:{filesize}:{chunk_count}:{chunk_size}"
+        chat_api.send(address(meta_msg, to), FILE)
+        
+        striped = 0
+        if streams and window is not None and len(indexes) > TRANSFER_WINDOW:
+            # Whole half windows over the streams, so the receiver acknowledges the last of them
+            striped = len(indexes) - len(indexes) % (TRANSFER_WINDOW // 2)
+            # Chunks on other connections could overtake the start message,
+            # the receiver's first acknowledgement says it is ready for them
+            if not window.wait_started(TRANSFER_ACK_TIMEOUT):
+                display_message(f"<System> Sending {filename} stopped, the receiver does not answer")
+                return
+            lanes = [(stream, indexes[lane:striped:len(streams)]) for lane, stream in enumerate(streams)]
         else:
-            # For larger files, notify that it's too large
-            display_message(f"<System> File {filename} is too large for direct transfer")
-            chat_api.send(f"{username_styled} [b]File too large:[/b] {filename} is too big for direct transfer. Please use an alternative method.")
+            lanes = [(chat_api, indexes)]
+        
+        results = [None] * len(lanes)
+        def send_lane(lane):
+            try:
+                results[lane] = send_chunks(file_path, file_code, chunk_size, *lanes[lane], window, to)
+            except OSError:
+                results[lane] = False
+        threads = [threading.Thread(target=send_lane, args=(lane,), daemon=True) for lane in range(1, len(lanes))]
+        for thread in threads:
+            thread.start()
+        send_lane(0)
+        for thread in threads:
+            thread.join()
+        
+        if striped:
+            # The rest once every striped chunk arrived, on the connection
+            # like the end message, so nothing overtakes it
+            results.append(window.wait_acked(TRANSFER_ACK_TIMEOUT) and
+                           send_chunks(file_path, file_code, chunk_size, chat_api, indexes[striped:], window, to))
+        if not all(results):
+            display_message(f"<System> Sending {filename} stopped, the receiver does not answer")
+            return
+        sent = len(indexes)
+        
+        # Send completion message, the receiver checks the file against the hash
+        end_msg = f"{username_styled} [b]File end:[/b] #{file_code}:{file_info['sha256'][:CONTENT_HASH_LENGTH]}"
+        chat_api.send(address(end_msg, to), FILE)
+        
+        elapsed = max(time.monotonic() - started, 0.001)
+        display_message(f"<System> File {filename} sent successfully in {sent} chunks ({format_size(min(sent * chunk_size, filesize) / elapsed)}/s)")
     except Exception as e:
         display_message(f"<System> Error sending file: {str(e)}")
 
+def send_chunks(file_path, file_code, chunk_size, connection, indexes, window=None, to=None):
+    """Send chunks over one connection, to one requester when given, False when the window timed out"""
+    with open(file_path, 'rb') as f:
+        for index in indexes:
+            if window is not None and not window.reserve(TRANSFER_ACK_TIMEOUT):
+                return False
+            f.seek(index * chunk_size)
+            connection.send(address_chunk(pack_chunk(file_code, index, f.read(chunk_size)), to), DATA)
+    return True
+
 def save_received_file(message, display_message):
     """Process and save incoming file data"""
     try:
@@ -116,27 +502,53 @@ def save_received_file(message, display_message):
             parts = message.split("[b]File start:[/b] #")
             if len(parts) > 1:
                 data_part = parts[1].strip()
-                code, filename, filesize, chunk_count = data_part.split(":", 3)
+                code, rest = data_part.split(":", 1)
+                if rest.count(":") >= 3:
+                    filename, filesize, chunk_count, chunk_size = rest.rsplit(":", 3)
+                else:
+                    # Senders from before binary chunks
+                    filename, filesize, chunk_count = rest.rsplit(":", 2)
+                    chunk_size = 0
                 
-                # Ask user where to save the file
-                save_path = filedialog.asksaveasfilename(
-                    title="Save Received File",
-                    initialfile=filename,
-                    defaultextension=".*",
-                    filetypes=[("All Files", "*.*")]
-                )
+                filesize, chunk_count, chunk_size = int(filesize), int(chunk_count), int(chunk_size)
+                
+                # A partial download of this file goes on where it stopped
+                sink = None
+                state = load_transfer_state(code)
+                if state and (state['size'], state['chunk_count'], state['chunk_size']) == (filesize, chunk_count, chunk_size):
+                    sink = FileSink.resume(state)
+                
+                if sink:
+                    save_path = sink.path
+                    display_message(f"<System> Resuming {filename}: {sink.received} of {chunk_count} chunks already received")
+                elif state:
+                    # Chunked differently or the data is gone, start over in the same place
+                    save_path = state['path']
+                else:
+                    # Ask user where to save the file
+                    save_path = filedialog.asksaveasfilename(
+                        title="Save Received File",
+                        initialfile=filename,
+                        defaultextension=".*",
+                        filetypes=[("All Files", "*.*")]
+                    )
                 
                 if save_path:
                     # Return the file path and code to start receiving chunks
+                    if sink is None:
+                        sink = FileSink(save_path, filesize, chunk_count, chunk_size, code, filename)
                     return {
                         'type': 'start',
                         'code': code,
                         'path': save_path,
                         'filename': filename,
-                        'filesize': int(filesize),
-                        'total_chunks': int(chunk_count),
-                        'chunks_received': 0,
-                        'data': []
+                        'filesize': filesize,
+                        'total_chunks': chunk_count,
+                        'chunk_size': chunk_size,
+                        'chunks_received': sink.received,
+                        'chunks_arrived': 0,
+                        'progress_shown': 0,
+                        'sink': sink
                     }
                 
         # Check if this is a file chunk message
@@ -146,22 +558,25 @@ def save_received_file(message, display_message):
                 data_part = parts[1].strip()
                 code, chunk_index, chunk_data = data_part.split(":", 2)
                 
+                # Base64 text chunk of an older sender
                 return {
                     'type': 'chunk',
                     'code': code,
                     'index': int(chunk_index),
-                    'data': chunk_data
+                    'data': base64.b64decode(chunk_data)
                 }
                 
         # Check if this is a file end message
         elif "[b]File end:[/b] #" in message:
             parts = message.split("[b]File end:[/b] #")
             if len(parts) > 1:
-                code = parts[1].strip()
+                # Older senders send the code only, without a hash
+                code, _, sha256 = parts[1].strip().partition(":")
                 
                 return {
                     'type': 'end',
-                    'code': code
+                    'code': code,
+                    'sha256': sha256 or None
                 }
                 
         # Check for legacy format (for backwards compatibility)
@@ -194,21 +609,28 @@ def save_received_file(message, display_message):
         display_message(f"<System> Error processing received file: {str(e)}")
         return None
 
+def read_data_frame(payload):
+    """Chunk info of a binary DATA frame, same shape as a text chunk"""
+    code, index, digest, data = unpack_chunk(payload)
+    return {'type': 'chunk', 'code': code, 'index': index, 'digest': digest, 'data': data}
+
 def process_file_chunk(file_data, chunk_info, display_message):
     """Process a chunk of file data"""
     try:
         if file_data['code'] == chunk_info['code']:
-            # Add this chunk to our data array at the specified index
-            while len(file_data['data']) <= chunk_info['index']:
-                file_data['data'].append('')
-            
-            file_data['data'][chunk_info['index']] = chunk_info['data']
-            file_data['chunks_received'] += 1
+            # Straight to disk at the chunk's offset
+            sink = file_data['sink']
+            sink.write(chunk_info['index'], chunk_info['data'], chunk_info.get('digest'))
+            file_data['chunks_received'] = sink.received
+            # Arrivals of this session, duplicates and corrupt chunks
+            # included, they pace the sender
+            file_data['chunks_arrived'] = file_data.get('chunks_arrived', 0) + 1
             
-            # Update progress
-            if file_data['chunks_received'] % 5 == 0 or file_data['chunks_received'] == file_data['total_chunks']:
-                progress = (file_data['chunks_received'] / file_data['total_chunks']) * 100
-                display_message(f"<System> Receiving file: {progress:.1f}% complete ({file_data['chunks_received']}/{file_data['total_chunks']} chunks)")
+            # Update progress every 10%
+            progress = int(sink.received * 100 / sink.chunk_count)
+            if progress >= file_data['progress_shown'] + 10 or sink.complete():
+                file_data['progress_shown'] = progress
+                display_message(f"<System> Receiving file: {progress}% complete ({sink.received}/{sink.chunk_count} chunks)")
             
             return file_data
         return None
@@ -216,17 +638,12 @@ def process_file_chunk(file_data, chunk_info, display_message):
         display_message(f"<System> Error processing file chunk: {str(e)}")
         return None
 
-def complete_file_transfer(file_data, display_message):
-    """Complete file transfer by writing all chunks to file"""
+def complete_file_transfer(file_data, display_message, sha256=None):
+    """Complete file transfer, the chunks are already on disk"""
     try:
-        # Join all chunks
-        full_data = ''.join(file_data['data'])
-        
-        # Decode and save
-        decoded_data = base64.b64decode(full_data)
-        
-        with open(file_data['path'], 'wb') as f:
-            f.write(decoded_data)
+        if not file_data['sink'].finish(sha256):
+            display_message(f"<System> File {file_data['filename']} is corrupt, it does not match the sender's hash. Type /get #{file_data['code']} to download it again.")
+            return False
         
         display_message(f"<System> File saved successfully: {os.path.basename(file_data['path'])}")
         return True
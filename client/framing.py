@@ -0,0 +1,137 @@
+"""
+Wire framing shared by the server and the client.
+
+Every message on the socket is a frame:
+    payload length (4 bytes, big-endian) | frame type (1 byte) | payload
+
+TCP is a byte stream, so one recv() may return half a frame or several
+frames at once. FrameDecoder buffers the incoming bytes and only hands out
+complete frames.
+"""
+
+import socket
+import struct
+import threading
+from collections import deque
+
+HEADER = struct.Struct("!IB")
+
+# Upper bound for a single frame, protects against garbage length headers
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Frame types
+CONTROL = 0  # Plaintext handshake messages
+CHAT = 1     # Encrypted chat message, forwarded to other clients
+FILE = 2     # Encrypted file transfer message, forwarded to other clients
+COMMAND = 3  # Encrypted command for the server, never forwarded
+HISTORY = 4  # Encrypted page of room history, server to client
+DATA = 5     # Encrypted binary file chunk, forwarded like FILE
+
+
+class FrameError(ValueError):
+    """Raised when the peer sends a malformed frame"""
+
+
+def encode_frame(payload: bytes, frame_type: int = CHAT) -> bytes:
+    """Prefix the payload with the frame header"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+class FrameDecoder:
+    """
+    Incremental frame decoder
+
+    def feed (data: bytes):
+        Add received bytes, returns the list of frames completed by them
+
+    def next_frame:
+        Pop the oldest decoded frame that was not returned by feed yet
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE) -> None:
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.frames = deque()
+
+    def feed(self, data: bytes):
+        self.buffer += data
+        frames = []
+        offset = 0
+
+        while len(self.buffer) - offset >= HEADER.size:
+            length, frame_type = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame too large: {length} bytes")
+
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                # Incomplete frame, wait for more data
+                break
+
+            frames.append((frame_type, bytes(self.buffer[offset + HEADER.size:end])))
+            offset = end
+
+        # Drop consumed bytes in one go instead of once per frame
+        if offset:
+            del self.buffer[:offset]
+
+        self.frames.extend(frames)
+        return frames
+
+    def next_frame(self):
+        if self.frames:
+            return self.frames.popleft()
+        return None
+
+
+class FrameSocket:
+    """
+    Blocking socket wrapper that sends and receives whole frames
+
+    def send_frame (payload: bytes, frame_type: int):
+        Send one frame, safe to call from several threads
+
+    def recv_frame:
+        Block until a whole frame arrived, returns (frame_type, payload)
+        or (None, b"") when the connection was closed
+    """
+
+    def __init__(self, sock, bufsize: int = 65536) -> None:
+        self.sock = sock
+        self.bufsize = bufsize
+        self.decoder = FrameDecoder()
+        self.send_lock = threading.Lock()
+        # Frames are written whole, Nagle would only delay pipelined ones
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
+            pass
+
+    def send_frame(self, payload: bytes, frame_type: int = CHAT):
+        frame = encode_frame(payload, frame_type)
+        # sendall may need several send calls, do not interleave frames
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def recv_frame(self):
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                return None, b""
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        return frame
+
+    def close(self):
+        # shutdown wakes up a thread blocked in recv on this socket, close alone does not
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def getpeername(self):
+        return self.sock.getpeername()
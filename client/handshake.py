@@ -0,0 +1,156 @@
+"""
+Login handshake, client side. See server/handshake.py for the message flow.
+
+The login goes out right after connecting and the cipher choice as soon as
+the server hello arrived, without waiting for the login result in between.
+"""
+
+import hashlib
+import hmac
+import json
+
+import rsa
+
+from api import API
+from framing import CONTROL
+
+# States
+HELLO = "hello"  # Waiting for the server hello
+LOGIN = "login"  # Waiting for the login result
+KEYS = "keys"    # RSA-only mode, waiting for our keypair
+DONE = "done"
+
+
+class LoginError(Exception):
+    """The server rejected the login, the message is meant for the user"""
+
+    MESSAGES = {
+        "retry": "Incorrect password",
+        "denied": "Incorrect password",
+        "taken": "Username already exists",
+        "invalid": "Invalid username",
+        "cipher": "No common cipher with the server",
+    }
+
+    def __init__(self, status: str) -> None:
+        super().__init__(self.MESSAGES.get(status, f"Login refused: {status}"))
+        self.status = status
+
+
+class Handshake:
+    """
+    Args: nickname, password_hash, conn (FrameSocket used by chat_api)
+
+    def start:
+        Frames to send as soon as the socket is connected
+
+    def receive (frame_type: int, payload: bytes):
+        Handle a server frame, returns the frames to send back,
+        raises LoginError when the server refused the login
+
+    chat_api:
+        API.SessionChat or API.Chat once state is DONE
+    """
+
+    def __init__(self, nickname: str, password_hash: str, conn=None) -> None:
+        self.conn = conn
+        self.nickname = nickname
+        self.password_hash = password_hash
+        self.state = HELLO
+        self.buffer = None
+        self.public_key = None
+        self.session_key = None
+        self.chat_api = None
+
+    def start(self):
+        # Sent before the hello, a server without a password ignores it
+        return [self._message("login", password=self.password_hash, nickname=self.nickname)]
+
+    def receive(self, frame_type: int, payload: bytes):
+        if frame_type != CONTROL:
+            raise ValueError("Expected a control frame during login")
+
+        message = json.loads(payload)
+        kind = message.get("type")
+
+        if kind == "hello" and self.state == HELLO:
+            self.buffer = message["buffer"]
+            self.public_key = rsa.PublicKey.load_pkcs1(message["public_key"].encode())
+            reply, self.session_key = API.choose_cipher(message["ciphers"], self.public_key)
+            self.state = LOGIN
+            return [(json.dumps(reply).encode(), CONTROL)]
+
+        if kind == "login" and self.state == LOGIN:
+            if message["status"] != "accepted":
+                raise LoginError(message["status"])
+            if self.session_key:
+                # Messages are sealed with our own session key
+                self.chat_api = API.SessionChat(self.session_key, self.conn)
+                self.state = DONE
+            else:
+                self.state = KEYS
+            return []
+
+        if kind == "keys" and self.state == KEYS:
+            # RSA-only mode, the server made a keypair for this session
+            public_key = rsa.PublicKey.load_pkcs1(message["public_key"].encode())
+            private_key = rsa.PrivateKey.load_pkcs1(message["private_key"].encode())
+            self.chat_api = API.Chat(private_key, public_key, self.conn, self.buffer)
+            self.state = DONE
+            return []
+
+        raise ValueError(f"Unexpected handshake message: {kind}")
+
+    def _message(self, kind: str, **fields):
+        fields["type"] = kind
+        return json.dumps(fields).encode(), CONTROL
+
+
+def attach_proof(session_key: bytes, nonce: bytes) -> str:
+    return hmac.new(session_key, b"attach" + nonce, hashlib.sha256).hexdigest()
+
+
+def stream_key(session_key: bytes, nonce: bytes) -> bytes:
+    return hmac.new(session_key, b"stream" + nonce, hashlib.sha256).digest()
+
+
+def attach(conn, nickname: str, session_key: bytes):
+    """
+    Make a connected FrameSocket a data stream of our login, returns its
+    chat API. Raises LoginError when the server does not take it.
+    """
+    frame_type, payload = conn.recv_frame()
+    if frame_type != CONTROL:
+        raise ConnectionResetError("Connection closed by server")
+    hello = json.loads(payload)
+    if "nonce" not in hello:
+        # Server without data streams
+        raise LoginError("attach")
+    nonce = bytes.fromhex(hello["nonce"])
+
+    message = {"type": "attach", "nickname": nickname, "proof": attach_proof(session_key, nonce)}
+    conn.send_frame(json.dumps(message).encode(), CONTROL)
+
+    frame_type, payload = conn.recv_frame()
+    if frame_type != CONTROL:
+        raise ConnectionResetError("Connection closed by server")
+    status = json.loads(payload).get("status")
+    if status != "accepted":
+        raise LoginError(status)
+    return API.SessionChat(stream_key(session_key, nonce), conn)
+
+
+def login(conn, nickname: str, password_hash: str):
+    """Run the handshake on a connected FrameSocket, returns the chat API"""
+    handshake = Handshake(nickname, password_hash, conn)
+    for payload, frame_type in handshake.start():
+        conn.send_frame(payload, frame_type)
+
+    while handshake.state != DONE:
+        frame_type, payload = conn.recv_frame()
+        if frame_type is None:
+            raise ConnectionResetError("Connection closed by server")
+        for reply, reply_type in handshake.receive(frame_type, payload):
+            conn.send_frame(reply, reply_type)
+
+    return handshake.chat_api
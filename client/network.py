@@ -1,6 +1,8 @@
 import socket
 from anonfile import AnonFile
+from framing import FrameSocket
 
 # Socket and network related globals
 s = socket.socket()
+conn = FrameSocket(s)
 anon = AnonFile()
\ No newline at end of file
@@ -0,0 +1,185 @@
+import heapq
+import ipaddress
+import itertools
+import threading
+import time
+
+
+class BanIndex:
+    """
+    In-memory ban list backed by the banned_users table
+
+    Bans are kept in a binary prefix trie over the address bits, one trie
+    for IPv4 and one for IPv6. A single address is a full-length prefix,
+    a CIDR range a shorter one, so a lookup is at most 32 (128) steps no
+    matter how many bans exist. Expiry times sit in a heap and due entries
+    are dropped lazily before each lookup.
+
+    def load:
+        Read the active bans from the database
+
+    def ban (target: str, reason: str, duration_hours: float):
+        Ban an address or CIDR range, written through to the database
+
+    def unban (target: str):
+        Lift a ban, written through to the database
+
+    def apply (target: str, banned_until: float):
+        Add a ban another worker already wrote to the database
+
+    def lift (target: str):
+        Remove a ban from memory only
+
+    def is_banned (ip: str):
+        Check an address against every ban
+
+    def bans:
+        Active bans as (network, banned_until), the first to expire first
+    """
+
+    # Trie node layout: [child for bit 0, child for bit 1, banned_until]
+    UNTIL = 2
+
+    def __init__(self, db=None) -> None:
+        self.db = db
+        self.lock = threading.Lock()
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        # (banned_until, sequence, network) entries, may hold stale ones after re-bans
+        self.expiry = []
+        self.sequence = itertools.count()
+        self.count = 0
+
+    def parse(target: str):
+        """Normalize an address or CIDR range, IPv4-mapped IPv6 becomes IPv4"""
+        network = ipaddress.ip_network(target.strip(), strict=False)
+        if network.version == 6 and network.network_address.ipv4_mapped and network.prefixlen >= 96:
+            mapped = network.network_address.ipv4_mapped
+            network = ipaddress.ip_network(f"{mapped}/{network.prefixlen - 96}", strict=False)
+        return network
+
+    def load(self):
+        if self.db is None:
+            return
+        for ip_address, reason, banned_until in self.db.get_active_bans():
+            try:
+                self._insert(BanIndex.parse(ip_address), banned_until)
+            except ValueError:
+                # Not an address, nothing would ever match it
+                continue
+
+    def ban(self, target: str, reason=None, duration_hours=24):
+        network = BanIndex.parse(target)
+        banned_until = time.time() + duration_hours * 3600
+
+        # Write through first, the ban must survive a restart
+        if self.db is not None:
+            self.db.ban_user(BanIndex.format(network), reason, duration_hours)
+
+        self._insert(network, banned_until)
+        return network
+
+    def unban(self, target: str):
+        network = BanIndex.parse(target)
+
+        if self.db is not None:
+            self.db.unban(BanIndex.format(network))
+
+        return self.lift(target)
+
+    def apply(self, target: str, banned_until: float):
+        self._insert(BanIndex.parse(target), banned_until)
+
+    def lift(self, target: str) -> bool:
+        network = BanIndex.parse(target)
+        with self.lock:
+            node = self._find(network)
+            if node is None or node[self.UNTIL] is None:
+                return False
+            node[self.UNTIL] = None
+            self.count -= 1
+            return True
+
+    def is_banned(self, ip: str) -> bool:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+
+            node = self.roots[address.version]
+            bits = int(address)
+            width = address.max_prefixlen
+
+            # Every node on the path is a prefix of the address
+            for depth in range(width + 1):
+                if node[self.UNTIL] is not None and node[self.UNTIL] > now:
+                    return True
+                if depth == width:
+                    break
+                node = node[(bits >> (width - depth - 1)) & 1]
+                if node is None:
+                    break
+        return False
+
+    def bans(self):
+        """Active bans as (network, banned_until), for admin listings"""
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            found = {}
+            for banned_until, _, network in self.expiry:
+                node = self._find(network)
+                if node is not None and node[self.UNTIL] == banned_until:
+                    found[network] = banned_until
+        return sorted(found.items(), key=lambda item: item[1])
+
+    def format(network) -> str:
+        """Single addresses are stored without a prefix length, like before CIDR support"""
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+        return str(network)
+
+    def _insert(self, network, banned_until):
+        with self.lock:
+            node = self.roots[network.version]
+            bits = int(network.network_address)
+            width = network.max_prefixlen
+
+            for depth in range(network.prefixlen):
+                bit = (bits >> (width - depth - 1)) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, None]
+                node = node[bit]
+
+            if node[self.UNTIL] is None:
+                self.count += 1
+            # Overlapping bans on the same prefix keep the longest one
+            if node[self.UNTIL] is None or banned_until > node[self.UNTIL]:
+                node[self.UNTIL] = banned_until
+                heapq.heappush(self.expiry, (banned_until, next(self.sequence), network))
+
+    def _find(self, network):
+        node = self.roots[network.version]
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+
+        for depth in range(network.prefixlen):
+            node = node[(bits >> (width - depth - 1)) & 1]
+            if node is None:
+                return None
+        return node
+
+    def _expire(self, now):
+        """Drop bans that ran out, caller holds the lock"""
+        while self.expiry and self.expiry[0][0] <= now:
+            banned_until, _, network = heapq.heappop(self.expiry)
+            node = self._find(network)
+            # Skip stale heap entries of bans that were extended or lifted
+            if node is not None and node[self.UNTIL] == banned_until:
+                node[self.UNTIL] = None
+                self.count -= 1
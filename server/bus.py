@@ -0,0 +1,257 @@
+"""
+Local message bus between the worker processes of a multi-process server.
+
+The supervisor runs the Hub on a Unix socket, every worker connects a
+BusClient. Messages are JSON objects in CONTROL frames with a "type":
+
+    claim {nick, ip, room}     Take a nickname, the hub answers, it owns presence
+    release {nick}             Give a nickname back
+    move {nick, room}          A user changed rooms
+    presence {event, nick, ip, room}
+                               Join, move or leave of a user on another worker
+    persist {op, args}         Database write, routed to the owner (worker 0)
+    direct {nick, ...}         Message for one user, routed to the worker it is on
+    reply {id, result}         Answer to a request
+    anything else              Relayed to every other worker (broadcast, ban, ...)
+"""
+
+import itertools
+import json
+import os
+import socket
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from framing import FrameSocket, CONTROL
+
+# The worker that owns the database writer
+OWNER = 0
+
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(",", ":")).encode()
+
+
+class Hub:
+    """
+    Message router, runs in the supervisor
+
+    def start:
+        Listen on the Unix socket and serve workers in background threads
+
+    def close:
+        Stop listening and remove the socket file
+    """
+
+    def __init__(self, path: str, max_pending: int = 100000) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.workers = {}
+        # nick -> [worker, ip, room] of every logged in user
+        self.presence = {}
+        # Writes waiting for the owner to (re)connect
+        self.pending = deque(maxlen=max_pending)
+        self.listener = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # Left over from a server that did not shut down cleanly
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(64)
+        threading.Thread(target=self._accept, name="bus-hub", daemon=True).start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(FrameSocket(sock),), daemon=True).start()
+
+    def _serve(self, conn):
+        frame_type, payload = conn.recv_frame()
+        if frame_type is None:
+            return
+        worker = json.loads(payload)["worker"]
+
+        with self.lock:
+            self.workers[worker] = conn
+            # A late or restarted worker learns who is online
+            for nick, (owner, ip, room) in self.presence.items():
+                self._send(conn, {"type": "presence", "event": "join", "nick": nick, "ip": ip, "room": room})
+            if worker == OWNER:
+                while self.pending:
+                    self._send(conn, self.pending.popleft())
+
+        try:
+            while True:
+                frame_type, payload = conn.recv_frame()
+                if frame_type is None:
+                    break
+                self._handle(worker, json.loads(payload))
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._disconnected(worker, conn)
+
+    def _handle(self, worker, message):
+        kind = message.get("type")
+
+        with self.lock:
+            if kind == "claim":
+                nick = message["nick"]
+                ok = nick not in self.presence
+                if ok:
+                    self.presence[nick] = [worker, message["ip"], message["room"]]
+                self._send(self.workers.get(worker), {"type": "reply", "id": message["id"], "result": ok})
+                if ok:
+                    message.update(type="presence", event="join")
+                    del message["id"]
+                    self._relay(worker, message)
+
+            elif kind == "move":
+                nick = message["nick"]
+                if self.presence.get(nick, (None,))[0] == worker:
+                    self.presence[nick][2] = message["room"]
+                    self._relay(worker, {"type": "presence", "event": "move", "nick": nick, "room": message["room"]})
+
+            elif kind == "release":
+                nick = message["nick"]
+                if self.presence.get(nick, (None,))[0] == worker:
+                    self.presence.pop(nick)
+                    self._relay(worker, {"type": "presence", "event": "leave", "nick": nick})
+
+            elif kind == "persist":
+                message["from"] = worker
+                owner = self.workers.get(OWNER)
+                if owner is None or not self._send(owner, message):
+                    self.pending.append(message)
+
+            elif kind == "reply":
+                self._send(self.workers.get(message.pop("to")), message)
+
+            elif kind == "direct":
+                owner = self.presence.get(message["nick"], (None,))[0]
+                self._send(self.workers.get(owner), message)
+
+            else:
+                self._relay(worker, message)
+
+    def _disconnected(self, worker, conn):
+        with self.lock:
+            if self.workers.get(worker) is conn:
+                del self.workers[worker]
+            # Its users are gone with it
+            for nick, (owner, ip, room) in list(self.presence.items()):
+                if owner == worker:
+                    del self.presence[nick]
+                    self._relay(worker, {"type": "presence", "event": "leave", "nick": nick})
+        conn.close()
+
+    def _relay(self, origin, message):
+        """Send to every worker except origin, caller holds the lock"""
+        for worker, conn in self.workers.items():
+            if worker != origin:
+                self._send(conn, message)
+
+    def _send(self, conn, message) -> bool:
+        if conn is None:
+            return False
+        try:
+            conn.send_frame(encode(message), CONTROL)
+            return True
+        except OSError:
+            return False
+
+
+class BusClient:
+    """
+    Connection of a worker to the hub
+
+    def connect (dispatch):
+        Register with the hub, dispatch is called from the reader thread
+        with every message for this worker
+
+    def publish (message: dict):
+        Send to every other worker
+
+    def request (message: dict):
+        Send to the hub and wait for the answer
+
+    def persist (op: str, args: tuple, reply: bool):
+        Database write for the owner, waits for the result when reply is set
+
+    def answer (message: dict, result):
+        Reply to a persist request forwarded by the hub
+    """
+
+    def __init__(self, path: str, worker: int, timeout: float = 5.0) -> None:
+        self.path = path
+        self.worker = worker
+        self.dispatch = None
+        self.timeout = timeout
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.conn = None
+
+    def connect(self, dispatch):
+        self.dispatch = dispatch
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.conn = FrameSocket(sock)
+        self.conn.send_frame(encode({"type": "hello", "worker": self.worker}), CONTROL)
+        threading.Thread(target=self._reader, name="bus-client", daemon=True).start()
+
+    def publish(self, message: dict):
+        self.conn.send_frame(encode(message), CONTROL)
+
+    def request(self, message: dict):
+        future = Future()
+        with self.lock:
+            message["id"] = next(self.ids)
+            self.waiting[message["id"]] = future
+        self.publish(message)
+        try:
+            return future.result(self.timeout)
+        finally:
+            with self.lock:
+                self.waiting.pop(message["id"], None)
+
+    def persist(self, op: str, args: tuple, reply: bool = False):
+        message = {"type": "persist", "op": op, "args": list(args)}
+        if reply:
+            return self.request(message)
+        self.publish(message)
+
+    def answer(self, message: dict, result):
+        if "id" in message:
+            self.publish({"type": "reply", "id": message["id"], "to": message["from"], "result": result})
+
+    def _reader(self):
+        while True:
+            try:
+                frame_type, payload = self.conn.recv_frame()
+            except OSError:
+                break
+            if frame_type is None:
+                break
+
+            message = json.loads(payload)
+            if message.get("type") == "reply":
+                with self.lock:
+                    future = self.waiting.get(message["id"])
+                if future is not None:
+                    future.set_result(message["result"])
+            else:
+                self.dispatch(message)
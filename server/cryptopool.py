@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import rsa
+
+_STOP = object()
+
+
+def decrypt_batch(jobs):
+    """Runs in a worker process, one result or exception per job"""
+    results = []
+    for private_key, ciphertext in jobs:
+        try:
+            results.append(rsa.decrypt(ciphertext, private_key).decode())
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class CryptoPool:
+    """
+    RSA decryption of inbound messages in worker processes
+
+    Pure-Python RSA holds the GIL, decrypting in the connection threads
+    lets one core serve every RSA-only client. Jobs go through a queue,
+    a dispatcher thread sends whatever piled up as one batch so the
+    inter-process overhead is paid once per batch instead of per message.
+
+    def available:
+        Whether worker processes can be used on this platform
+
+    def start:
+        Start the worker processes
+
+    def decrypt (private_key, ciphertext: bytes):
+        Future resolved with the decoded message
+
+    def close:
+        Stop the dispatcher and the workers
+    """
+
+    def __init__(self, workers: int = None, batch_size: int = 64) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.jobs = queue.SimpleQueue()
+        self.executor = None
+        self.dispatcher = None
+        self.batches = 0
+        self.decrypted = 0
+
+    def available() -> bool:
+        # fork, spawn would re-run the server module in every worker
+        return "fork" in multiprocessing.get_all_start_methods()
+
+    def start(self):
+        context = multiprocessing.get_context("fork")
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+        # Fork the workers now, not later from a busy connection thread
+        self.executor.submit(int).result()
+        self.dispatcher = threading.Thread(target=self._dispatch, name="crypto-dispatch", daemon=True)
+        self.dispatcher.start()
+
+    def decrypt(self, private_key, ciphertext: bytes) -> Future:
+        future = Future()
+        self.jobs.put((future, private_key, ciphertext))
+        return future
+
+    def close(self):
+        if self.dispatcher is not None:
+            self.jobs.put(_STOP)
+            self.dispatcher.join()
+            self.dispatcher = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _dispatch(self):
+        stopping = False
+        while not stopping:
+            job = self.jobs.get()
+            if job is _STOP:
+                break
+
+            # Take everything that queued up meanwhile, up to batch_size
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stopping = True
+                    break
+                batch.append(job)
+
+            futures = [future for future, _, _ in batch]
+            try:
+                task = self.executor.submit(decrypt_batch, [(key, data) for _, key, data in batch])
+            except RuntimeError as e:
+                # Shut down
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            task.add_done_callback(lambda task, futures=futures: self._resolve(task, futures))
+
+    def _resolve(self, task, futures):
+        try:
+            results = task.result()
+        except BaseException as e:
+            # A worker died or the pool was shut down
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        self.decrypted += len(results)
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -3,11 +3,70 @@ import sqlite3
 import os
 import hashlib
 import time
+import queue
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
+# Tells the writer thread to flush and exit
+_STOP = object()
+
+# Accepted values for the connection pragmas that take keywords
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+
+# Room of messages saved without one, and of the history from before rooms
+DEFAULT_ROOM = "lobby"
+
+class UserCache:
+    """Bounded LRU map of username -> (user_id, is_admin), callers hold Database.lock"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, username):
+        entry = self.entries.get(username)
+        if entry is not None:
+            self.entries.move_to_end(username)
+        return entry
+
+    def put(self, username, user_id, is_admin):
+        self.entries[username] = (user_id, bool(is_admin))
+        self.entries.move_to_end(username)
+        if len(self.entries) > self.max_size:
+            # Evict the least recently used user
+            self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        self.entries.pop(username, None)
+
+    def clear(self):
+        self.entries.clear()
+
 class Database:
-    def __init__(self, db_file="chat_database.db"):
-        """Initialize database connection and create tables if they don't exist"""
+    def __init__(self, db_file="chat_database.db", flush_interval=0.5, batch_size=500,
+                 queue_size=10000, queue_timeout=5.0, user_cache_size=10000,
+                 journal_mode="wal", synchronous="normal", cache_size=-65536,
+                 mmap_size=268435456):
+        """
+        Initialize database connection and create tables if they don't exist
+
+        Chat messages are written behind: save_message queues them and a
+        writer thread inserts them in batches of up to batch_size, at most
+        flush_interval seconds after they were queued. When queue_size
+        messages are waiting, save_message blocks for up to queue_timeout
+        seconds before dropping the message.
+
+        Known users are kept in an LRU cache of user_cache_size entries so
+        the message path does not look them up again.
+
+        journal_mode, synchronous, cache_size (pages, or KiB when negative)
+        and mmap_size (bytes) are applied as pragmas on the connection.
+
+        forward (op, args, reply) takes over the writes when set, a server
+        worker that does not own the database hands them to the one that does.
+        """
         self.db_file = db_file
         
         # Create database directory if it doesn't exist
@@ -17,8 +76,42 @@ class Database:
             
         self.conn = sqlite3.connect(db_file, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        # The connection is shared by the handlers and the writer thread
+        self.lock = threading.RLock()
+        self.user_cache = UserCache(user_cache_size)
+        self.configure(journal_mode, synchronous, cache_size, mmap_size)
         self.create_tables()
+        self.migrate()
+        
+        # Write-behind queue for chat messages
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue_timeout = queue_timeout
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.dropped_messages = 0
+        self.closed = False
+        self.forward = None
+        self.writer_thread = threading.Thread(target=self._writer, name="db-writer", daemon=True)
+        self.writer_thread.start()
+        
+        # Planner statistics, refreshed by start_optimizer
+        self.stopped = threading.Event()
+        self.optimizer_thread = None
         
+    def configure(self, journal_mode, synchronous, cache_size, mmap_size):
+        """Apply the performance pragmas, PRAGMA values cannot be bound as parameters"""
+        journal_mode = str(journal_mode).lower()
+        synchronous = str(synchronous).lower()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"Invalid journal mode: {journal_mode}")
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Invalid synchronous level: {synchronous}")
+        
+        self.cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+        self.cursor.execute(f"PRAGMA synchronous = {synchronous}")
+        self.cursor.execute(f"PRAGMA cache_size = {int(cache_size)}")
+        self.cursor.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+    
     def create_tables(self):
         """Create necessary tables if they don't exist"""
         # Users table
@@ -76,14 +169,233 @@ class Database:
         
         self.conn.commit()
     
+    def migrate(self):
+        """
+        Upgrade the schema of an existing database in place.
+        PRAGMA user_version holds the number of migrations already applied,
+        new migrations are only ever appended to the list.
+        """
+        migrations = [
+            self._migration_indexes,
+            self._migration_stats,
+            self._migration_rooms,
+            self._migration_search,
+            self._migration_files,
+            self._migration_statistics,
+        ]
+        
+        with self.lock:
+            version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+            
+            for number, migration in enumerate(migrations[version:], start=version + 1):
+                # DDL does not open a transaction implicitly, do it by hand
+                # so a migration is applied completely or not at all
+                self.cursor.execute("BEGIN")
+                try:
+                    migration()
+                    self.cursor.execute(f"PRAGMA user_version = {number}")
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+    
+    def _migration_indexes(self):
+        """1: Indexes for history, ban and shared file lookups"""
+        # Recent history, rowid is implicitly the last column of every index
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, timestamp)"
+        )
+        # Covers is_banned, no table access needed
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_banned_ip ON banned_users (ip_address, banned_at, banned_until)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_shared_files_user ON shared_files (user_id)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_shared_files_url ON shared_files (file_url)"
+        )
+    
+    def _migration_stats(self):
+        """2: Counters kept up to date by triggers, so statistics never scan a table"""
+        statements = [
+            '''
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                shared_files INTEGER NOT NULL DEFAULT 0,
+                last_message TIMESTAMP
+            )
+            ''',
+            "CREATE INDEX IF NOT EXISTS idx_user_stats_messages ON user_stats (message_count)",
+            # Messages per hour, keyed by 'YYYY-MM-DD HH' in UTC
+            '''
+            CREATE TABLE IF NOT EXISTS message_rate (
+                hour TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_message_insert AFTER INSERT ON messages
+            BEGIN
+                UPDATE stats SET value = value + 1 WHERE name = 'messages';
+                INSERT INTO user_stats (user_id, message_count, last_message)
+                VALUES (NEW.user_id, 1, NEW.timestamp)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    message_count = message_count + 1,
+                    last_message = NEW.timestamp;
+                INSERT INTO message_rate (hour, count)
+                VALUES (strftime('%Y-%m-%d %H', NEW.timestamp), 1)
+                ON CONFLICT (hour) DO UPDATE SET count = count + 1;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_message_delete AFTER DELETE ON messages
+            BEGIN
+                UPDATE stats SET value = value - 1 WHERE name = 'messages';
+                UPDATE user_stats SET message_count = message_count - 1 WHERE user_id = OLD.user_id;
+                UPDATE message_rate SET count = count - 1
+                WHERE hour = strftime('%Y-%m-%d %H', OLD.timestamp);
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_user_insert AFTER INSERT ON users
+            BEGIN
+                UPDATE stats SET value = value + 1 WHERE name = 'users';
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_user_delete AFTER DELETE ON users
+            BEGIN
+                UPDATE stats SET value = value - 1 WHERE name = 'users';
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_file_insert AFTER INSERT ON shared_files
+            BEGIN
+                UPDATE stats SET value = value + 1 WHERE name = 'shared_files';
+                INSERT INTO user_stats (user_id, shared_files) VALUES (NEW.user_id, 1)
+                ON CONFLICT (user_id) DO UPDATE SET shared_files = shared_files + 1;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS stats_file_delete AFTER DELETE ON shared_files
+            BEGIN
+                UPDATE stats SET value = value - 1 WHERE name = 'shared_files';
+                UPDATE user_stats SET shared_files = shared_files - 1 WHERE user_id = OLD.user_id;
+            END
+            ''',
+        ]
+        for statement in statements:
+            self.cursor.execute(statement)
+        
+        # Backfill from the existing rows, the only full scans ever needed
+        self.cursor.execute('''
+        INSERT OR REPLACE INTO stats (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'messages', COUNT(*) FROM messages
+        UNION ALL SELECT 'shared_files', COUNT(*) FROM shared_files
+        ''')
+        self.cursor.execute('''
+        INSERT OR REPLACE INTO user_stats (user_id, message_count, shared_files, last_message)
+        SELECT users.id,
+               (SELECT COUNT(*) FROM messages WHERE messages.user_id = users.id),
+               (SELECT COUNT(*) FROM shared_files WHERE shared_files.user_id = users.id),
+               (SELECT MAX(timestamp) FROM messages WHERE messages.user_id = users.id)
+        FROM users
+        ''')
+        self.cursor.execute('''
+        INSERT OR REPLACE INTO message_rate (hour, count)
+        SELECT strftime('%Y-%m-%d %H', timestamp), COUNT(*)
+        FROM messages
+        GROUP BY 1
+        ''')
+    
+    def _migration_rooms(self):
+        """3: Messages belong to a room, room history is read through an index"""
+        self.cursor.execute(
+            f"ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}'"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_room ON messages (room, timestamp)"
+        )
+    
+    def _migration_search(self):
+        """4: Full-text index of the messages, kept in sync by triggers"""
+        # External content table, the text itself stays in messages only
+        self.cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+            content,
+            content = 'messages',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        ''')
+        statements = [
+            '''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+                INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+            ''',
+        ]
+        for statement in statements:
+            self.cursor.execute(statement)
+        
+        # Backfill: index the existing history in one pass
+        self.cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    
+    def _migration_files(self):
+        """5: Shared files are found by code, stored ones by content hash"""
+        for column in ("file_code TEXT", "content_hash TEXT", "size INTEGER", "stored INTEGER NOT NULL DEFAULT 0"):
+            self.cursor.execute(f"ALTER TABLE shared_files ADD COLUMN {column}")
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_shared_files_code ON shared_files (file_code)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_shared_files_hash ON shared_files (content_hash)"
+        )
+    
+    def _migration_statistics(self):
+        """6: Analyze the tables again, migration 1 did it while they were empty and the plans kept those numbers"""
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if self.cursor.fetchone():
+            # Sampled, from here on optimize keeps the statistics current
+            self.cursor.execute("PRAGMA analysis_limit = 1000")
+            self.cursor.execute("ANALYZE")
+    
     def register_user(self, username, password_hash):
         """Register a new user"""
         try:
-            self.cursor.execute(
-                "INSERT INTO users (username, password) VALUES (?, ?)",
-                (username, password_hash)
-            )
-            self.conn.commit()
+            with self.lock:
+                self.cursor.execute(
+                    "INSERT INTO users (username, password) VALUES (?, ?)",
+                    (username, password_hash)
+                )
+                self.conn.commit()
+                self.user_cache.invalidate(username)
             return True
         except sqlite3.IntegrityError:
             # Username already exists
@@ -91,131 +403,582 @@ class Database:
     
     def authenticate_user(self, username, password_hash):
         """Authenticate a user"""
-        self.cursor.execute(
-            "SELECT id, password FROM users WHERE username = ?",
-            (username,)
-        )
-        user = self.cursor.fetchone()
-        
-        if user and user[1] == password_hash:
-            # Update last login time
+        with self.lock:
             self.cursor.execute(
-                "UPDATE users SET last_login = ? WHERE id = ?",
-                (datetime.now(), user[0])
+                "SELECT id, password FROM users WHERE username = ?",
+                (username,)
             )
-            self.conn.commit()
-            return True
-        return False
+            user = self.cursor.fetchone()
+            
+            if user and user[1] == password_hash:
+                # Update last login time
+                self.cursor.execute(
+                    "UPDATE users SET last_login = ? WHERE id = ?",
+                    (datetime.now(), user[0])
+                )
+                self.conn.commit()
+                return True
+            return False
+    
+    def lookup_user(self, username):
+        """Get (user_id, is_admin) from the cache or the database, None if unknown"""
+        with self.lock:
+            entry = self.user_cache.get(username)
+            if entry is not None:
+                return entry
+            
+            self.cursor.execute(
+                "SELECT id, is_admin FROM users WHERE username = ?",
+                (username,)
+            )
+            user = self.cursor.fetchone()
+            if not user:
+                return None
+            
+            self.user_cache.put(username, user[0], user[1])
+            return self.user_cache.get(username)
     
     def is_user_admin(self, username):
-        """Check if user is an admin"""
-        self.cursor.execute(
-            "SELECT is_admin FROM users WHERE username = ?",
-            (username,)
-        )
-        result = self.cursor.fetchone()
-        return bool(result and result[0])
+        """Check if user is an admin, also caches the user for the message path"""
+        user = self.lookup_user(username)
+        return bool(user and user[1])
     
-    def save_message(self, username, message):
-        """Save a chat message"""
-        # Get or create user
-        self.cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-        user = self.cursor.fetchone()
+    def set_admin(self, username, is_admin=True):
+        """Promote or demote a user, returns False for unknown users"""
+        if self.forward is not None:
+            self.invalidate_user(username)
+            return self.forward("set_admin", (username, is_admin), True)
         
-        if not user:
-            # For system messages, create a system user if it doesn't exist
-            if username == "System":
+        with self.lock:
+            self.cursor.execute(
+                "UPDATE users SET is_admin = ? WHERE username = ?",
+                (1 if is_admin else 0, username)
+            )
+            self.conn.commit()
+            self.user_cache.invalidate(username)
+            return self.cursor.rowcount > 0
+    
+    def invalidate_user(self, username):
+        """Forget the cached entry of a user changed by another process"""
+        with self.lock:
+            self.user_cache.invalidate(username)
+    
+    def get_user_id(self, username):
+        """Get the id of a user, creating an account with a random password if needed"""
+        with self.lock:
+            user = self.lookup_user(username)
+            
+            if not user:
+                # System messages and unknown chat users get a placeholder account,
+                # the caller commits
                 self.cursor.execute(
                     "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
                     (username, hashlib.md5(os.urandom(16).hex().encode()).hexdigest())
                 )
-                self.cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-                user = self.cursor.fetchone()
-            else:
-                # Create a regular user if needed
-                self.register_user(username, hashlib.md5(os.urandom(16).hex().encode()).hexdigest())
-                self.cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-                user = self.cursor.fetchone()
-                
-        if user:
-            self.cursor.execute(
-                "INSERT INTO messages (user_id, content) VALUES (?, ?)",
-                (user[0], message)
-            )
-            self.conn.commit()
+                user = self.lookup_user(username)
+        
+        return user[0] if user else None
+    
+    def save_message(self, username, message, room=DEFAULT_ROOM, timestamp=None):
+        """Queue a chat message of a room for the writer thread"""
+        if self.closed:
+            return False
+        
+        # Same format as CURRENT_TIMESTAMP, taken now and not when the batch is written
+        if timestamp is None:
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        
+        if self.forward is not None:
+            self.forward("save_message", (username, message, room, timestamp), False)
             return True
-        return False
+        
+        try:
+            # Blocks while the queue is full, so producers slow down to the writer's pace
+            self.write_queue.put((username, message, timestamp, room), timeout=self.queue_timeout)
+            return True
+        except queue.Full:
+            self.dropped_messages += 1
+            return False
     
-    def get_recent_messages(self, limit=50):
-        """Get recent chat messages"""
-        self.cursor.execute('''
-        SELECT users.username, messages.content, messages.timestamp
+    def write_messages(self, records):
+        """Insert a batch of (username, message, timestamp, room) records in one transaction"""
+        with self.lock:
+            try:
+                rows = [
+                    (self.get_user_id(username), message, timestamp, room)
+                    for username, message, timestamp, room in records
+                ]
+                self.cursor.executemany(
+                    "INSERT INTO messages (user_id, content, timestamp, room) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                # Placeholder users created by this batch are gone as well
+                self.user_cache.clear()
+                print(f"Error writing {len(records)} messages: {e}")
+    
+    def _writer(self):
+        """Drain the write queue in batches until close() is called"""
+        running = True
+        while running:
+            item = self.write_queue.get()
+            if item is _STOP:
+                break
+            
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            
+            # Collect more records until the batch is full or the flush interval ran out
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.write_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    running = False
+                    break
+                batch.append(item)
+            
+            self.write_messages(batch)
+    
+    def get_recent_messages(self, limit=50, room=None):
+        """Get recent chat messages, of one room when given"""
+        with self.lock:
+            if room is None:
+                self.cursor.execute('''
+                SELECT users.username, messages.content, messages.timestamp
+                FROM messages
+                JOIN users ON messages.user_id = users.id
+                ORDER BY messages.timestamp DESC, messages.id DESC
+                LIMIT ?
+                ''', (limit,))
+            else:
+                # Walks idx_messages_room backwards, the rowid breaks timestamp ties
+                self.cursor.execute('''
+                SELECT users.username, messages.content, messages.timestamp
+                FROM messages
+                JOIN users ON messages.user_id = users.id
+                WHERE messages.room = ?
+                ORDER BY messages.timestamp DESC, messages.id DESC
+                LIMIT ?
+                ''', (room, limit))
+            
+            return self.cursor.fetchall()
+    
+    def get_history(self, room, limit=50, before=None, after=None):
+        """
+        One page of a room's history as (id, username, content, timestamp)
+        rows, oldest first. before and after are (timestamp, id) keys, the
+        page holds the newest rows older than before, the oldest rows newer
+        than after, or the newest rows of the room.
+
+        Keyset pagination: every page is a range read on idx_messages_room
+        plus one primary key lookup per row, however deep it is.
+        """
+        query = '''
+        SELECT messages.id,
+               (SELECT username FROM users WHERE users.id = messages.user_id),
+               messages.content, messages.timestamp
         FROM messages
-        JOIN users ON messages.user_id = users.id
-        ORDER BY messages.timestamp DESC
+        WHERE messages.room = ? {condition}
+        ORDER BY messages.timestamp {order}, messages.id {order}
         LIMIT ?
-        ''', (limit,))
+        '''
+        if after is not None:
+            sql = query.format(condition="AND (messages.timestamp, messages.id) > (?, ?)", order="ASC")
+            params = (room, after[0], after[1], limit)
+        elif before is not None:
+            sql = query.format(condition="AND (messages.timestamp, messages.id) < (?, ?)", order="DESC")
+            params = (room, before[0], before[1], limit)
+        else:
+            sql = query.format(condition="", order="DESC")
+            params = (room, limit)
         
-        return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute(sql, params)
+            rows = self.cursor.fetchall()
+        
+        return rows if after is not None else rows[::-1]
     
-    def save_shared_file(self, username, filename, file_url):
-        """Save a record of a shared file"""
-        self.cursor.execute(
-            "SELECT id FROM users WHERE username = ?",
-            (username,)
+    def search(self, match, room=None, username=None, since=None, until=None, limit=10, offset=0,
+               candidates=1000):
+        """
+        Messages matching an FTS5 query, best match first, as
+        (id, username, content, timestamp, room, snippet) rows.
+        room and username narrow it down, since and until are timestamps
+        in the CURRENT_TIMESTAMP format, since inclusive, until exclusive.
+
+        Only the newest candidates matches that pass the filters are
+        ranked, so a common word costs a bounded amount of work however
+        often it occurs. The index yields the matches newest first, the
+        filters only look at those rows through the primary key.
+        """
+        conditions = ["messages_fts MATCH ?"]
+        params = [match]
+        if room is not None:
+            conditions.append("messages.room = ?")
+            params.append(room)
+        if username is not None:
+            conditions.append("messages.user_id = (SELECT id FROM users WHERE username = ?)")
+            params.append(username)
+        if since is not None:
+            conditions.append("messages.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("messages.timestamp < ?")
+            params.append(until)
+        
+        sql = f'''
+        SELECT id, (SELECT username FROM users WHERE users.id = user_id), content, timestamp, room, snippet
+        FROM (
+            SELECT messages.id, messages.user_id, messages.content, messages.timestamp, messages.room,
+                   snippet(messages_fts, 0, '[b]', '[/b]', '…', 12) AS snippet,
+                   bm25(messages_fts) AS score
+            FROM messages_fts
+            JOIN messages ON messages.id = messages_fts.rowid
+            WHERE {" AND ".join(conditions)}
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
         )
-        user = self.cursor.fetchone()
+        ORDER BY score
+        LIMIT ? OFFSET ?
+        '''
+        params += [max(candidates, offset + limit), limit, offset]
         
-        if not user:
-            # Create user if needed
-            self.register_user(username, hashlib.md5(os.urandom(16).hex().encode()).hexdigest())
-            self.cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            user = self.cursor.fetchone()
+        with self.lock:
+            self.cursor.execute(sql, params)
+            return self.cursor.fetchall()
+    
+    def get_rooms(self):
+        """Rooms that have messages, one seek on idx_messages_room per room"""
+        with self.lock:
+            self.cursor.execute('''
+            WITH RECURSIVE rooms (room) AS (
+                SELECT MIN(room) FROM messages
+                UNION ALL
+                SELECT (SELECT MIN(room) FROM messages WHERE room > rooms.room)
+                FROM rooms WHERE rooms.room IS NOT NULL
+            )
+            SELECT room FROM rooms WHERE room IS NOT NULL
+            ''')
+            return [room for room, in self.cursor.fetchall()]
+    
+    def retention_bound(self, room, max_age_days=None, max_messages=None):
+        """
+        (timestamp, id) key that every expired message of a room sorts
+        before, None when the room is within its limits. Expired messages
+        are always the oldest ones, so they are a prefix of idx_messages_room.
+        """
+        bounds = []
+        if max_age_days is not None:
+            cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - max_age_days * 86400))
+            bounds.append((cutoff, 0))
+        
+        if max_messages is not None:
+            with self.lock:
+                # The newest message past the limit is expired, and everything before it
+                self.cursor.execute('''
+                SELECT timestamp, id FROM messages
+                WHERE room = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT 1 OFFSET ?
+                ''', (room, max_messages))
+                row = self.cursor.fetchone()
+            if row:
+                bounds.append((row[0], row[1] + 1))
+        
+        return max(bounds) if bounds else None
+    
+    def get_expired_messages(self, room, bound, limit=10000):
+        """The oldest messages of a room before bound, as (id, username, content, timestamp, room)"""
+        with self.lock:
+            self.cursor.execute('''
+            SELECT messages.id,
+                   (SELECT username FROM users WHERE users.id = messages.user_id),
+                   messages.content, messages.timestamp, messages.room
+            FROM messages
+            WHERE messages.room = ? AND (messages.timestamp, messages.id) < (?, ?)
+            ORDER BY messages.timestamp, messages.id
+            LIMIT ?
+            ''', (room, bound[0], bound[1], limit))
+            return self.cursor.fetchall()
+    
+    def delete_messages(self, ids):
+        """Delete messages by id in one transaction, the triggers update the counters and the index"""
+        with self.lock:
+            try:
+                self.cursor.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in ids])
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+    
+    def compact(self):
+        """
+        Give the free pages back to the file system, merge the full-text
+        index and refresh the planner statistics. Only a database switched
+        to incremental auto-vacuum by vacuum frees pages. Returns the number
+        of pages freed.
+        """
+        with self.lock:
+            free = 0
+            if self.cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                free = self.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+                self.cursor.execute("PRAGMA incremental_vacuum").fetchall()
             
-        if user:
+            self.cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+            # Sampled ANALYZE, bounded work however large the tables are
+            self.cursor.execute("PRAGMA analysis_limit = 1000")
+            self.cursor.execute("ANALYZE")
+            self.conn.commit()
+        return free
+    
+    def optimize(self, startup=False):
+        """
+        Refresh the planner statistics of the tables whose row counts
+        changed a lot since they were last analyzed, the others are left
+        alone. At startup every table is checked, later only the ones the
+        connection has queried since.
+        """
+        with self.lock:
+            # Sampled ANALYZE, bounded work however large the tables are
+            self.cursor.execute("PRAGMA analysis_limit = 1000")
+            self.cursor.execute("PRAGMA optimize = 0x10002" if startup else "PRAGMA optimize")
+            self.conn.commit()
+    
+    def start_optimizer(self, interval_hours=1):
+        """Run optimize now and then every interval_hours in a background thread"""
+        if self.optimizer_thread is not None:
+            return
+        self.optimizer_thread = threading.Thread(
+            target=self._optimizer, args=(interval_hours * 3600,), name="db-optimize", daemon=True
+        )
+        self.optimizer_thread.start()
+    
+    def _optimizer(self, interval):
+        startup = True
+        while not self.stopped.is_set():
+            try:
+                self.optimize(startup)
+            except sqlite3.Error as e:
+                print(f"Error optimizing the database: {e}")
+            startup = False
+            self.stopped.wait(interval)
+    
+    def vacuum(self):
+        """
+        Switch the database to incremental auto-vacuum and rebuild the file.
+        One full VACUUM, the database is locked until it is done. Returns the
+        number of pages freed.
+        """
+        if self.forward is not None:
+            self.forward("vacuum", (), False)
+            return None
+        
+        with self.lock:
+            free = self.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.cursor.execute("VACUUM")
+        return free
+    
+    def save_shared_file(self, username, filename, file_url, file_code=None):
+        """Save a record of a shared file"""
+        if self.forward is not None:
+            self.forward("save_shared_file", (username, filename, file_url, file_code), False)
+            return True
+        
+        with self.lock:
+            user_id = self.get_user_id(username)
+                
+            if user_id:
+                self.cursor.execute(
+                    "INSERT INTO shared_files (user_id, filename, file_url, file_code) VALUES (?, ?, ?, ?)",
+                    (user_id, filename, file_url, file_code)
+                )
+                self.conn.commit()
+                return True
+            return False
+    
+    def get_shared_file(self, file_code):
+        """(filename, content_hash, size) of a shared file held by the server, or None"""
+        with self.lock:
+            self.cursor.execute('''
+            SELECT filename, content_hash, size FROM shared_files
+            WHERE file_code = ? AND stored = 1
+            ORDER BY id DESC LIMIT 1
+            ''', (file_code,))
+            return self.cursor.fetchone()
+    
+    def get_file_sharer(self, file_code):
+        """Username of the latest user who shared a code, or None"""
+        with self.lock:
+            self.cursor.execute('''
+            SELECT users.username FROM shared_files
+            JOIN users ON users.id = shared_files.user_id
+            WHERE shared_files.file_code = ?
+            ORDER BY shared_files.id DESC LIMIT 1
+            ''', (file_code,))
+            row = self.cursor.fetchone()
+            return row[0] if row else None
+    
+    def store_shared_file(self, username, file_code, content_hash, size):
+        """Mark a user's shares of a code as held by the server under its content hash"""
+        if self.forward is not None:
+            self.forward("store_shared_file", (username, file_code, content_hash, size), False)
+            return True
+        
+        with self.lock:
+            self.cursor.execute('''
+            UPDATE shared_files SET content_hash = ?, size = ?, stored = 1
+            WHERE file_code = ? AND user_id = (SELECT id FROM users WHERE username = ?)
+            ''', (content_hash, size, file_code, username))
+            self.conn.commit()
+            return self.cursor.rowcount > 0
+    
+    def evict_shared_files(self, content_hash):
+        """The server no longer holds the content, every share of it is peer to peer again"""
+        if self.forward is not None:
+            self.forward("evict_shared_files", (content_hash,), False)
+            return True
+        
+        with self.lock:
             self.cursor.execute(
-                "INSERT INTO shared_files (user_id, filename, file_url) VALUES (?, ?, ?)",
-                (user[0], filename, file_url)
+                "UPDATE shared_files SET stored = 0 WHERE content_hash = ?", (content_hash,)
             )
             self.conn.commit()
             return True
-        return False
     
     def ban_user(self, ip_address, reason=None, duration_hours=24):
         """Ban a user by IP address"""
+        if self.forward is not None:
+            self.forward("ban_user", (ip_address, reason, duration_hours), False)
+            return
+        
         banned_until = datetime.now().timestamp() + (duration_hours * 3600)
         
-        self.cursor.execute(
-            "INSERT INTO banned_users (ip_address, reason, banned_until) VALUES (?, ?, ?)",
-            (ip_address, reason, banned_until)
-        )
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute(
+                "INSERT INTO banned_users (ip_address, reason, banned_until) VALUES (?, ?, ?)",
+                (ip_address, reason, banned_until)
+            )
+            self.conn.commit()
+    
+    def unban(self, ip_address):
+        """Lift the active bans of an IP address or range"""
+        if self.forward is not None:
+            self.forward("unban", (ip_address,), False)
+            return
+        
+        now = datetime.now().timestamp()
+        
+        with self.lock:
+            self.cursor.execute(
+                "UPDATE banned_users SET banned_until = ? WHERE ip_address = ? AND banned_until > ?",
+                (now, ip_address, now)
+            )
+            self.conn.commit()
+    
+    def get_active_bans(self):
+        """Get (ip_address, reason, banned_until) for every ban that has not expired"""
+        now = datetime.now().timestamp()
+        
+        with self.lock:
+            self.cursor.execute('''
+            SELECT ip_address, reason, MAX(banned_until)
+            FROM banned_users
+            WHERE banned_until > ?
+            GROUP BY ip_address
+            ''', (now,))
+            return self.cursor.fetchall()
     
     def is_banned(self, ip_address):
         """Check if an IP is banned"""
         current_time = datetime.now().timestamp()
         
-        self.cursor.execute(
-            "SELECT banned_until FROM banned_users WHERE ip_address = ? ORDER BY banned_at DESC LIMIT 1",
-            (ip_address,)
-        )
-        result = self.cursor.fetchone()
+        with self.lock:
+            self.cursor.execute(
+                "SELECT banned_until FROM banned_users WHERE ip_address = ? ORDER BY banned_at DESC LIMIT 1",
+                (ip_address,)
+            )
+            result = self.cursor.fetchone()
         
         if result and result[0] > current_time:
             return True
         return False
     
+    def get_stats(self, top=5):
+        """
+        Database statistics from the counter tables, no table scans.
+        messages_per_minute is a sliding estimate over the last 60 minutes.
+        """
+        now = time.gmtime()
+        current_hour = time.strftime("%Y-%m-%d %H", now)
+        previous_hour = time.strftime("%Y-%m-%d %H", time.gmtime(time.time() - 3600))
+        
+        with self.lock:
+            self.cursor.execute("SELECT name, value FROM stats")
+            stats = dict(self.cursor.fetchall())
+            
+            self.cursor.execute(
+                "SELECT hour, count FROM message_rate WHERE hour IN (?, ?)",
+                (current_hour, previous_hour)
+            )
+            rate = dict(self.cursor.fetchall())
+            
+            # CROSS JOIN keeps user_stats as the outer loop, walking the message_count index
+            self.cursor.execute('''
+            SELECT users.username, user_stats.message_count
+            FROM user_stats
+            CROSS JOIN users ON users.id = user_stats.user_id
+            WHERE users.username != 'System' AND user_stats.message_count > 0
+            ORDER BY user_stats.message_count DESC
+            LIMIT ?
+            ''', (top,))
+            top_posters = self.cursor.fetchall()
+        
+        # Weight the previous hour by the part of it still inside the window
+        elapsed = now.tm_min / 60 + now.tm_sec / 3600
+        last_hour = rate.get(current_hour, 0) + rate.get(previous_hour, 0) * (1 - elapsed)
+        
+        return {
+            "users": stats.get("users", 0),
+            "messages": stats.get("messages", 0),
+            "shared_files": stats.get("shared_files", 0),
+            "messages_last_hour": int(last_hour),
+            "messages_per_minute": last_hour / 60,
+            "top_posters": top_posters,
+            "queued_messages": self.write_queue.qsize(),
+            "dropped_messages": self.dropped_messages,
+        }
+    
     def get_all_users(self):
         """Get all users from the database"""
-        self.cursor.execute("SELECT * FROM users")
-        return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute("SELECT * FROM users")
+            return self.cursor.fetchall()
 
     def get_all_messages(self):
         """Get all messages from the database"""
-        self.cursor.execute("SELECT * FROM messages")
-        return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute("SELECT * FROM messages")
+            return self.cursor.fetchall()
     
     def close(self):
-        """Close the database connection"""
+        """Flush queued messages and close the database connection"""
+        if not self.closed:
+            self.closed = True
+            # Everything queued before the sentinel is written first
+            self.write_queue.put(_STOP)
+            self.writer_thread.join()
+            
+            self.stopped.set()
+            if self.optimizer_thread is not None:
+                self.optimizer_thread.join()
+        
         if self.conn:
             self.conn.close()
\ No newline at end of file
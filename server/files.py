@@ -0,0 +1,249 @@
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+
+# Header of a binary file chunk (DATA frame): file code, chunk index, chunk digest
+CHUNK_HEADER = struct.Struct("!8sI8s")
+
+# Chunks a sender may be ahead of the receiver's acknowledgements,
+# receivers acknowledge every half window
+WINDOW = 16
+
+# Hex digits of the SHA-256 files are stored and verified by
+HASH_LENGTH = 32
+
+# Largest file the store takes, the clients share nothing bigger
+MAX_FILE_SIZE = 10 * 1024 * 1024
+
+
+def chunk_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def parse_ranges(text: str, chunk_count: int):
+    """Chunk indexes of a "0-15,40-159" range list, in order"""
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        first, last = int(first), int(last or first)
+        yield from range(max(first, 0), min(last, chunk_count - 1) + 1)
+
+
+class FileStore:
+    """
+    Content-addressed store of shared files
+
+    A client that shares a file offers it with "/store #code size hash".
+    The server uploads it over the usual file transfer protocol, once per
+    content: an offer of a file it already holds only records the new code.
+    Requests for a stored code are answered from disk by the server, the
+    sharer does not have to be online.
+
+    Files are named by the first HASH_LENGTH hex digits of their SHA-256,
+    the shared_files table maps codes to them. Offers larger than
+    MAX_FILE_SIZE are refused, once the store grows past max_bytes the
+    least recently downloaded files are removed.
+
+    def offer (username: str, code: str, size: int, content_hash: str):
+        "stored" when the content is already here, an Upload to receive it, or None
+
+    def commit (upload: Upload):
+        Verify and keep a finished upload, returns False when it is corrupt
+
+    def download (code: str, chunk_size: int, ranges: str, window: int):
+        A Download of a stored file, or None
+
+    def evict:
+        Remove the least recently used files until the store fits
+
+    def stats:
+        Number and total size of the stored files
+    """
+
+    def __init__(self, db, directory: str = "files", max_bytes: int = 1024 ** 3) -> None:
+        self.db = db
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, content_hash)
+
+    def offer(self, username: str, code: str, size: int, content_hash: str):
+        if len(content_hash) != HASH_LENGTH or not all(c in "0123456789abcdef" for c in content_hash):
+            return None
+        if size > MAX_FILE_SIZE:
+            return None
+
+        if os.path.exists(self.path(content_hash)):
+            # Same content under another code
+            self.db.store_shared_file(username, code, content_hash, size)
+            return "stored"
+        os.makedirs(self.directory, exist_ok=True)
+        return Upload(username, self.directory, code, size, content_hash)
+
+    def commit(self, upload) -> bool:
+        upload.file.close()
+        if not upload.complete() or file_hash(upload.part_path) != upload.content_hash:
+            upload.discard()
+            return False
+
+        # Never changed once stored, a code always gets the bytes it was offered with
+        os.chmod(upload.part_path, 0o444)
+        os.replace(upload.part_path, self.path(upload.content_hash))
+        self.db.store_shared_file(upload.username, upload.code, upload.content_hash, upload.size)
+        self.evict()
+        return True
+
+    def download(self, code: str, chunk_size: int, ranges: str = None, window: int = WINDOW):
+        row = self.db.get_shared_file(code)
+        if row is None:
+            return None
+        filename, content_hash, size = row
+        try:
+            download = Download(code, filename, self.path(content_hash), size, content_hash, chunk_size, ranges, window)
+        except FileNotFoundError:
+            # Evicted by another worker
+            return None
+        # Modification time is the last use, eviction goes by it
+        os.utime(download.path)
+        return download
+
+    def evict(self):
+        files = []
+        for name in self.names():
+            if len(name) != HASH_LENGTH:
+                # Uploads in progress
+                continue
+            try:
+                stat = os.stat(self.path(name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self.db.evict_shared_files(name)
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def names(self) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return os.listdir(self.directory)
+
+    def stats(self) -> dict:
+        files = [name for name in self.names() if len(name) == HASH_LENGTH]
+        return {"files": len(files), "bytes": sum(os.path.getsize(self.path(name)) for name in files)}
+
+
+class Upload:
+    """A file the server receives for the store, written at chunk offsets to a temporary file"""
+
+    def __init__(self, username: str, directory: str, code: str, size: int, content_hash: str) -> None:
+        self.username = username
+        self.code = code
+        self.size = size
+        self.content_hash = content_hash
+        self.chunk_size = 0
+        self.chunk_count = 0
+        self.received = set()
+        # Arrivals since the sender started, they pace it
+        self.arrived = 0
+        # Chunks come in on the data streams of the client too
+        self.lock = threading.Lock()
+        fd, self.part_path = tempfile.mkstemp(dir=directory, suffix=".part")
+        self.file = os.fdopen(fd, "wb")
+        self.file.truncate(size)
+
+    def start(self, chunk_count: int, chunk_size: int):
+        self.chunk_count = chunk_count
+        self.chunk_size = chunk_size
+        self.arrived = 0
+
+    def write(self, index: int, digest: bytes, data: bytes) -> int:
+        """Arrivals so far, this one included"""
+        with self.lock:
+            self._write(index, digest, data)
+            return self.arrived
+
+    def _write(self, index: int, digest: bytes, data: bytes):
+        self.arrived += 1
+        if not self.chunk_size or not 0 <= index < self.chunk_count or index in self.received:
+            return
+        if chunk_digest(data) != digest or index * self.chunk_size + len(data) > self.size:
+            return
+        self.file.seek(index * self.chunk_size)
+        self.file.write(data)
+        self.received.add(index)
+
+    def complete(self) -> bool:
+        # chunk_size is set by the start message
+        return self.chunk_size > 0 and len(self.received) == self.chunk_count
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+class Download:
+    """
+    A stored file on its way to one client, read from disk as the client
+    acknowledges, never more than window chunks ahead
+    """
+
+    def __init__(self, code: str, filename: str, path: str, size: int, content_hash: str,
+                 chunk_size: int, ranges: str = None, window: int = WINDOW) -> None:
+        self.code = code
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.content_hash = content_hash
+        self.chunk_size = chunk_size
+        self.chunk_count = (size + chunk_size - 1) // chunk_size
+        indexes = list(parse_ranges(ranges, self.chunk_count)) if ranges else range(self.chunk_count)
+        # Chunks this download sends
+        self.count = len(indexes)
+        self.indexes = iter(indexes)
+        # How many of them go over data streams, set when the client has some
+        self.striped = 0
+        self.file = open(path, "rb")
+        self.window = window
+        self.sent = 0
+        self.acked = 0
+        self.done = False
+        # Set once the end message went out
+        self.ended = False
+
+    def ack(self, received: int):
+        self.acked = max(self.acked, received)
+
+    def chunks(self, limit: int = None):
+        """Payloads of the chunks the window allows now, up to limit sent, done is set after the last one"""
+        while not self.done and self.sent - self.acked < self.window and (limit is None or self.sent < limit):
+            index = next(self.indexes, None)
+            if index is None:
+                self.close()
+                break
+            self.file.seek(index * self.chunk_size)
+            data = self.file.read(self.chunk_size)
+            self.sent += 1
+            yield CHUNK_HEADER.pack(self.code.encode(), index, chunk_digest(data)) + data
+
+    def close(self):
+        self.done = True
+        self.file.close()
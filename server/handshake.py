@@ -0,0 +1,223 @@
+"""
+Login handshake, server side.
+
+Every handshake message is a CONTROL frame holding a JSON object with a
+"type". Nothing waits for the other side unless it needs its data, so a
+login takes one round trip after the TCP connect:
+
+    server                                  client
+    hello {protected, buffer, ciphers,
+           public_key, nonce}    ------->
+                                 <-------   login {password, nickname}
+                                 <-------   cipher {cipher, key}
+    login {status}               ------->
+    keys {public_key,
+          private_key} (RSA only) ------>
+    welcome (encrypted CHAT frame) ----->
+
+The client sends login right after connecting and cipher as soon as the
+hello arrived, the server handles them in any order. The class does no
+I/O, Chat.run and AsyncChat.run feed it frames and send what it returns.
+
+The server private key never leaves the server. It only unwraps session
+keys, a client that can only do RSA gets a keypair of its own instead,
+handed to provide_keys by the caller from the key pool.
+
+A logged in client opens data streams for its file transfers with
+attach {nickname, proof} instead of login and cipher. The proof is an
+HMAC of the hello nonce with the session key of its login, the stream is
+encrypted with a key derived the same way.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+import rsa
+
+from framing import CONTROL
+
+# States
+LOGIN = "login"    # Waiting for a valid login
+KEYS = "keys"      # RSA-only client, waiting for provide_keys
+DONE = "done"      # Logged in, cipher agreed
+FAILED = "failed"  # Rejected, the connection must be closed
+
+
+class HandshakeError(ValueError):
+    """Raised when the client sends something that is not a handshake message"""
+
+
+def attach_proof(session_key: bytes, nonce: bytes) -> str:
+    return hmac.new(session_key, b"attach" + nonce, hashlib.sha256).hexdigest()
+
+
+def stream_key(session_key: bytes, nonce: bytes) -> bytes:
+    return hmac.new(session_key, b"stream" + nonce, hashlib.sha256).digest()
+
+
+class Handshake:
+    """
+    Args: public_key, private_key, claim (callable), password, max_attempts,
+          buffer, ciphers, attach (callable)
+
+    claim (nickname) registers the nickname and returns False when it is taken,
+    attach (nickname) returns the session key of a logged in user or None
+
+    def start:
+        Frames to send as soon as the client connected
+
+    def receive (frame_type: int, payload: bytes):
+        Handle a client frame, returns the frames to send back
+
+    def provide_keys (keypair):
+        Session keypair for an RSA-only client, returns the frames to send
+
+    state:
+        LOGIN until the client is logged in (DONE) or rejected (FAILED),
+        KEYS in between for RSA-only clients
+
+    attached:
+        True when the connection is a data stream of a logged in user
+    """
+
+    def __init__(self, public_key, private_key, claim, password=None, max_attempts=3,
+                 buffer=1024, ciphers=("rsa",), attach=None) -> None:
+        self.public_key = public_key
+        self.private_key = private_key
+        self.claim = claim
+        self.attach = attach
+        self.nonce = os.urandom(16)
+        self.password_hash = hashlib.md5(password.encode()).hexdigest() if password else None
+        self.max_attempts = max_attempts
+        self.buffer = buffer
+        self.ciphers = list(ciphers)
+
+        self.state = LOGIN
+        self.attempts = 0
+        self.nickname = None
+        self.logged_in = False
+        self.attached = False
+        # The cipher message may arrive before the login is accepted, keep it
+        self.cipher_message = None
+
+        # Results
+        self.cipher = None
+        self.session_key = None
+        self.session_keypair = None
+        self.reason = None
+
+    def start(self):
+        return [self._message(
+            "hello",
+            protected=self.password_hash is not None,
+            buffer=self.buffer,
+            ciphers=self.ciphers,
+            public_key=rsa.PublicKey.save_pkcs1(self.public_key).decode(),
+            nonce=self.nonce.hex(),
+        )]
+
+    def receive(self, frame_type: int, payload: bytes):
+        if self.state != LOGIN:
+            raise HandshakeError("Handshake already finished")
+        if frame_type != CONTROL:
+            raise HandshakeError("Expected a control frame")
+
+        try:
+            message = json.loads(payload)
+            kind = message["type"]
+        except (ValueError, TypeError, KeyError):
+            raise HandshakeError("Malformed handshake message")
+
+        if kind == "login" and not self.logged_in:
+            return self._login(message)
+        if kind == "attach" and not self.logged_in and self.cipher_message is None:
+            return self._attach(message)
+        if kind == "cipher" and self.cipher_message is None:
+            self.cipher_message = message
+            return self._finish()
+        raise HandshakeError(f"Unexpected handshake message: {kind}")
+
+    def _login(self, message):
+        if self.password_hash is not None and message.get("password") != self.password_hash:
+            self.attempts += 1
+            if self.attempts >= self.max_attempts:
+                return self._fail("password", "denied")
+            return [self._message("login", status="retry")]
+
+        nickname = message.get("nickname")
+        if not isinstance(nickname, str) or not nickname.strip():
+            return self._fail("nickname", "invalid")
+
+        if not self.claim(nickname):
+            return self._fail("nickname taken", "taken")
+
+        self.nickname = nickname
+        self.logged_in = True
+        return [self._message("login", status="accepted")] + self._finish()
+
+    def _attach(self, message):
+        nickname = message.get("nickname")
+        session_key = self.attach(nickname) if self.attach is not None and isinstance(nickname, str) else None
+        proof = message.get("proof")
+        if session_key is None or not isinstance(proof, str):
+            return self._fail("attach", "denied")
+        if not hmac.compare_digest(attach_proof(session_key, self.nonce), proof):
+            return self._fail("attach", "denied")
+
+        self.nickname = nickname
+        self.attached = True
+        # Only sessions with a session key can attach, that cipher is offered first
+        self.cipher = self.ciphers[0]
+        self.session_key = stream_key(session_key, self.nonce)
+        self.state = DONE
+        return [self._message("login", status="accepted")]
+
+    def _finish(self):
+        # Both the login and the cipher choice are needed, in any order
+        if not self.logged_in or self.cipher_message is None:
+            return []
+
+        choice = self.cipher_message.get("cipher")
+        if choice not in self.ciphers:
+            return self._fail("cipher", "cipher")
+
+        if choice == "rsa":
+            # Only logged in clients get key material
+            self.cipher = "rsa"
+            self.state = KEYS
+            return []
+
+        try:
+            # The client sent its session key encrypted with our public key
+            self.session_key = rsa.decrypt(base64.b64decode(self.cipher_message["key"]), self.private_key)
+        except (KeyError, ValueError, TypeError, rsa.pkcs1.DecryptionError):
+            return self._fail("session key", "cipher")
+
+        self.cipher = choice
+        self.state = DONE
+        return []
+
+    def provide_keys(self, keypair):
+        if self.state != KEYS:
+            raise HandshakeError("No keys expected")
+
+        public_key, private_key = keypair
+        self.session_keypair = keypair
+        self.state = DONE
+        return [self._message(
+            "keys",
+            public_key=rsa.PublicKey.save_pkcs1(public_key).decode(),
+            private_key=rsa.PrivateKey.save_pkcs1(private_key).decode(),
+        )]
+
+    def _fail(self, reason: str, status: str):
+        self.state = FAILED
+        self.reason = reason
+        return [self._message("login", status=status)]
+
+    def _message(self, kind: str, **fields):
+        fields["type"] = kind
+        return json.dumps(fields).encode(), CONTROL
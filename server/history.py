@@ -0,0 +1,161 @@
+import base64
+import json
+import re
+
+
+class HistoryError(ValueError):
+    """Raised for a malformed history request or cursor"""
+
+
+class History:
+    """
+    Scrollback of a room, one page at a time
+
+    Pages are keyset paginated on (timestamp, id): a cursor names the row
+    a page ends at, the next page starts right after it, so deep pages
+    cost the same as the first one and new messages never shift them.
+
+    A page goes to the client as one or more HISTORY frames, each an
+    encrypted JSON object of at most max_bytes:
+
+        {"room": str, "messages": [[timestamp, username, content], ...],
+         "last": bool, "before": cursor, "after": cursor}
+
+    before and after are only in the last frame of a page. before is null
+    when there is nothing older, after is null on the newest page.
+
+    def parse (args: list):
+        Read "[before|after <cursor>] [limit]", returns (before, after, limit)
+
+    def page (room: str, before, after, limit: int):
+        Rows and cursors of one page
+
+    def frames (page: dict, max_bytes: int):
+        JSON payloads of a page, each at most max_bytes long
+    """
+
+    # Format of CURRENT_TIMESTAMP and Database.save_message
+    TIMESTAMP = re.compile(r"(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})")
+
+    def __init__(self, db, page_size: int = 50, max_page_size: int = 500) -> None:
+        self.db = db
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+    def encode_cursor(timestamp: str, message_id: int) -> str:
+        match = History.TIMESTAMP.fullmatch(timestamp)
+        if match:
+            # Short enough to fit next to a row in an RSA block
+            return f"{''.join(match.groups())}.{message_id}"
+        token = f"{timestamp}|{message_id}".encode()
+        return "~" + base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+    def decode_cursor(cursor: str):
+        try:
+            if cursor.startswith("~"):
+                token = base64.urlsafe_b64decode(cursor[1:] + "=" * (-len(cursor[1:]) % 4)).decode()
+                timestamp, message_id = token.rsplit("|", 1)
+                return timestamp, int(message_id)
+
+            digits, message_id = cursor.split(".")
+            if len(digits) != 14 or not digits.isdigit():
+                raise ValueError(cursor)
+            timestamp = f"{digits[:4]}-{digits[4:6]}-{digits[6:8]} {digits[8:10]}:{digits[10:12]}:{digits[12:]}"
+            return timestamp, int(message_id)
+        except ValueError:
+            # Covers bad base64, bad UTF-8 and a missing or bad id
+            raise HistoryError(f"Invalid cursor: {cursor}")
+
+    def parse(self, args: list):
+        before = after = None
+        limit = self.page_size
+        args = list(args)
+
+        if len(args) >= 2 and args[0] in ("before", "after"):
+            key = History.decode_cursor(args[1])
+            if args[0] == "before":
+                before = key
+            else:
+                after = key
+            args = args[2:]
+
+        if args:
+            try:
+                limit = int(args[0])
+            except ValueError:
+                raise HistoryError(f"Invalid page size: {args[0]}")
+            if limit < 1:
+                raise HistoryError(f"Invalid page size: {args[0]}")
+
+        return before, after, min(limit, self.max_page_size)
+
+    def page(self, room: str, before=None, after=None, limit: int = None) -> dict:
+        limit = min(limit or self.page_size, self.max_page_size)
+
+        # One row more than asked tells whether there is another page
+        rows = self.db.get_history(room, limit + 1, before=before, after=after)
+        more = len(rows) > limit
+        if more:
+            # The extra row is the one furthest from the cursor
+            rows = rows[:limit] if after is not None else rows[1:]
+
+        older = more if after is None else True
+        newer = more if after is not None else before is not None
+
+        return {
+            "room": room,
+            "messages": [[timestamp, username, content] for _, username, content, timestamp in rows],
+            "before": History.encode_cursor(rows[0][3], rows[0][0]) if rows and older else None,
+            "after": History.encode_cursor(rows[-1][3], rows[-1][0]) if rows and newer else None,
+        }
+
+    def frames(self, page: dict, max_bytes: int) -> list:
+        cursors = {"before": page["before"], "after": page["after"]}
+        room = page["room"]
+
+        def payload(rows, last):
+            body = {"room": room, "messages": rows, "last": last}
+            if last:
+                body.update(cursors)
+            return History.dump(body)
+
+        # Size of a frame without rows, every row adds its own length and a comma
+        empty = len(payload([], False))
+        frames = []
+        rows = []
+        size = empty
+
+        for row in page["messages"]:
+            row, row_size = History.fit(row, max_bytes - empty)
+            if row is None:
+                continue
+            if rows and size + row_size + 1 > max_bytes:
+                frames.append(payload(rows, False))
+                rows = []
+                size = empty
+            rows.append(row)
+            size += row_size + (1 if len(rows) > 1 else 0)
+
+        last = payload(rows, True)
+        if len(last) > max_bytes:
+            # No room for the cursors next to the rows
+            frames.append(payload(rows, False))
+            last = payload([], True)
+        frames.append(last)
+        return frames
+
+    def fit(row: list, max_bytes: int):
+        """Shorten the content until the row fits, returns (row, size) or (None, 0)"""
+        timestamp, username, content = row
+        size = len(History.dump(row))
+        while size > max_bytes and content:
+            # Escapes make the JSON longer than the text, cut at least the excess
+            content = content[:max(0, len(content) - (size - max_bytes) - 1)]
+            row = [timestamp, username, content + "…"]
+            size = len(History.dump(row))
+        if size > max_bytes:
+            return None, 0
+        return row, size
+
+    def dump(value) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode()
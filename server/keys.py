@@ -0,0 +1,249 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+import rsa
+
+
+def generate(bits: int):
+    """Runs in a worker process"""
+    return rsa.newkeys(bits)
+
+
+class KeyPool:
+    """
+    Fresh RSA keypairs generated ahead of time in worker processes
+
+    rsa.newkeys is pure Python and slow. Once the ready keys and the ones
+    being generated drop below low_water, jobs are queued on a process pool
+    until they reach high_water again, so bursts are served from the pool
+    while every core refills it.
+
+    def start:
+        Start the worker processes
+
+    def request:
+        Future resolved with a (public_key, private_key) pair, right away
+        when one is ready
+
+    def get (block: bool, timeout: float):
+        Take a keypair, None if none is ready in time
+
+    def stats:
+        Ready, pending and served counters
+    """
+
+    def __init__(self, bits: int, low_water: int = 2, high_water: int = 8, workers: int = None) -> None:
+        self.bits = bits
+        self.low_water = low_water
+        self.high_water = max(high_water, low_water)
+        self.workers = workers or os.cpu_count() or 1
+        # Reentrant, a job that is already done runs its callback inside submit
+        self.lock = threading.RLock()
+        self.executor = None
+
+        self.keys = deque()
+        # Requests that arrived while the pool was empty
+        self.waiters = deque()
+        self.pending = 0
+        self.generated = 0
+        self.served = 0
+        self.waited = 0
+
+    def start(self):
+        if "fork" in multiprocessing.get_all_start_methods():
+            # fork, spawn would re-run the server module in every worker
+            context = multiprocessing.get_context("fork")
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+        else:
+            # Still keeps generation off the login path, just on one core
+            self.executor = ThreadPoolExecutor(1, thread_name_prefix="key-pool")
+        with self.lock:
+            self._refill()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def request(self) -> Future:
+        future = Future()
+        with self.lock:
+            if self.keys:
+                future.set_result(self.keys.popleft())
+                self.served += 1
+            else:
+                self.waiters.append(future)
+                self.waited += 1
+            self._refill()
+        return future
+
+    def get(self, block: bool = True, timeout: float = None):
+        if self.executor is None:
+            # Not started, nothing is generating
+            return generate(self.bits) if block else None
+
+        if not block:
+            with self.lock:
+                if not self.keys:
+                    return None
+                self.served += 1
+                keypair = self.keys.popleft()
+                self._refill()
+                return keypair
+
+        future = self.request()
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            with self.lock:
+                if future in self.waiters:
+                    self.waiters.remove(future)
+                    return None
+            # Resolved while we gave up, do not lose the key
+            return future.result()
+
+    def ready(self) -> int:
+        return len(self.keys)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "ready": len(self.keys),
+                "pending": self.pending,
+                "generated": self.generated,
+                "served": self.served,
+                "waited": self.waited,
+            }
+
+    def _refill(self):
+        """Queue generation jobs, caller holds the lock"""
+        if self.executor is None:
+            return
+
+        supply = len(self.keys) + self.pending - len(self.waiters)
+        if supply >= self.low_water and self.pending >= len(self.waiters):
+            return
+
+        while len(self.keys) + self.pending - len(self.waiters) < self.high_water:
+            try:
+                job = self.executor.submit(generate, self.bits)
+            except RuntimeError:
+                # Shut down
+                return
+            self.pending += 1
+            job.add_done_callback(self._generated)
+
+    def _generated(self, job):
+        try:
+            keypair = job.result()
+        except BaseException:
+            # Cancelled on shutdown or a broken worker
+            with self.lock:
+                self.pending -= 1
+            return
+
+        with self.lock:
+            self.pending -= 1
+            self.generated += 1
+            # Hand it to a waiting login first
+            while self.waiters:
+                waiter = self.waiters.popleft()
+                if waiter.set_running_or_notify_cancel():
+                    waiter.set_result(keypair)
+                    self.served += 1
+                    break
+            else:
+                self.keys.append(keypair)
+            self._refill()
+
+
+class KeyStore:
+    """
+    The server keypair, persisted to a key file only the owner can read
+
+    def load:
+        Read the key file, or create it. Returns True when it was loaded
+
+    def current:
+        (public_key, private_key) for new connections, rotates when due
+
+    def rotate:
+        Replace the keypair with one from the pool and save it
+    """
+
+    def __init__(self, path: str, bits: int, rotate_hours: float = 0, pool: KeyPool = None) -> None:
+        self.path = path
+        self.bits = bits
+        self.rotate_seconds = rotate_hours * 3600
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.keypair = None
+        self.created = 0.0
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                private_key = rsa.PrivateKey.load_pkcs1(f.read())
+            # A key of another size means the buffer setting changed
+            if private_key.n.bit_length() == self.bits:
+                self._use(private_key, os.path.getmtime(self.path))
+                return True
+        except (OSError, ValueError):
+            pass
+
+        public_key, private_key = rsa.newkeys(self.bits)
+        self._save(private_key)
+        self._use(private_key, time.time())
+        return False
+
+    def current(self):
+        if self.rotation_due():
+            with self.lock:
+                # Another connection may have rotated while we waited
+                if self.rotation_due():
+                    # Never block a login on key generation, keep the old key until one is ready
+                    self._rotate(block=False)
+        return self.keypair
+
+    def rotation_due(self) -> bool:
+        return bool(self.rotate_seconds) and time.time() - self.created >= self.rotate_seconds
+
+    def rotate(self, block: bool = True) -> bool:
+        with self.lock:
+            return self._rotate(block)
+
+    def _rotate(self, block: bool) -> bool:
+        if self.pool is not None:
+            keypair = self.pool.get(block)
+        else:
+            keypair = rsa.newkeys(self.bits) if block else None
+        if keypair is None:
+            return False
+
+        public_key, private_key = keypair
+        self._save(private_key)
+        self._use(private_key, time.time())
+        return True
+
+    def _use(self, private_key, created: float):
+        # Connections read the keypair without the lock, swap it in one assignment
+        self.keypair = (rsa.PublicKey(private_key.n, private_key.e), private_key)
+        self.created = created
+
+    def _save(self, private_key):
+        # Write a new file with owner-only permissions, then swap it in,
+        # one temporary file per process as server workers rotate on their own
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        if os.path.exists(temp_path):
+            # A leftover could have looser permissions, O_CREAT keeps those
+            os.unlink(temp_path)
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(rsa.PrivateKey.save_pkcs1(private_key))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
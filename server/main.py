@@ -1,17 +1,40 @@
 import socket
 import rsa
-import zlib
 import time
 import json
-import hashlib
 import os
+import asyncio
+import itertools
+import signal
+import re
+import base64
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from threading import Thread
+from threading import Thread, Lock
 from rich import print
 
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+except ImportError:
+    # Without cryptography only the RSA-only mode is offered
+    ChaCha20Poly1305 = None
+
 # Import the database
-from database import Database
+from database import Database, DEFAULT_ROOM
+from bans import BanIndex
+from framing import FrameSocket, FrameDecoder, FrameError, encode_frame, CONTROL, CHAT, FILE, COMMAND, HISTORY, DATA
+from outbox import Outbox, QueuedSocket
+from sessions import SessionRegistry
+from handshake import Handshake, HandshakeError, DONE, KEYS, LOGIN
+from keys import KeyPool, KeyStore
+from cryptopool import CryptoPool
+from bus import Hub, BusClient, OWNER
+from history import History, HistoryError
+from search import Search, SearchError
+from retention import Retention
+from files import FileStore, CHUNK_HEADER, WINDOW
 
 # Read config file
 config_file = "config.json"
@@ -19,12 +42,28 @@ with open(config_file, "r") as f:
     config_json = json.load(f)
   
 # Vars
-clients = []
-nicknames = []
-client_ips = {}  # To store client IP addresses
+# Logged in clients by connection, nickname and IP address
+sessions = SessionRegistry()
+
+# Database initialization, every worker process opens its own connection
+database_file: str = config_json.get("database_file", "chat_database.db")
+database_options = dict(
+    flush_interval=config_json.get("db_flush_interval", 0.5),
+    batch_size=config_json.get("db_batch_size", 500),
+    queue_size=config_json.get("db_queue_size", 10000),
+    user_cache_size=config_json.get("user_cache_size", 10000),
+    journal_mode=config_json.get("db_journal_mode", "wal"),
+    synchronous=config_json.get("db_synchronous", "normal"),
+    cache_size=config_json.get("db_cache_size", -65536),
+    mmap_size=config_json.get("db_mmap_size", 268435456),
+)
+# Worker 0 refreshes the planner statistics at startup and every
+# db_optimize_interval_hours, with or without a retention policy
+db_optimize_interval_hours: float = config_json.get("db_optimize_interval_hours", 1)
+db = Database(database_file, **database_options)
 
-# Database initialization
-db = Database(config_json.get("database_file", "chat_database.db"))
+# Bans are checked in memory, changes are written through to the database
+bans = BanIndex(db)
  
 """
 ip : The IP address where the server will start listening for connections
@@ -45,13 +84,126 @@ save_chat_history = config_json.get("save_chat_history", True)
 max_login_attempts = config_json.get("max_login_attempts", 3)
 admin_commands_enabled = config_json.get("admin_commands_enabled", True)
 
-# Create socket
-server = socket.socket()
+# Messages only reach the members of the sender's room, everyone starts
+# in default_room and moves with /join <room>, /part goes back
+default_room: str = config_json.get("default_room", DEFAULT_ROOM)
+
+# Scrollback is sent in pages of history_page_size messages (a client
+# may ask for up to history_max_page), split into HISTORY frames of at
+# most history_frame_bytes
+history = History(
+    db,
+    page_size=config_json.get("history_page_size", 50),
+    max_page_size=config_json.get("history_max_page", 500),
+)
+history_frame_bytes: int = config_json.get("history_frame_bytes", 16384)
+
+# Messages older than retention_days or beyond the newest retention_messages
+# of their room (retention_rooms overrides both per room, null keeps them
+# forever) are moved to compressed segments in archive_dir. Worker 0 does
+# it every maintenance_interval_hours and vacuums the database after, a
+# database only gives pages back once /admin vacuum switched it over
+retention = Retention(
+    db,
+    archive_dir=config_json.get("archive_dir", "archive"),
+    max_age_days=config_json.get("retention_days"),
+    max_messages=config_json.get("retention_messages"),
+    rooms=config_json.get("retention_rooms"),
+    batch_size=config_json.get("retention_batch_size", 10000),
+)
+maintenance_interval_hours: float = config_json.get("maintenance_interval_hours", 24)
+
+# /search pages through the full-text index search_page_size results at a time,
+# ranking the newest search_candidates matches, archive:yes searches the archive segments
+search = Search(
+    db,
+    page_size=config_json.get("search_page_size", 10),
+    archive=retention,
+    max_candidates=config_json.get("search_candidates", 1000),
+)
+
+# Shared files are uploaded to file_store_dir (null, the default: clients
+# share peer to peer only) and downloaded from there while the sharer is offline. The same
+# content is kept once, beyond file_store_bytes the least recently
+# downloaded files are removed
+file_store_dir = config_json.get("file_store_dir")
+file_store = None
+if file_store_dir:
+    file_store = FileStore(db, file_store_dir, config_json.get("file_store_bytes", 1073741824))
+
+# Offer a per-connection symmetric session key negotiated over RSA,
+# clients without support keep using RSA for every message
+session_encryption: bool = config_json.get("session_encryption", True)
+
+# "threaded" runs one thread per connection, "asyncio" serves every
+# connection from a single event loop
+server_mode: str = config_json.get("server_mode", "threaded")
+
+# Every client gets a bounded outbound queue, outbox_policy says what
+# happens when a slow client lets it fill up: "drop_oldest", "disconnect"
+# or "spill" to a temporary file of at most outbox_spill_limit bytes
+outbox_max_frames: int = config_json.get("outbox_max_frames", 1024)
+outbox_policy: str = config_json.get("outbox_policy", "drop_oldest")
+outbox_spill_dir = config_json.get("outbox_spill_dir")
+outbox_spill_limit: int = config_json.get("outbox_spill_limit", 67108864)
+
+# workers > 1 starts a supervisor that forks that many server processes,
+# all accepting on the same port (SO_REUSEPORT). They share broadcasts,
+# nicknames, bans and admin changes over a Unix socket at bus_path and
+# worker 0 does every database write
+worker_count: int = config_json.get("workers", 1)
+bus_path: str = config_json.get("bus_path", "chat_bus.sock")
+if worker_count > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+    print("[[red]![/red]] Multiple workers need fork and SO_REUSEPORT, running a single process")
+    worker_count = 1
+
+# Set in every worker process
+worker_index: int = OWNER
+bus = None
+# Users logged in on the other workers, nickname -> IP address and nickname -> room
+remote_users = {}
+remote_rooms = {}
+
+# The process pools below are per worker, split the cores between them
+cores_per_worker = max(1, (os.cpu_count() or 1) // worker_count)
 
-# Start listing
-server.bind((ip, port))
-print(f"[[green]![/green]] Listing: {ip}:{port}")
-server.listen(32)
+# Keypairs for RSA-only sessions and key rotation, generated ahead by
+# key_pool_workers processes (null: one per core, shared out between
+# workers) and topped up to key_pool_high_water whenever fewer than
+# key_pool_low_water are left
+key_pool = KeyPool(
+    buffer,
+    low_water=config_json.get("key_pool_low_water", 4),
+    high_water=config_json.get("key_pool_high_water", 16),
+    workers=config_json.get("key_pool_workers") or cores_per_worker,
+)
+
+# Messages of RSA-only clients are decrypted by crypto_workers processes
+# (null: one per core, shared out between workers, 0: in the connection
+# thread), batched by up to crypto_batch_size messages
+crypto_workers = config_json.get("crypto_workers")
+if crypto_workers is None:
+    # With a single core the pool only adds inter-process overhead
+    crypto_workers = cores_per_worker if cores_per_worker > 1 else 0
+crypto_pool = None
+if crypto_workers and CryptoPool.available():
+    crypto_pool = CryptoPool(crypto_workers, config_json.get("crypto_batch_size", 64))
+
+# The server keypair is kept in key_file and reused across restarts,
+# key_rotation_hours > 0 replaces it on a schedule with a key from the pool
+keys = KeyStore(
+    config_json.get("key_file", "server_key.pem"),
+    buffer,
+    rotate_hours=config_json.get("key_rotation_hours", 0),
+    pool=key_pool,
+)
+
+# Pending connections the kernel keeps while the accept loop catches up,
+# large enough for every client reconnecting at once after a restart
+listen_backlog: int = config_json.get("listen_backlog", 1024)
+
+# Listening socket, bound by Main.run
+server = None
 
 
 class API:
@@ -59,8 +211,8 @@ class API:
     def create_keys (buffer: int):
         Generate an RSA key
 
-    def send_buffer (socket, buffer: int):
-        Send the buffer to the client
+    def create_outbox:
+        Outbound queue for a new connection
 
     class Chat:
         arg: private_key, public_key
@@ -68,7 +220,7 @@ class API:
         def send (socket, message: str):
             Send encrypted message
 
-        def recv (socketm, message: str):
+        def recv (socket):
             Receives a message and decrypt it
 
     class RSA:
@@ -77,16 +229,69 @@ class API:
         def encryption (message: str):
             Encrypt message
 
-        def decrypt (message: bytes):
+        def decrypt (message: bytes, frame_type: int):
             Decrypt message
+
+        def send (socket, message: str, frame_type: int):
+            Encrypt a message and send it on a connection, chat messages
+            longer than one block end in "…", others raise OverflowError
+
+    class Session:
+        arg: key, prefix
+        Same interface as RSA, with an AEAD cipher and a symmetric key.
+        The frame type is authenticated with the message and a nonce
+        counter that does not exceed the last one is refused
+
+    def cipher_offer:
+        Ciphers the server offers to the client
+
+    def create_cipher (handshake: Handshake):
+        Build the cipher the client chose during the handshake
+
+    def create_handshake (chat: Chat):
+        Login state machine for a new connection
+
+    def room_name (name: str):
+        Normalized room name, None when it is not valid
     """
 
+    SESSION_CIPHER = "chacha20poly1305"
+    ROOM_NAME = re.compile(r"[a-z0-9_-]{1,32}")
+
     def create_keys(buffer: int):
         public_key, private_key = rsa.newkeys(buffer)
         return public_key, private_key
 
-    def send_buffer(s, buffer: int):
-        s.send(str(buffer).encode())
+    def create_outbox():
+        return Outbox(outbox_max_frames, outbox_policy, outbox_spill_dir, outbox_spill_limit)
+
+    def cipher_offer():
+        ciphers = ["rsa"]
+        if session_encryption and ChaCha20Poly1305 is not None:
+            ciphers.insert(0, API.SESSION_CIPHER)
+        return ciphers
+
+    def create_cipher(handshake):
+        if handshake.cipher == API.SESSION_CIPHER:
+            return API.Session(handshake.session_key, API.Session.SERVER)
+        # RSA-only clients have a keypair of their own
+        return API.RSA(*handshake.session_keypair)
+
+    def create_handshake(chat):
+        return Handshake(
+            chat.public_key,
+            chat.private_key,
+            chat.register,
+            password=password if protected_by_password else None,
+            max_attempts=max_login_attempts,
+            buffer=buffer,
+            ciphers=API.cipher_offer(),
+            attach=chat.attach,
+        )
+
+    def room_name(name: str):
+        name = name.lstrip("#").lower()
+        return name if API.ROOM_NAME.fullmatch(name) else None
 
     class Chat:
         def __init__(self, priv_key, pub_key) -> None:
@@ -94,57 +299,183 @@ class API:
             self.pub_key = pub_key
 
         def send(self, s, msg: str):
-            s.send(rsa.encrypt(msg.encode(), self.pub_key))
+            s.send_frame(rsa.encrypt(msg.encode(), self.pub_key))
 
-        def recv(self, s, buffer: int):
-            msg = s.recv(buffer)
+        def recv(self, s):
+            frame_type, msg = s.recv_frame()
             return rsa.decrypt(msg, self.priv_key)
 
-    class Send_keys:
-        def __init__(self, pub_key, priv_key, client) -> None:
-            self.client = client
-            self.pub_key = pub_key
-            self.priv_key = priv_key
-
-        def private(self):
-            private_key_exported = rsa.PrivateKey.save_pkcs1(self.priv_key)
-            # compressing
-            private_key_exported = zlib.compress(private_key_exported, 4)
-            self.client.send(private_key_exported)
-
-        def public(self):
-            public_key_exported = rsa.PublicKey.save_pkcs1(self.pub_key)
-            # compressing
-            public_key_exported = zlib.compress(public_key_exported, 4)
-            self.client.send(public_key_exported)
-
     class RSA:
+        # Messages longer than one block over all RSA-only clients, chat is cut short
+        truncated = 0
+        dropped = 0
+
         def __init__(self, pub_key, priv_key) -> None:
             self.pub_key = pub_key
             self.priv_key = priv_key
 
-        def encrypt(self, msg: str):
-            return rsa.encrypt(msg.encode(), self.pub_key)
+        def encrypt(self, msg, frame_type: int = CHAT):
+            if isinstance(msg, str):
+                msg = msg.encode()
+            return rsa.encrypt(msg, self.pub_key)
 
-        def decrypt(self, msg: bytes):
+        def decrypt(self, msg: bytes, frame_type: int = CHAT):
             return rsa.decrypt(msg, self.priv_key)
 
+        def send(self, client, msg, frame_type: int = CHAT):
+            try:
+                payload = self.encrypt(msg)
+            except OverflowError:
+                if frame_type != CHAT or not isinstance(msg, str):
+                    # File messages and chunks are of no use cut short
+                    API.RSA.dropped += 1
+                    raise
+                API.RSA.truncated += 1
+                limit = buffer // 8 - 11 - len("…".encode())
+                payload = self.encrypt(msg.encode()[:limit].decode(errors="ignore") + "…")
+            client.send_frame(payload, frame_type)
+
+    class Session:
+        # Nonce prefixes, one per direction so a nonce is never reused
+        SERVER = b"\x00\x00\x00\x01"
+        CLIENT = b"\x00\x00\x00\x02"
+
+        def __init__(self, key: bytes, prefix: bytes) -> None:
+            if len(key) != 32:
+                raise ValueError("Session key must be 32 bytes")
+            self.aead = ChaCha20Poly1305(key)
+            self.prefix = prefix
+            self.peer_prefix = API.Session.CLIENT if prefix == API.Session.SERVER else API.Session.SERVER
+            self.counter = itertools.count()
+            # Broadcasts send from many threads, the nonces must leave in order
+            self.lock = Lock()
+            # Counter of the last message from the peer, replays never exceed it
+            self.peer_counter = -1
+
+        def encrypt(self, msg, frame_type: int = CHAT):
+            """Sealed message, the frame type is authenticated along with it"""
+            if isinstance(msg, str):
+                msg = msg.encode()
+            nonce = self.prefix + next(self.counter).to_bytes(8, "big")
+            return nonce + self.aead.encrypt(nonce, msg, bytes([frame_type]))
+
+        def decrypt(self, msg: bytes, frame_type: int = CHAT):
+            nonce = msg[:12]
+            if nonce[:4] != self.peer_prefix:
+                raise ValueError("Unexpected nonce direction")
+            counter = int.from_bytes(nonce[4:], "big")
+            if counter <= self.peer_counter:
+                raise ValueError("Replayed message")
+            msg = self.aead.decrypt(nonce, msg[12:], bytes([frame_type]))
+            self.peer_counter = counter
+            return msg
+
+        def send(self, client, msg, frame_type: int = CHAT):
+            """Encrypt and queue under one lock, so the peer sees the counters rise"""
+            with self.lock:
+                client.send_frame(self.encrypt(msg, frame_type), frame_type)
+
 
 class Chat:
     """
-    Args: client (socket), private_key, public_key
+    Args: client (FrameSocket), private_key, public_key
 
     def joined (nickname: str):
         It will send a message when a client disconnect
 
-    def welcome_message (bytes: bytes):
+    def announce (message: str, room: str):
+        System message to a room, saved to the history
+
+    def save_history (username: str, message: str, room: str):
+        Keep a message in the history of a room
+
+    def welcome_message (message: str):
         It will send the clients the encrypted welcome message
 
-    def send_to_clients (message: bytes):
-        It sends clients a message, but it won't be able to send it to itself
+    def send_message (message: str, frame_type: int):
+        Encrypt a message for this client and send it
+
+    def decrypt (message: bytes, frame_type: int):
+        Decrypt a message from this client, RSA in the crypto pool,
+        DATA frames stay bytes
+
+    def send_to_clients (message: str, frame_type: int, room: str):
+        It sends the members of a room (this client's by default) a message,
+        but it won't be able to send it to itself. Each client gets it
+        encrypted with its own cipher, the clients of the other workers
+        through the bus
+
+    def deliver (message: str, room: str, frame_type: int, exclude):
+        Send to the room members of this process only, called through the class
+
+    def send_direct (nickname: str, message: str, frame_type: int, streamed: bool):
+        Send to one user, here or on another worker, instead of the room
+
+    def deliver_to (nickname: str, message: str, frame_type: int, streamed: bool):
+        Send to one user of this process, called through the class
+
+    def kick_banned (exclude):
+        Disconnect the clients of this process that are banned now
 
     def remove_client (client):
-        removes clients from the client list
+        Unregister a client and tell the others it left
+
+    def join_room (room: str):
+        Move this client to another room
+
+    def send_history (before, after, limit: int):
+        Send a page of this client's room history in HISTORY frames
+
+    def send_search (args: list):
+        Run a /search and send a page of results
+
+    def handle_room_command (command: str):
+        /join, /part, /rooms, /history, /search and /store, returns False for other commands
+
+    def offer_file (code: str, size: int, content_hash: str):
+        Keep a file this client shares in the file store, uploading it when it is new
+
+    def handle_file_message (message: str):
+        Answer file requests from the store and receive uploads, True when handled
+
+    def hold_request (message: str):
+        Keep a request for a file this client is uploading, True when held
+
+    def release_requests (requests: list, stored: bool):
+        Answer held requests from the store, or pass them on to this client
+
+    def start_download (code: str, chunk_size: int, ranges: str):
+        Send a stored file to this client, False when it is not stored
+
+    def send_data (payload: bytes):
+        Send a file chunk to this client, over a data stream when it has one
+
+    def attach (nickname: str):
+        Make this connection a data stream of a user, returns its session key
+
+    def stream:
+        Receive the file chunks of a data stream
+
+    def handle_data (payload: bytes, streamed: bool):
+        Route a file chunk to the store, its requester or the room
+
+    def route_file_message (target: str, message: str):
+        Send a file message to one user, the chunks of its transfer follow it
+
+    def route_request (message: str):
+        Send a file request to the user who shared the file, True when handled
+
+    def close_transfers:
+        Stop the uploads and downloads of this client
+
+    def register (nickname: str):
+        Claim the nickname, called by the handshake
+
+    def unregister:
+        Free the nickname of a client that did not make it through the login
+
+    def login (handshake: Handshake):
+        Set up the cipher and greet the client once the handshake is over
 
     def middle:
         When a customer enters the chat, perform this function.
@@ -162,51 +493,493 @@ class Chat:
         self.client_ip = client.getpeername()[0]
         self.nickname = None
         self.is_admin = False
+        self.room = default_room
+        # Clients that asked for history once get it again on every room change
+        self.scrollback = False
+        # Set by the handshake once the client picked a cipher
+        self.cipher = None
+        # Transfers with the file store by file code
+        self.uploads = {}
+        self.downloads = {}
+        # File code -> nicknames the chunks of an outgoing transfer go to
+        self.routes = {}
+        # File code -> requests for it held until its upload to the store is over,
+        # the chunks of a peer transfer could not be told apart from the upload's
+        self.waiting = {}
+        self.waiting_lock = Lock()
+        # Key of the login, data streams prove they belong to it with it
+        self.session_key = None
+        # Data streams of this user (Chat objects of those connections),
+        # chunks go over them so chat never waits behind a transfer
+        self.streams = []
+        self.stream_turn = itertools.count()
+        # Set on a data stream, the Chat of the login it belongs to
+        self.owner = None
 
     def joined(self, nickname: str):
-        join_message = f"[green]{nickname}[/green] has joined."
-        self.send_to_clients(self.rsa_api.encrypt(join_message))
+        self.announce(f"[green]{nickname}[/green] has joined.", self.room)
+
+    def announce(self, msg: str, room: str):
+        self.send_to_clients(msg, room=room)
         
-        # Save join message to database if enabled
+        # Save join and leave messages to database if enabled
         if save_chat_history:
-            db.save_message("System", join_message)
+            self.save_history("System", msg, room)
+
+    def save_history(self, username: str, msg: str, room: str):
+        db.save_message(username, msg, room)
+
+    def welcome_message(self, welcome_message: str):
+        self.send_message(welcome_message)
 
-    def welcome_message(self, welcome_message: bytes):
-        self.client.send(welcome_message)
+    def send_message(self, msg: str, frame_type: int = CHAT):
+        self.cipher.send(self.client, msg, frame_type)
+
+    def decrypt(self, msg: bytes, frame_type: int = CHAT):
+        if frame_type == DATA:
+            return self.cipher.decrypt(msg, frame_type)
+        if crypto_pool is not None and isinstance(self.cipher, API.RSA):
+            # Waiting releases the GIL, other connections keep going
+            return crypto_pool.decrypt(self.cipher.priv_key, msg).result()
+        return self.cipher.decrypt(msg, frame_type).decode()
+
+    def send_to_clients(self, msg: str, frame_type: int = CHAT, room: str = None):
+        room = room or self.room
+        Chat.deliver(msg, room, frame_type, self.client)
+        if bus is not None:
+            message = {"type": "broadcast", "frame_type": frame_type, "room": room}
+            if isinstance(msg, bytes):
+                # File data, JSON only carries text
+                message["data"] = base64.b64encode(msg).decode()
+            else:
+                message["text"] = msg
+            bus.publish(message)
+
+    def deliver(msg: str, room: str, frame_type: int = CHAT, exclude=None):
+        # Only the room's members, the tuple stays valid while people come and go
+        for session in sessions.members(room):
+            if session.connection is not exclude:
+                cipher = session.chat.cipher
+                # Skip clients still in the handshake
+                if cipher is None:
+                    continue
+                if frame_type == FILE and session.chat.hold_request(msg):
+                    continue
 
-    def send_to_clients(self, msg: bytes):
-        for client in clients:
-            if client != self.client:
                 try:
-                    client.send(msg)
+                    cipher.send(session.connection, msg, frame_type)
+                except OverflowError:
+                    # File message too long for an RSA-only client, counted
+                    continue
                 except BaseException:
-                    self.remove_client(client)
+                    session.chat.remove_client(session.connection)
+
+    def send_data(self, payload: bytes):
+        """Send a file chunk over one of the data streams, the connection itself without them"""
+        while self.streams:
+            try:
+                stream = self.streams[next(self.stream_turn) % len(self.streams)]
+            except (IndexError, ZeroDivisionError):
+                # The last one just closed
+                break
+            try:
+                stream.cipher.send(stream.client, payload, DATA)
+                return
+            except OSError:
+                self.detach(stream)
+        self.cipher.send(self.client, payload, DATA)
+
+    def attach(self, nickname: str):
+        """Session key of a user logged in on this process, this connection becomes one of its data streams"""
+        session = sessions.find(nickname)
+        if session is None or session.chat.session_key is None:
+            return None
+        self.owner = session.chat
+        return session.chat.session_key
+
+    def detach(self, stream):
+        try:
+            self.streams.remove(stream)
+        except ValueError:
+            pass
+
+    def stream(self):
+        """Receive the chunks of a data stream, they count as sent by its owner"""
+        owner = self.owner
+        owner.streams.append(self)
+        try:
+            while True:
+                frame_type, msg = self.client.recv_frame()
+                if frame_type is None:
+                    break
+                self.stream_frame(frame_type, msg)
+        except OSError:
+            pass
+        finally:
+            owner.detach(self)
+
+    def stream_frame(self, frame_type: int, msg: bytes):
+        if frame_type != DATA:
+            # Only chunks, everything else belongs on the connection of the login
+            return
+        try:
+            payload = self.cipher.decrypt(msg, DATA)
+        except Exception:
+            return
+        self.owner.handle_data(payload, streamed=True)
+
+    def send_direct(self, nickname: str, msg, frame_type: int = FILE, streamed: bool = False):
+        if Chat.deliver_to(nickname, msg, frame_type, streamed):
+            return
+        if bus is not None and nickname in remote_users:
+            # The hub passes it to the worker of that user only
+            message = {"type": "direct", "nick": nickname, "frame_type": frame_type, "streamed": streamed}
+            if isinstance(msg, bytes):
+                message["data"] = base64.b64encode(msg).decode()
+            else:
+                message["text"] = msg
+            bus.publish(message)
+
+    def deliver_to(nickname: str, msg, frame_type: int = FILE, streamed: bool = False) -> bool:
+        """
+        False when the user is not connected to this process. Chunks that
+        came over a data stream leave over one, the others stay in order
+        with the messages of the connection.
+        """
+        # The nickname index, one lookup however many people are online
+        session = sessions.find(nickname)
+        if session is None:
+            return False
+        cipher = session.chat.cipher
+        if cipher is None:
+            return True
+        if frame_type == FILE and session.chat.hold_request(msg):
+            return True
+        try:
+            if streamed:
+                session.chat.send_data(msg)
+                return True
+            cipher.send(session.connection, msg, frame_type)
+        except OverflowError:
+            # File message or chunk too long for an RSA-only client, counted
+            pass
+        except BaseException:
+            session.chat.remove_client(session.connection)
+        return True
+
+    def route_file_message(self, target: str, msg: str):
+        """
+        Send a file message to one user. The chunks of a transfer follow
+        the start message to the same user until its end message.
+        """
+        for marker in ("[b]File start:[/b] #", "[b]File end:[/b] #"):
+            if marker in msg:
+                code = msg.split(marker, 1)[1].split(":", 1)[0].strip()
+                if marker == "[b]File start:[/b] #":
+                    self.routes.setdefault(code, set()).add(target)
+                elif code in self.routes:
+                    self.routes[code].discard(target)
+                    if not self.routes[code]:
+                        del self.routes[code]
+        # The receiver answers the sender, so it learns who that is
+        self.send_direct(target, f"@{self.nickname} {msg}")
+
+    def route_request(self, msg: str) -> bool:
+        """
+        A request goes to the sharer only, the shared_files table knows who
+        that is. Codes it does not know are asked in the room like before.
+        """
+        marker = "[b]Requesting file:[/b] #"
+        if marker not in msg:
+            return False
+        code = msg.split(marker, 1)[1].split(":", 1)[0].strip()
+        sharer = db.get_file_sharer(code)
+        if sharer is None or sharer == self.nickname:
+            return False
+        if sessions.find(sharer) is None and sharer not in remote_users:
+            self.send_message(f"[yellow]#{code} is not available, {sharer} is offline[/yellow]")
+            return True
+        self.route_file_message(sharer, msg)
+        return True
+
+    def kick_banned(exclude=None):
+        for banned in sessions.snapshot():
+            if banned.chat is not exclude and bans.is_banned(banned.ip):
+                try:
+                    banned.chat.send_message("[red]You have been banned from this server.[/red]")
+                    banned.connection.close()
+                except:
+                    pass
 
     def remove_client(self, client):
         print(f"[[yellow]?[/yellow]] Client disconnected")
 
-        if client in clients:
-            index = clients.index(client)
-            # Remove from list
-            clients.remove(client)
-            
-            # Get username from socket
-            if index < len(nicknames):
-                nickname = nicknames[index]
-                
-                leave_message = f"[green]{nickname}[/green] has left."
-                self.send_to_clients(self.rsa_api.encrypt(leave_message))
-                
-                # Save leave message to database if enabled
-                if save_chat_history:
-                    db.save_message("System", leave_message)
-                
-                # Remove nickname
-                nicknames.remove(nickname)
-                
-                # Remove from client_ips dict
-                if nickname in client_ips:
-                    del client_ips[nickname]
+        self.close_transfers()
+
+        # Only the first caller gets the session, the leave message is sent once
+        session = sessions.remove(client)
+        if session is not None:
+            if bus is not None:
+                bus.publish({"type": "release", "nick": session.nickname})
+            self.announce(f"[green]{session.nickname}[/green] has left.", session.room)
+
+    def join_room(self, room: str):
+        if room == self.room:
+            self.send_message(f"[yellow]You are already in #{room}[/yellow]")
+            return
+        
+        previous = sessions.move(self.client, room)
+        if previous is None:
+            return
+        self.room = room
+        if bus is not None:
+            bus.publish({"type": "move", "nick": self.nickname, "room": room})
+        
+        self.announce(f"[green]{self.nickname}[/green] has left #{previous}.", previous)
+        self.announce(f"[green]{self.nickname}[/green] has joined #{room}.", room)
+        self.send_message(f"[yellow]You are now in #{room}[/yellow]")
+        if self.scrollback:
+            self.send_history()
+
+    def send_history(self, before=None, after=None, limit: int = None):
+        page = history.page(self.room, before, after, limit)
+        
+        if isinstance(self.cipher, API.RSA):
+            # One RSA block per frame, PKCS#1 v1.5 takes 11 bytes of it
+            max_bytes = buffer // 8 - 11
+        else:
+            max_bytes = history_frame_bytes
+        
+        for payload in history.frames(page, max_bytes):
+            try:
+                self.cipher.send(self.client, payload, HISTORY)
+            except OverflowError:
+                # A long room name leaves no room for a row
+                continue
+
+    def send_search(self, args: list):
+        query = search.parse(args, self.room)
+        rows, more = search.run(query)
+        
+        where = f"#{query['room']}" if query["room"] else "all rooms"
+        if query["archive"]:
+            where += " (archive)"
+        lines = [f"[yellow]Search in {where}, page {query['page']}:[/yellow]"]
+        for _, username, content, timestamp, room, snippet in rows:
+            lines.append(f"[{timestamp}] #{room} {snippet}")
+        if not rows:
+            lines.append("[yellow]No messages found[/yellow]")
+        elif more:
+            lines.append(f"[yellow]More results with page:{query['page'] + 1}[/yellow]")
+        
+        # RSA-only clients get what fits in one block
+        for line in lines:
+            self.send_message(line)
+
+    def handle_room_command(self, command: str) -> bool:
+        parts = command.split()
+        cmd = parts[0] if parts else ""
+        
+        if cmd == "/join" and len(parts) >= 2:
+            room = API.room_name(parts[1])
+            if room is None:
+                self.send_message("[red]Room names are 1-32 letters, digits, - or _[/red]")
+            else:
+                self.join_room(room)
+        
+        elif cmd == "/part":
+            self.join_room(default_room)
+        
+        elif cmd == "/rooms":
+            counts = Counter(sessions.rooms()) + Counter(remote_rooms.values())
+            lines = ["[yellow]Rooms:[/yellow]"]
+            for room, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+                marker = " (you)" if room == self.room else ""
+                lines.append(f"#{room}: {count}{marker}")
+            for line in lines:
+                self.send_message(line)
+        
+        elif cmd == "/history":
+            # /history [before|after <cursor>] [limit]
+            self.scrollback = True
+            try:
+                self.send_history(*history.parse(parts[1:]))
+            except HistoryError as e:
+                self.send_message(f"[red]{e}[/red]")
+        
+        elif cmd == "/store" and file_store is not None and len(parts) >= 4:
+            # /store #code size hash, sent by the client after sharing a file
+            try:
+                self.offer_file(parts[1].lstrip("#"), int(parts[2]), parts[3])
+            except ValueError:
+                pass
+        
+        elif cmd == "/search":
+            # /search [from:user] [in:room|all] [after:date] [before:date] [page:n] words
+            try:
+                self.send_search(parts[1:])
+            except SearchError as e:
+                self.send_message(f"[red]{e}[/red]")
+        
+        else:
+            return False
+        return True
+
+    def offer_file(self, code: str, size: int, content_hash: str):
+        result = file_store.offer(self.nickname, code, size, content_hash)
+        if result == "stored":
+            self.send_message(f"[yellow]#{code} is kept on the server, it can be downloaded while you are offline[/yellow]")
+        elif result is not None:
+            if code in self.routes:
+                # On its way to a peer right now, the chunks would mix
+                result.discard()
+                return
+            previous = self.uploads.pop(code, None)
+            if previous is not None:
+                previous.discard()
+            self.uploads[code] = result
+            # The client sends it like to any other requester
+            self.send_message(f"[yellow]Server[/yellow] [b]Requesting file:[/b] #{code}", FILE)
+
+    def handle_file_message(self, msg: str) -> bool:
+        """File traffic between this client and the store, True when it must not reach the room"""
+        if file_store is None:
+            return False
+        for marker in ("[b]Requesting file:[/b] #", "[b]File ack:[/b] #", "[b]File start:[/b] #", "[b]File end:[/b] #"):
+            if marker in msg:
+                break
+        else:
+            return False
+        code, _, rest = msg.split(marker, 1)[1].strip().partition(":")
+        
+        if marker == "[b]Requesting file:[/b] #":
+            # A resume names its chunk size and the missing ranges
+            chunk_size, _, ranges = rest.partition(":")
+            return self.start_download(code, int(chunk_size) if chunk_size.isdigit() else None, ranges or None)
+        
+        if marker == "[b]File ack:[/b] #":
+            download = self.downloads.get(code)
+            if download is None:
+                return False
+            download.ack(int(rest))
+            self.pump_download(download)
+            return True
+        
+        upload = self.uploads.get(code)
+        if upload is None:
+            return False
+        if marker == "[b]File start:[/b] #":
+            # The filename may contain colons, it is not last
+            _, _, chunk_count, chunk_size = rest.rsplit(":", 3)
+            upload.start(int(chunk_count), int(chunk_size))
+            # Ready for the chunks, a client striping them over data streams waits for this
+            self.send_message(f"[yellow]Server[/yellow] [b]File ack:[/b] #{code}:0", FILE)
+        else:
+            with self.waiting_lock:
+                del self.uploads[code]
+                waiting = self.waiting.pop(code, [])
+            stored = file_store.commit(upload)
+            if stored:
+                self.send_message(f"[yellow]#{code} is kept on the server, it can be downloaded while you are offline[/yellow]")
+            else:
+                self.send_message(f"[red]Upload of #{code} to the server failed, it is shared from your client only[/red]")
+            self.release_requests(waiting, stored)
+        return True
+
+    def hold_request(self, msg: str) -> bool:
+        """Called with every file message for this client, msg is "@requester request" """
+        marker = "[b]Requesting file:[/b] #"
+        if not self.uploads or marker not in msg:
+            return False
+        code = msg.split(marker, 1)[1].split(":", 1)[0].strip()
+        with self.waiting_lock:
+            if code not in self.uploads:
+                return False
+            self.waiting.setdefault(code, []).append(msg)
+        return True
+
+    def release_requests(self, requests: list, stored: bool):
+        for msg in requests:
+            requester, _, request = msg[1:].partition(" ")
+            session = sessions.find(requester)
+            if stored and session is not None and session.chat.handle_file_message(request):
+                continue
+            # Requesters on another worker, or the upload failed: the client answers
+            try:
+                self.send_message(msg, FILE)
+            except OverflowError:
+                pass
+
+    def receive_upload(self, upload, payload: bytes):
+        _, index, digest = CHUNK_HEADER.unpack_from(payload)
+        arrived = upload.write(index, digest, payload[CHUNK_HEADER.size:])
+        # Acknowledge every half window like a client does
+        if arrived % (WINDOW // 2) == 0 or upload.complete():
+            self.send_message(f"[yellow]Server[/yellow] [b]File ack:[/b] #{upload.code}:{arrived}", FILE)
+
+    def start_download(self, code: str, chunk_size: int = None, ranges: str = None) -> bool:
+        if isinstance(self.cipher, API.RSA):
+            # A chunk and its header in one RSA block
+            max_chunk_size = buffer // 8 - 11 - CHUNK_HEADER.size
+        else:
+            max_chunk_size = 64 * 1024
+        if not chunk_size or chunk_size > max_chunk_size:
+            chunk_size = max_chunk_size
+            ranges = None
+        
+        # A window per stream, each stream has a window of bytes in flight
+        download = file_store.download(code, chunk_size, ranges, WINDOW * max(1, len(self.streams)))
+        if download is None:
+            # Not stored, the sharer answers
+            return False
+        
+        try:
+            self.send_message(f"[yellow]Server[/yellow] [b]File start:[/b] #{code}:{download.filename}:{download.size}:{download.chunk_count}:{chunk_size}", FILE)
+        except OverflowError:
+            # Filename too long for an RSA-only client
+            download.close()
+            return False
+        
+        previous = self.downloads.pop(code, None)
+        if previous is not None:
+            previous.close()
+        self.downloads[code] = download
+        if self.streams:
+            # Whole half windows over the streams, so the client acknowledges the last of them
+            download.striped = download.count - download.count % (WINDOW // 2)
+            # The chunks could overtake the start message, the client's
+            # first acknowledgement says it is ready for them
+        else:
+            self.pump_download(download)
+        return True
+
+    def pump_download(self, download):
+        """Send what the window allows, then the end message once"""
+        for payload in download.chunks(download.striped):
+            self.send_data(payload)
+        if download.acked >= download.striped:
+            # The rest once every streamed chunk arrived, on the connection
+            # like the end message, so nothing overtakes it
+            for payload in download.chunks():
+                self.cipher.send(self.client, payload, DATA)
+        if download.done and not download.ended:
+            download.ended = True
+            # Stays in downloads, the last acknowledgements are not forwarded either
+            self.send_message(f"[yellow]Server[/yellow] [b]File end:[/b] #{download.code}:{download.content_hash}", FILE)
+
+    def close_transfers(self):
+        self.routes.clear()
+        with self.waiting_lock:
+            self.waiting.clear()
+        for stream in tuple(self.streams):
+            stream.client.close()
+        self.streams.clear()
+        while self.uploads:
+            self.uploads.popitem()[1].discard()
+        while self.downloads:
+            download = self.downloads.popitem()[1]
+            if not download.done:
+                download.close()
 
     def handle_admin_command(self, command):
         """Handle admin commands"""
@@ -217,214 +990,600 @@ class Chat:
         cmd = parts[1]
         
         if cmd == "ban" and len(parts) >= 3:
-            user_to_ban = parts[2]
+            target = parts[2]
             reason = " ".join(parts[3:]) if len(parts) > 3 else "No reason provided"
             
-            if user_to_ban in client_ips:
-                ip_to_ban = client_ips[user_to_ban]
-                db.ban_user(ip_to_ban, reason)
-                
-                # Notify admin
-                admin_msg = f"User {user_to_ban} has been banned. Reason: {reason}"
-                self.client.send(self.rsa_api.encrypt(f"[red]ADMIN:[/red] {admin_msg}"))
+            # A connected user, here or on another worker, otherwise an IP address or CIDR range
+            user = sessions.find(target)
+            user_ip = user.ip if user else remote_users.get(target)
+            ip_to_ban = user_ip or target
+            try:
+                network = bans.ban(ip_to_ban, reason)
+            except ValueError:
+                self.send_message(f"[red]ADMIN:[/red] Unknown user or address {target}")
+                return
+            
+            if bus is not None:
+                # Already written to the database, the other workers only update their index
+                bus.publish({"type": "ban", "target": BanIndex.format(network), "banned_until": time.time() + 24 * 3600})
+            
+            # Notify admin
+            admin_msg = f"{'User ' if user_ip else ''}{target} has been banned. Reason: {reason}"
+            self.send_message(f"[red]ADMIN:[/red] {admin_msg}")
+            
+            # Disconnect every user inside the banned range
+            Chat.kick_banned(self)
+        
+        elif cmd == "unban" and len(parts) >= 3:
+            try:
+                lifted = bans.unban(parts[2])
+            except ValueError:
+                self.send_message(f"[red]ADMIN:[/red] Invalid address {parts[2]}")
+                return
+            
+            if bus is not None:
+                bus.publish({"type": "unban", "target": parts[2]})
+            
+            status = "lifted" if lifted else "not found"
+            self.send_message(f"[red]ADMIN:[/red] Ban on {parts[2]} {status}")
+        
+        elif cmd == "bans":
+            active = bans.bans()
+            self.send_message(f"[red]ADMIN:[/red] {len(active)} active bans")
+            # One message per ban so RSA-only clients can decrypt them
+            for network, banned_until in active[:50]:
+                until = datetime.fromtimestamp(banned_until).strftime("%Y-%m-%d %H:%M")
+                self.send_message(f"{BanIndex.format(network)} until {until}")
+        
+        elif cmd in ("promote", "demote") and len(parts) >= 3:
+            username = parts[2]
+            is_admin = cmd == "promote"
+            
+            if db.set_admin(username, is_admin):
+                # Apply to the connected user right away
+                session = sessions.find(username)
+                if session:
+                    session.chat.is_admin = is_admin
+                if bus is not None:
+                    bus.publish({"type": "admin", "nick": username, "is_admin": is_admin})
                 
-                # Disconnect the banned user
-                for i, nick in enumerate(nicknames):
-                    if nick == user_to_ban and i < len(clients):
-                        try:
-                            clients[i].send(self.rsa_api.encrypt("[red]You have been banned from this server.[/red]"))
-                            clients[i].close()
-                        except:
-                            pass
+                status = "now" if is_admin else "no longer"
+                self.send_message(f"[red]ADMIN:[/red] {username} is {status} an administrator")
+            else:
+                self.send_message(f"[red]ADMIN:[/red] Unknown user {username}")
         
         elif cmd == "history" and len(parts) >= 3:
             try:
-                limit = int(parts[2])
-                messages = db.get_recent_messages(limit)
-                
-                history_msg = "[yellow]--- Chat History ---[/yellow]\n"
-                for username, content, timestamp in messages:
-                    dt = datetime.fromtimestamp(timestamp) if isinstance(timestamp, (int, float)) else timestamp
-                    formatted_time = dt.strftime("%Y-%m-%d %H:%M:%S")
-                    history_msg += f"[{formatted_time}] <{username}> {content}\n"
-                
-                self.client.send(self.rsa_api.encrypt(history_msg))
-            except:
-                self.client.send(self.rsa_api.encrypt("[red]Error retrieving chat history[/red]"))
+                _, _, limit = history.parse(parts[2:3])
+                self.send_history(limit=limit)
+            except HistoryError as e:
+                self.send_message(f"[red]ADMIN:[/red] {e}")
+            except Exception:
+                self.send_message("[red]Error retrieving chat history[/red]")
+        
+        elif cmd == "queues":
+            # Outbound queue metrics of the connected clients
+            lines = ["[yellow]Outbound Queues:[/yellow]"]
+            total = {"depth": 0, "queued_bytes": 0, "spilled_bytes": 0, "evicted": 0, "spilled": 0}
+            deepest = []
+            for session in sessions.snapshot():
+                stats = session.connection.outbox.stats()
+                for key in total:
+                    total[key] += stats[key]
+                deepest.append((stats["depth"] + stats["spilled"], session.nickname))
+            
+            lines.append(f"Clients: {len(sessions)}, policy: {outbox_policy}, limit: {outbox_max_frames} frames")
+            lines.append(f"Queued: {total['depth']} frames ({total['queued_bytes']} bytes)")
+            lines.append(f"Spilled to disk: {total['spilled_bytes']} bytes")
+            lines.append(f"Evicted: {total['evicted']}, spilled: {total['spilled']}, disconnected: {Outbox.disconnects}")
+            lines.append(f"Too long for RSA-only clients: {API.RSA.truncated} cut short, {API.RSA.dropped} dropped")
+            for depth, nickname in sorted(deepest, reverse=True)[:3]:
+                if depth:
+                    lines.append(f"Deepest: {nickname} ({depth})")
+            
+            for line in lines:
+                self.send_message(line)
+        
+        elif cmd == "vacuum":
+            # Rewrites the whole file, logins and writes wait for it
+            self.send_message("[red]ADMIN:[/red] Vacuuming the database, it is locked until it is done")
+            
+            def vacuum():
+                freed = db.vacuum()
+                if freed is not None:
+                    self.send_message(f"[red]ADMIN:[/red] Vacuum done, {freed} pages freed")
+            Thread(target=vacuum, daemon=True).start()
         
         elif cmd == "dbstats":
-            # Get database statistics
-            num_users = len(db.get_all_users())
-            num_messages = len(db.get_all_messages())
-            admin_msg = f"[yellow]Database Stats:[/yellow]\nUsers: {num_users}\nMessages: {num_messages}"
-            self.client.send(self.rsa_api.encrypt(admin_msg))
+            # Get database statistics from the counter tables
+            stats = db.get_stats()
+            lines = [
+                "[yellow]Database Stats:[/yellow]",
+                f"Users: {stats['users']}",
+                f"Messages: {stats['messages']}",
+                f"Shared files: {stats['shared_files']}",
+                f"Last hour: {stats['messages_last_hour']} ({stats['messages_per_minute']:.1f}/min)",
+                f"Write queue: {stats['queued_messages']} queued, {stats['dropped_messages']} dropped",
+            ]
+            archive = retention.stats()
+            lines.append(f"Archived: {archive['messages']} messages in {archive['segments']} segments")
+            if file_store is not None:
+                stored = file_store.stats()
+                lines.append(f"Stored files: {stored['files']} ({stored['bytes'] / 1024 / 1024:.1f} MB)")
+            for username, count in stats["top_posters"]:
+                lines.append(f"Top: {username} ({count})")
+            
+            # One message per line so RSA-only clients can decrypt them
+            for line in lines:
+                self.send_message(line)
+
+    def handle_data(self, payload: bytes, streamed: bool = False):
+        """
+        Binary file chunk, the code in its header says whether it is for
+        the store. "@nickname " in front of it addresses one requester,
+        several may download the same code at once.
+        """
+        target = None
+        if payload[:1] == b"@":
+            target, _, payload = payload[1:].partition(b" ")
+            target = target.decode(errors="ignore")
+        code = payload[:8].decode(errors="ignore")
+        upload = self.uploads.get(code)
+        if target is not None:
+            # Only while the transfer to that requester runs
+            if target in self.routes.get(code, ()):
+                self.send_direct(target, payload, DATA, streamed)
+        elif upload is not None:
+            self.receive_upload(upload, payload)
+        elif code in self.routes:
+            # Senders that do not address their chunks, every requester of the code gets them
+            for target in tuple(self.routes.get(code, ())):
+                self.send_direct(target, payload, DATA, streamed)
+        else:
+            # Senders that do not address their transfers
+            self.send_to_clients(payload, DATA)
+
+    def handle_message(self, frame_type: int, decrypted_msg: str) -> bool:
+        """
+        Process one decrypted message received from the client.
+        Returns False when the client left and the session must end.
+        """
+        nickname = self.nickname
+
+        if frame_type == DATA:
+            self.handle_data(decrypted_msg)
+            return True
+
+        try:
+            # Handle admin commands
+            if decrypted_msg.startswith("/admin ") and self.is_admin and admin_commands_enabled:
+                self.handle_admin_command(decrypted_msg)
+                return True
+            
+            # Check for exit command
+            if decrypted_msg == "/exit":
+                self.remove_client(self.client)
+                return False
+            
+            # Room commands, unknown or unauthorized ones are dropped
+            if frame_type == COMMAND:
+                self.handle_room_command(decrypted_msg)
+                return True
+            
+            # "@nickname message" goes to that user only
+            if frame_type == FILE and decrypted_msg.startswith("@"):
+                target, _, body = decrypted_msg[1:].partition(" ")
+                if target != nickname:
+                    self.route_file_message(target, body)
+                return True
+            
+            # Requests the store answers and uploads to it
+            if frame_type == FILE and self.handle_file_message(decrypted_msg):
+                return True
+            
+            # Other requests go to the sharer instead of the room
+            if frame_type == FILE and self.route_request(decrypted_msg):
+                return True
+            
+            # Save chat message to database if enabled, file chunks are not history
+            if save_chat_history and frame_type == CHAT:
+                self.save_history(nickname, decrypted_msg, self.room)
+            
+            # Check if it's a file upload message
+            if "[b]Shared file:[/b]" in decrypted_msg:
+                # Extract file URL
+                file_url = decrypted_msg.split("[b]Shared file:[/b]")[1].strip()
+                # "name (size) | Code: #code", the code is how the file is requested
+                match = re.fullmatch(r"(.*) \([^)]*\) \| Code: #(\w+)", file_url)
+                filename, file_code = match.groups() if match else ("shared_file", None)
+                # Save to database
+                db.save_shared_file(nickname, filename, file_url, file_code)
+            
+        except Exception as e:
+            print(f"[[red]![/red]] Error processing message from {nickname}: {e}")
+        
+        # Forward chat and file traffic to the room, commands stay here
+        if frame_type == FILE:
+            # Answers are addressed to the sender
+            self.send_to_clients(f"@{nickname} {decrypted_msg}", FILE)
+        elif frame_type == CHAT:
+            self.send_to_clients(decrypted_msg, frame_type)
+        return True
 
     def middle(self):
-        index = clients.index(self.client)
-        nickname = nicknames[index]
-        self.nickname = nickname
-        self.joined(nickname)
+        self.joined(self.nickname)
 
         while True:
             try:
-                msg = self.client.recv(buffer)
+                frame_type, msg = self.client.recv_frame()
                 
-                # If empty message, client disconnected
-                if not msg:
+                # If no frame, client disconnected
+                if frame_type is None:
                     self.remove_client(self.client)
                     break
                 
-                # Decrypt the message
                 try:
-                    decrypted_msg = self.rsa_api.decrypt(msg).decode()
-                    
-                    # Handle admin commands
-                    if decrypted_msg.startswith("/admin ") and self.is_admin and admin_commands_enabled:
-                        self.handle_admin_command(decrypted_msg)
-                        continue
-                    
-                    # Check for exit command
-                    if decrypted_msg == "/exit":
-                        self.remove_client(self.client)
-                        break
-                    
-                    # Save message to database if enabled
-                    if save_chat_history:
-                        db.save_message(nickname, decrypted_msg)
-                    
-                    # Check if it's a file upload message
-                    if "[b]Shared file:[/b]" in decrypted_msg:
-                        # Extract file URL
-                        file_url = decrypted_msg.split("[b]Shared file:[/b]")[1].strip()
-                        # Save to database
-                        db.save_shared_file(nickname, "shared_file", file_url)
-                    
-                except:
-                    # Unable to decrypt, just forward the message
-                    pass
+                    decrypted_msg = self.decrypt(msg, frame_type)
+                except Exception:
+                    # Unable to decrypt, there is nothing we could re-encrypt
+                    print(f"[[red]![/red]] Dropped undecryptable message from {self.nickname}")
+                    continue
                 
-                # Forward message to all clients
-                self.send_to_clients(msg)
+                if not self.handle_message(frame_type, decrypted_msg):
+                    break
 
             except Exception as e:
                 print(f"[[red]![/red]] Error handling client message: {e}")
                 self.remove_client(self.client)
                 break
 
+    def register(self, nickname: str) -> bool:
+        """Claim the nickname during the handshake, False when it is taken"""
+        self.nickname = nickname
+        self.is_admin = db.is_user_admin(nickname)
+        
+        # Nicknames are unique across all workers, the hub decides
+        if bus is not None:
+            try:
+                if not bus.request({"type": "claim", "nick": nickname, "ip": self.client_ip, "room": self.room}):
+                    return False
+            except Exception as e:
+                print(f"[[red]![/red]] Bus error: {e}")
+                return False
+        
+        if sessions.add(self.client, nickname, self.client_ip, self, self.room) is None:
+            if bus is not None:
+                bus.publish({"type": "release", "nick": nickname})
+            return False
+        print(f"[[yellow]?[/yellow]] Client connected: {nickname} from {self.client_ip}")
+        return True
+
+    def unregister(self):
+        session = sessions.remove(self.client)
+        if session is not None and bus is not None:
+            bus.publish({"type": "release", "nick": session.nickname})
+
+    def login(self, handshake) -> bool:
+        """Finish the handshake, returns False when the client was rejected"""
+        if handshake.state != DONE:
+            if handshake.nickname is not None:
+                # Claimed the nickname, then failed the cipher negotiation
+                self.unregister()
+            self.client.close()
+            return False
+
+        self.cipher = API.create_cipher(handshake)
+        self.session_key = handshake.session_key
+
+        # Encrypt welcome_message and send to client
+        self.welcome_message(welcome_message)
+        
+        # If user is admin, send admin notification
+        if self.is_admin:
+            admin_welcome = "[red]You are logged in as an administrator. Use /admin command <args> for admin functions.[/red]"
+            self.send_message(admin_welcome)
+        return True
+
     def run(self):
+        handshake = API.create_handshake(self)
+        try:
+            # The hello goes out right away, the client does not wait for it to log in
+            for payload, frame_type in handshake.start():
+                self.client.send_frame(payload, frame_type)
+
+            while handshake.state == LOGIN:
+                frame_type, payload = self.client.recv_frame()
+                if frame_type is None:
+                    raise ConnectionResetError("Connection closed during login")
+                for reply, reply_type in handshake.receive(frame_type, payload):
+                    self.client.send_frame(reply, reply_type)
+
+            if handshake.state == KEYS:
+                # Ready in the pool unless a burst drained it
+                for reply, reply_type in handshake.provide_keys(key_pool.get()):
+                    self.client.send_frame(reply, reply_type)
+        except (HandshakeError, FrameError, OSError) as e:
+            print(f"[[red]![/red]] Error during authentication: {e}")
+            self.unregister()
+            self.client.close()
+            return
+
         try:
-            # Check if IP is banned
-            if db.is_banned(self.client_ip):
-                self.client.send("banned".encode())
-                self.client.close()
+            if handshake.state == DONE and handshake.attached:
+                self.cipher = API.create_cipher(handshake)
+                self.stream()
                 return
-                
-            login_attempts = 0
-            username_exist = False
             
-            if protected_by_password:
-                self.client.send("protected".encode())
-                
-                while login_attempts < max_login_attempts:
-                    user_passwd = self.client.recv(1024).decode()
-                    if user_passwd == hashlib.md5(password.encode()).hexdigest():
-                        self.client.send("/accepted".encode())
-                        break
-                    else:
-                        login_attempts += 1
-                        if login_attempts >= max_login_attempts:
-                            self.client.send("/exit".encode())
-                            self.client.close()
-                            return
-                        self.client.send("/retry".encode())
-            else:
-                self.client.send("no_protected".encode())
+            if not self.login(handshake):
+                return
+            
+            # Begin message handling
+            self.middle()
+            
+        except Exception as e:
+            print(f"[[red]![/red]] Error in connection setup: {e}")
+            self.remove_client(self.client)
+        finally:
+            # Stops the outbox writer once the last frames are out
+            self.client.close()
 
-            nickname = self.client.recv(buffer).decode()
 
-            # Check username existing
-            for list_nickname in nicknames:
-                if not username_exist and nickname == list_nickname:
-                    username_exist = True
+class StreamClient:
+    """
+    Socket-like wrapper around an asyncio StreamWriter, so the Chat helpers
+    (send_to_clients, remove_client, admin commands) work unchanged for
+    connections served by the event loop.
 
-            # If username doesn't exist
-            if not username_exist:
-                # Send message: "accepted" to client
-                self.client.send("/accepted".encode())
-                print(f"[[yellow]?[/yellow]] Client connected: {nickname} from {self.client_ip}")
+    Frames go through an Outbox drained by a writer task, which waits for
+    the transport to drain so a slow client fills its own queue only.
+    """
 
-                # Check if user is admin
-                self.is_admin = db.is_user_admin(nickname)
-                
-                # Add to tracking structures
-                nicknames.append(nickname)
-                clients.append(self.client)
-                client_ips[nickname] = self.client_ip
-            else:
-                # Send message: "exit" to client
-                self.client.send("/exit".encode())
-                self.client.close()
-                return
-        except Exception as e:
-            print(f"[[red]![/red]] Error during authentication: {e}")
+    def __init__(self, writer, outbox: Outbox = None) -> None:
+        self.writer = writer
+        self.outbox = outbox or API.create_outbox()
+        # Frames are written whole, Nagle would only delay pipelined ones
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.task = asyncio.get_running_loop().create_task(self.drain())
+
+    def send_frame(self, payload: bytes, frame_type: int = CHAT):
+        if self.closing or self.writer.is_closing():
+            raise ConnectionResetError("Connection closed")
+        # Never blocks: the frame is queued for the writer task
+        if not self.outbox.put(encode_frame(payload, frame_type)):
+            self.abort()
+            raise ConnectionResetError("Outbound queue overflow")
+        self.wakeup.set()
+
+    async def drain(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.outbox.has_data():
+                    self.writer.write(self.outbox.take())
+                    await self.writer.drain()
+                if self.closing:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.outbox.discard()
+            self.writer.close()
+
+    def close(self):
+        """Close once the queued frames were written"""
+        self.closing = True
+        self.wakeup.set()
+
+    def abort(self):
+        self.closing = True
+        self.outbox.discard()
+        self.writer.transport.abort()
+        self.wakeup.set()
+
+    def getpeername(self):
+        return self.writer.get_extra_info("peername")
+
+
+class AsyncChat(Chat):
+    """
+    Args: reader, writer (asyncio streams), private_key, public_key
+
+    Same handshake and message loop as Chat, but every wait is a coroutine
+    so a single event loop can serve all connections.
+
+    async def recv_frame:
+        Wait for the next whole frame from the client
+
+    async def decrypt_async (message: bytes, frame_type: int):
+        Like decrypt, without blocking the event loop
+
+    def save_history (username: str, message: str, room: str):
+        Like Chat.save_history, a full write queue blocks a thread instead of the event loop
+
+    async def run:
+        Handshake, then middle
+
+    async def middle:
+        Wait for messages from the client and send them to all
+
+    async def stream_async:
+        Like stream, for a data stream served by the event loop
+    """
+
+    # One thread, so the messages reach the write queue in the order they were
+    # sent, the owner runs the writes of the other workers on it as well
+    history_writer = ThreadPoolExecutor(1, thread_name_prefix="history")
+
+    def __init__(self, reader, writer, private_key, public_key) -> None:
+        super().__init__(StreamClient(writer), private_key, public_key)
+        self.reader = reader
+        self.decoder = FrameDecoder()
+
+    def save_history(self, username: str, msg: str, room: str):
+        AsyncChat.history_writer.submit(db.save_message, username, msg, room)
+
+    async def decrypt_async(self, msg: bytes, frame_type: int = CHAT):
+        if frame_type == DATA:
+            return self.cipher.decrypt(msg, frame_type)
+        if crypto_pool is not None and isinstance(self.cipher, API.RSA):
+            return await asyncio.wrap_future(crypto_pool.decrypt(self.cipher.priv_key, msg))
+        return self.cipher.decrypt(msg, frame_type).decode()
+
+    async def recv_frame(self):
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = await self.reader.read(65536)
+            if not data:
+                return None, b""
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        return frame
+
+    async def middle(self):
+        self.joined(self.nickname)
+
+        while True:
             try:
-                self.client.close()
-            except:
-                pass
-            return
-        
+                frame_type, msg = await self.recv_frame()
+                
+                # If no frame, client disconnected
+                if frame_type is None:
+                    self.remove_client(self.client)
+                    break
+                
+                try:
+                    decrypted_msg = await self.decrypt_async(msg, frame_type)
+                except Exception:
+                    print(f"[[red]![/red]] Dropped undecryptable message from {self.nickname}")
+                    continue
+                
+                if not self.handle_message(frame_type, decrypted_msg):
+                    break
+
+            except Exception as e:
+                print(f"[[red]![/red]] Error handling client message: {e}")
+                self.remove_client(self.client)
+                break
+
+    async def stream_async(self):
+        owner = self.owner
+        owner.streams.append(self)
         try:
-            API.send_buffer(self.client, buffer)
-        except Exception as e:
-            print(f"[[red]![/red]] Error sending buffer: {e}")
-            return
-        
-        time.sleep(0.5)
-        
+            while True:
+                frame_type, msg = await self.recv_frame()
+                if frame_type is None:
+                    break
+                self.stream_frame(frame_type, msg)
+        except OSError:
+            pass
+        finally:
+            owner.detach(self)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        handshake = API.create_handshake(self)
         try:
-            send_keys = API.Send_keys(
-                self.public_key,
-                self.private_key,
-                self.client)
+            for payload, frame_type in handshake.start():
+                self.client.send_frame(payload, frame_type)
 
-            self.rsa_api = API.RSA(self.public_key, self.private_key)
-            self.chat_api = API.Chat(self.private_key, self.public_key)
+            while handshake.state == LOGIN:
+                frame_type, payload = await self.recv_frame()
+                if frame_type is None:
+                    raise ConnectionResetError("Connection closed during login")
+                # Claiming the nickname waits for the bus and the database, in a thread
+                replies = await loop.run_in_executor(None, handshake.receive, frame_type, payload)
+                for reply, reply_type in replies:
+                    self.client.send_frame(reply, reply_type)
 
-            send_keys.public()
-            time.sleep(0.5)
-            send_keys.private()
-            time.sleep(0.5)
+            if handshake.state == KEYS:
+                keypair = await asyncio.wrap_future(key_pool.request())
+                for reply, reply_type in handshake.provide_keys(keypair):
+                    self.client.send_frame(reply, reply_type)
+        except (HandshakeError, FrameError, OSError) as e:
+            print(f"[[red]![/red]] Error during authentication: {e}")
+            self.unregister()
+            self.client.close()
+            return
 
-            # Encrypt welcome_message and send to client
-            self.welcome_message(self.rsa_api.encrypt(welcome_message))
+        try:
+            if handshake.state == DONE and handshake.attached:
+                self.cipher = API.create_cipher(handshake)
+                await self.stream_async()
+                return
             
-            # If user is admin, send admin notification
-            if self.is_admin:
-                admin_welcome = "[red]You are logged in as an administrator. Use /admin command <args> for admin functions.[/red]"
-                self.client.send(self.rsa_api.encrypt(admin_welcome))
+            if not self.login(handshake):
+                return
             
             # Begin message handling
-            self.middle()
+            await self.middle()
             
         except Exception as e:
             print(f"[[red]![/red]] Error in connection setup: {e}")
             self.remove_client(self.client)
+        finally:
+            self.client.close()
 
 
 class Main:
     """
-    def run:
-        It will generate keys and wait for connections
+    def prepare:
+        Load the bans and the server key, show the recent history
+
+    def listen (reuse_port: bool):
+        Bind the listening socket
+
+    def run (reuse_port: bool):
+        It will start the pools and wait for connections
+
+    def supervise:
+        Fork the workers, route their bus messages and restart them when they die
+
+    def spawn (index: int):
+        Fork a worker, returns its pid
+
+    def worker (index: int):
+        Body of a forked worker process, never returns
+
+    def stop (signum, frame):
+        Signal handler of the supervisor and the workers, shuts down once
+
+    def on_bus_message (message: dict):
+        Apply what another worker did to this process
+
+    def persist (message: dict):
+        Database write forwarded by another worker, answered when it is done
+
+    def shutdown:
+        Stop the pools, flush the database and close the socket
+
+    def reject (client):
+        Tell a banned client and close the connection
+
+    def run_threaded:
+        Accept loop, one thread per connection
+
+    async def run_async:
+        Serve every connection from a single event loop
     """
-    def run():
-        username_exist = False
+    # Database writes the owner accepts from the other workers
+    PERSIST_OPS = ("save_message", "save_shared_file", "store_shared_file", "evict_shared_files", "ban_user", "unban", "set_admin", "vacuum")
 
+    def prepare():
         print(f"[[magenta]*[/magenta]] Buffer: {buffer}")
         print(f"[[blue]*[/blue]] Database initialized")
 
-        print("[[cyan]+[/cyan]] RSA key generation...")
-        public_key, private_key = API.create_keys(buffer)
-        print("[[cyan]+[/cyan]] RSA key generated")
+        bans.load()
+        print(f"[[blue]*[/blue]] Active bans: {bans.count}")
+
+        if keys.load():
+            print(f"[[cyan]+[/cyan]] RSA key loaded from {keys.path}")
+        else:
+            print(f"[[cyan]+[/cyan]] RSA key generated and saved to {keys.path}")
 
         try:
             # Get historic messages
@@ -432,16 +1591,223 @@ class Main:
             if recent_messages:
                 print("[[green]+[/green]] Recent chat history:")
                 for username, content, timestamp in recent_messages[-5:]:
-                    dt = datetime.fromtimestamp(timestamp) if isinstance(timestamp, (int, float)) else timestamp
-                    formatted_time = dt.strftime("%Y-%m-%d %H:%M:%S")
+                    # SQLite hands CURRENT_TIMESTAMP back as a string
+                    if isinstance(timestamp, (int, float)):
+                        formatted_time = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+                    else:
+                        formatted_time = timestamp
                     print(f"  [{formatted_time}] <{username}> {content}")
         except Exception as e:
             print(f"[[red]![/red]] Error retrieving chat history: {e}")
 
+    def listen(reuse_port: bool = False):
+        sock = socket.socket()
+        if reuse_port:
+            # Every worker binds the port, the kernel spreads the connections between them
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((ip, port))
+        sock.listen(listen_backlog)
+        return sock
+
+    def run(reuse_port: bool = False):
+        global server
+
+        server = Main.listen(reuse_port)
+        if bus is None:
+            print(f"[[green]![/green]] Listing: {ip}:{port}")
+        else:
+            print(f"[[green]![/green]] Worker {worker_index} listing: {ip}:{port}")
+
+        key_pool.start()
+        if worker_index == OWNER and maintenance_interval_hours:
+            retention.start(maintenance_interval_hours)
+        if worker_index == OWNER and db_optimize_interval_hours:
+            db.start_optimizer(db_optimize_interval_hours)
+        if crypto_pool is not None:
+            crypto_pool.start()
+            print(f"[[cyan]+[/cyan]] Crypto pool: {crypto_pool.workers} workers")
+        print(f"[[cyan]+[/cyan]] Session key pool: {key_pool.low_water}-{key_pool.high_water} keys, {key_pool.workers} workers")
+
+        if server_mode == "asyncio":
+            asyncio.run(Main.run_async())
+        else:
+            Main.run_threaded()
+
+    def supervise():
+        print(f"[[magenta]*[/magenta]] Workers: {worker_count}")
+
+        # Inherited by the workers
+        signal.signal(signal.SIGINT, Main.stop)
+        signal.signal(signal.SIGTERM, Main.stop)
+
+        # A SQLite connection must not cross a fork, the workers open their own
+        db.close()
+
+        hub = Hub(bus_path)
+        hub.start()
+        children = {}
+        try:
+            for index in range(worker_count):
+                children[Main.spawn(index)] = index
+
+            while True:
+                pid, status = os.wait()
+                index = children.pop(pid, None)
+                if index is None:
+                    continue
+                print(f"[[red]![/red]] Worker {index} exited with status {status}, restarting")
+                time.sleep(1)
+                children[Main.spawn(index)] = index
+        finally:
+            # The owner goes last, the others may still hand it writes
+            for owner in (False, True):
+                pids = [pid for pid, index in children.items() if (index == OWNER) == owner]
+                for pid in pids:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                for pid in pids:
+                    try:
+                        os.waitpid(pid, 0)
+                    except ChildProcessError:
+                        pass
+            hub.close()
+
+    def spawn(index: int) -> int:
+        pid = os.fork()
+        if pid == 0:
+            Main.worker(index)
+        return pid
+
+    def worker(index: int):
+        global db, bus, worker_index
+
+        # Ctrl+C reaches the whole process group, the supervisor decides the shutdown order
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            worker_index = index
+            db = Database(database_file, **database_options)
+            bans.db = db
+            history.db = db
+            search.db = db
+            retention.db = db
+            if file_store is not None:
+                file_store.db = db
+
+            # Connected by run_threaded or run_async
+            bus = BusClient(bus_path, index)
+            if index != OWNER:
+                db.forward = bus.persist
+
+            Main.run(reuse_port=True)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print(f"[[red]![/red]] Worker {index} failed: {e}")
+            status = 1
+        finally:
+            try:
+                Main.shutdown()
+            finally:
+                # Never return into the supervisor code this process was forked from
+                os._exit(status)
+
+    def stop(signum, frame):
+        # Only once, a repeated signal (process managers signal the whole group) must not cut the shutdown short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt
+
+    def on_bus_message(message: dict):
+        kind = message.get("type")
+
+        if kind == "broadcast":
+            msg = message["text"] if "text" in message else base64.b64decode(message["data"])
+            Chat.deliver(msg, message["room"], message["frame_type"])
+
+        elif kind == "direct":
+            msg = message["text"] if "text" in message else base64.b64decode(message["data"])
+            Chat.deliver_to(message["nick"], msg, message["frame_type"], message.get("streamed", False))
+
+        elif kind == "presence":
+            nick = message["nick"]
+            if message["event"] == "join":
+                remote_users[nick] = message["ip"]
+                remote_rooms[nick] = message["room"]
+            elif message["event"] == "move":
+                remote_rooms[nick] = message["room"]
+            else:
+                remote_users.pop(nick, None)
+                remote_rooms.pop(nick, None)
+
+        elif kind == "ban":
+            bans.apply(message["target"], message["banned_until"])
+            Chat.kick_banned()
+
+        elif kind == "unban":
+            bans.lift(message["target"])
+
+        elif kind == "admin":
+            db.invalidate_user(message["nick"])
+            session = sessions.find(message["nick"])
+            if session:
+                session.chat.is_admin = message["is_admin"]
+
+        elif kind == "persist" and message.get("op") in Main.PERSIST_OPS:
+            # Only the owner gets these. A write may block for seconds (a full
+            # write queue, a vacuum), the history thread runs them in order,
+            # away from the event loop and the bus reader
+            try:
+                AsyncChat.history_writer.submit(Main.persist, message)
+            except RuntimeError:
+                # Shutting down
+                pass
+
+    def persist(message: dict):
+        try:
+            result = getattr(db, message["op"])(*message["args"])
+        except Exception as e:
+            print(f"[[red]![/red]] Error writing for worker {message.get('from')}: {e}")
+            result = None
+        bus.answer(message, result)
+
+    def shutdown():
+        retention.close()
+        key_pool.close()
+        if crypto_pool is not None:
+            crypto_pool.close()
+        # Messages still on their way to the write queue
+        AsyncChat.history_writer.shutdown()
+        db.close()
+        if server is not None:
+            server.close()
+
+    def reject(client):
+        try:
+            client.send_frame(b"banned", CONTROL)
+        except OSError:
+            pass
+        client.close()
+
+    def run_threaded():
+        print("[[magenta]*[/magenta]] Server mode: threaded")
+
+        if bus is not None:
+            bus.connect(Main.on_bus_message)
+
         while True:
             try:
                 client, addr = server.accept()
-                chat = Chat(client, private_key, public_key)
+
+                # Reject banned addresses before spending a thread on them
+                if bans.is_banned(addr[0]):
+                    Main.reject(FrameSocket(client))
+                    continue
+
+                public_key, private_key = keys.current()
+                chat = Chat(QueuedSocket(client, API.create_outbox()), private_key, public_key)
 
                 multi_conn = Thread(target=chat.run)
                 multi_conn.daemon = True
@@ -450,13 +1816,46 @@ class Main:
                 print(f"[[red]![/red]] Error accepting connection: {e}")
                 time.sleep(1)  # Avoid CPU spinning on repeated errors
 
+    async def run_async():
+        print("[[magenta]*[/magenta]] Server mode: asyncio")
+
+        if bus is not None:
+            # The bus reader is a thread, hand its messages to the event loop
+            loop = asyncio.get_running_loop()
+            bus.connect(lambda message: loop.call_soon_threadsafe(Main.on_bus_message, message))
+
+        async def on_connect(reader, writer):
+            if bans.is_banned(writer.get_extra_info("peername")[0]):
+                Main.reject(StreamClient(writer))
+                return
+
+            try:
+                public_key, private_key = keys.current()
+                chat = AsyncChat(reader, writer, private_key, public_key)
+            except Exception as e:
+                print(f"[[red]![/red]] Error accepting connection: {e}")
+                writer.close()
+                return
+            await chat.run()
+
+        # Reuse the already bound and listening socket
+        async_server = await asyncio.start_server(on_connect, sock=server)
+        async with async_server:
+            await async_server.serve_forever()
+
 if __name__ == "__main__":
+    # Treat SIGTERM like Ctrl+C so queued messages are flushed on shutdown
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     try:
-        Main.run()
+        Main.prepare()
+        if worker_count > 1:
+            Main.supervise()
+        else:
+            Main.run()
     except KeyboardInterrupt:
         print("\n[[yellow]*[/yellow]] Server shutting down...")
     except Exception as e:
         print(f"[[red]![/red]] Fatal error: {e}")
     finally:
-        db.close()
-        server.close()
\ No newline at end of file
+        Main.shutdown()
\ No newline at end of file
@@ -0,0 +1,226 @@
+import socket
+import tempfile
+import threading
+from collections import deque
+
+from framing import FrameSocket, encode_frame, CHAT
+
+# What happens when a client's queue is full
+DROP_OLDEST = "drop_oldest"  # Evict the oldest queued frame
+DISCONNECT = "disconnect"    # Drop the slow client
+SPILL = "spill"              # Keep queuing in a temporary file on disk
+
+POLICIES = (DROP_OLDEST, DISCONNECT, SPILL)
+
+
+class Outbox:
+    """
+    Bounded queue of encoded frames waiting to be written to one client
+
+    Senders only append to the queue, a writer owned by the connection
+    drains it, so a client with a full TCP window never stalls anyone else.
+    The class holds no lock, QueuedSocket guards it with its condition and
+    the asyncio server only touches it from the event loop.
+
+    def put (frame: bytes):
+        Queue a frame, returns False when the client must be disconnected
+
+    def take (max_bytes: int):
+        Bytes to write next, oldest first
+
+    def stats:
+        Queue depth and counters for /admin queues
+    """
+
+    # Clients dropped because their queue overflowed, over all outboxes
+    disconnects = 0
+
+    def __init__(self, max_frames=1024, policy=DROP_OLDEST, spill_dir=None,
+                 spill_limit=64 * 1024 * 1024) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbox policy: {policy}")
+
+        self.max_frames = max_frames
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.spill_limit = spill_limit
+
+        self.frames = deque()
+        self.queued_bytes = 0
+
+        # Once spilling starts every new frame goes to disk until the file
+        # is fully written out, which keeps the frames in order
+        self.spill = None
+        self.spill_read = 0
+        self.spill_write = 0
+
+        self.evicted = 0
+        self.spilled = 0
+        self.sent = 0
+
+    def put(self, frame: bytes) -> bool:
+        if self.spill is not None:
+            return self._spill(frame)
+
+        if len(self.frames) >= self.max_frames:
+            if self.policy == DROP_OLDEST:
+                self.queued_bytes -= len(self.frames.popleft())
+                self.evicted += 1
+            elif self.policy == SPILL:
+                return self._spill(frame)
+            else:
+                Outbox.disconnects += 1
+                return False
+
+        self.frames.append(frame)
+        self.queued_bytes += len(frame)
+        return True
+
+    def take(self, max_bytes=256 * 1024) -> bytes:
+        # Frames in memory were queued before anything in the spill file
+        if self.frames:
+            batch = []
+            size = 0
+            while self.frames and (not batch or size + len(self.frames[0]) <= max_bytes):
+                frame = self.frames.popleft()
+                batch.append(frame)
+                size += len(frame)
+            self.queued_bytes -= size
+            self.sent += size
+            # One write for many small frames
+            return b"".join(batch)
+
+        if self.spill is not None:
+            # The file is a plain byte stream of frames, no need to split it
+            self.spill.seek(self.spill_read)
+            data = self.spill.read(max_bytes)
+            self.spill_read += len(data)
+            self.sent += len(data)
+            if self.spill_read >= self.spill_write:
+                self.spill.close()
+                self.spill = None
+                self.spill_read = self.spill_write = 0
+            return data
+
+        return b""
+
+    def has_data(self) -> bool:
+        return bool(self.frames) or self.spill is not None
+
+    def depth(self) -> int:
+        return len(self.frames)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.frames),
+            "queued_bytes": self.queued_bytes,
+            "spilled_bytes": self.spill_write - self.spill_read,
+            "evicted": self.evicted,
+            "spilled": self.spilled,
+            "sent_bytes": self.sent,
+        }
+
+    def discard(self):
+        """Drop everything still queued, the connection is gone"""
+        self.frames.clear()
+        self.queued_bytes = 0
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            self.spill_read = self.spill_write = 0
+
+    def _spill(self, frame: bytes) -> bool:
+        if self.spill_write - self.spill_read + len(frame) > self.spill_limit:
+            # Even the disk queue is full, give up on this client
+            Outbox.disconnects += 1
+            return False
+
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(dir=self.spill_dir)
+        self.spill.seek(self.spill_write)
+        self.spill.write(frame)
+        self.spill_write += len(frame)
+        self.spilled += 1
+        return True
+
+
+class QueuedSocket(FrameSocket):
+    """
+    FrameSocket whose sends go through an Outbox drained by a writer thread
+
+    send_frame only queues the frame, so broadcasting to many clients is a
+    loop of cheap appends instead of blocking sendall calls.
+
+    def close:
+        Close once the queued frames were written
+
+    def abort:
+        Close right away and drop the queue
+    """
+
+    def __init__(self, sock, outbox: Outbox, bufsize: int = 65536) -> None:
+        super().__init__(sock, bufsize)
+        self.outbox = outbox
+        self.condition = threading.Condition()
+        self.closing = False
+        self.closed = False
+        self.writer = threading.Thread(target=self._writer, name="outbox-writer", daemon=True)
+        self.writer.start()
+
+    def send_frame(self, payload: bytes, frame_type: int = CHAT):
+        frame = encode_frame(payload, frame_type)
+        with self.condition:
+            if self.closing or self.closed:
+                raise ConnectionResetError("Connection closed")
+            accepted = self.outbox.put(frame)
+            if accepted:
+                self.condition.notify()
+
+        if not accepted:
+            self.abort()
+            raise ConnectionResetError("Outbound queue overflow")
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+            # The writer is gone, nobody else will release the socket
+            release = self.closed
+        if release:
+            self.sock.close()
+
+    def abort(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.outbox.discard()
+            self.condition.notify()
+            release = self.closing
+        # Wakes the reader thread and a sendall blocked on a full TCP window,
+        # the socket itself is released by whichever of close and abort runs last
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if release:
+            self.sock.close()
+
+    def _writer(self):
+        while True:
+            with self.condition:
+                while not self.outbox.has_data() and not self.closing and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                data = self.outbox.take()
+            if not data:
+                # Closing and everything was written
+                break
+
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                break
+
+        self.abort()
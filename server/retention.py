@@ -0,0 +1,194 @@
+import gzip
+import json
+import os
+import threading
+import time
+
+
+class Retention:
+    """
+    History retention, archival and compaction
+
+    Messages past the horizon of their room, older than max_age_days or
+    beyond the newest max_messages, are moved out of the live database
+    into gzip compressed JSON lines segments in archive_dir. rooms holds
+    per-room {"days": ..., "messages": ...} policies, null keeps forever.
+
+    Segments are written once and made read-only, index.json lists them
+    with their room and time range so a search only opens the segments
+    that can match. After archiving the database frees its pages with an
+    incremental vacuum and refreshes the planner statistics. Without any
+    policy there is nothing to do, neither the thread nor a pass runs.
+
+    def start (interval_hours: float):
+        Run a pass now and then every interval_hours in a background thread
+
+    def close:
+        Stop the background thread
+
+    def run:
+        One retention and compaction pass, returns the number of archived messages
+
+    def search (words: list, room, username, since, until, limit: int, offset: int):
+        Archived messages containing every word, newest first
+
+    def stats:
+        Number of segments and archived messages
+    """
+
+    INDEX = "index.json"
+
+    def __init__(self, db, archive_dir: str = "archive", max_age_days: float = None,
+                 max_messages: int = None, rooms: dict = None, batch_size: int = 10000) -> None:
+        self.db = db
+        self.archive_dir = archive_dir
+        self.max_age_days = max_age_days
+        self.max_messages = max_messages
+        self.rooms = rooms or {}
+        self.batch_size = batch_size
+        # Serializes passes, a manual run must not race the scheduled one
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enabled(self) -> bool:
+        policies = [(self.max_age_days, self.max_messages)]
+        policies += [(policy.get("days"), policy.get("messages")) for policy in self.rooms.values()]
+        return any(days is not None or messages is not None for days, messages in policies)
+
+    def policy(self, room: str):
+        """(max_age_days, max_messages) of a room"""
+        policy = self.rooms.get(room, {})
+        return policy.get("days", self.max_age_days), policy.get("messages", self.max_messages)
+
+    def start(self, interval_hours: float = 24):
+        if self.thread is not None or not self.enabled():
+            return
+        self.thread = threading.Thread(target=self._schedule, args=(interval_hours * 3600,), name="retention", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self) -> int:
+        if not self.enabled():
+            return 0
+        archived = 0
+        with self.lock:
+            for room in self.db.get_rooms():
+                max_age_days, max_messages = self.policy(room)
+                bound = self.db.retention_bound(room, max_age_days, max_messages)
+                if bound is None:
+                    continue
+
+                # In batches, the writer thread gets the connection in between
+                while not self.stopped.is_set():
+                    rows = self.db.get_expired_messages(room, bound, self.batch_size)
+                    if not rows:
+                        break
+                    # On disk before the rows are deleted, a crash can only duplicate them
+                    self._write_segment(room, rows)
+                    self.db.delete_messages([row[0] for row in rows])
+                    archived += len(rows)
+
+            if not self.stopped.is_set():
+                self.db.compact()
+        return archived
+
+    def search(self, words: list, room=None, username=None, since=None, until=None,
+               limit: int = 10, offset: int = 0) -> list:
+        """Rows like Database.search, a full scan of every segment in range"""
+        words = [word.rstrip("*").lower() for word in words if word.rstrip("*")]
+        found = []
+        seen = set()
+
+        # Newest segments first, they are only ever appended
+        for segment in sorted(self._load_index(), key=lambda segment: segment["last"], reverse=True):
+            if room is not None and segment["room"] != room:
+                continue
+            if since is not None and segment["last"] < since:
+                continue
+            if until is not None and segment["first"] >= until:
+                continue
+
+            with gzip.open(os.path.join(self.archive_dir, segment["file"]), "rt", encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f]
+
+            for message_id, user, content, timestamp, message_room in reversed(rows):
+                if message_id in seen:
+                    continue
+                if username is not None and user != username:
+                    continue
+                if since is not None and timestamp < since:
+                    continue
+                if until is not None and timestamp >= until:
+                    continue
+                text = content.lower()
+                if not all(word in text for word in words):
+                    continue
+
+                seen.add(message_id)
+                found.append((message_id, user, content, timestamp, message_room, content))
+                if len(found) >= offset + limit:
+                    return found[offset:]
+        return found[offset:]
+
+    def stats(self) -> dict:
+        index = self._load_index()
+        return {"segments": len(index), "messages": sum(segment["count"] for segment in index)}
+
+    def _schedule(self, interval: float):
+        while not self.stopped.is_set():
+            try:
+                started = time.monotonic()
+                archived = self.run()
+                if archived:
+                    print(f"Archived {archived} messages in {time.monotonic() - started:.1f}s")
+            except Exception as e:
+                print(f"Retention pass failed: {e}")
+            self.stopped.wait(interval)
+
+    def _write_segment(self, room: str, rows: list):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = f"{room}.{rows[0][0]}-{rows[-1][0]}.jsonl.gz"
+        path = os.path.join(self.archive_dir, name)
+
+        tmp = f"{path}.tmp"
+        lines = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+        with open(tmp, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(lines.encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+
+        index = [segment for segment in self._load_index() if segment["file"] != name]
+        index.append({
+            "file": name,
+            "room": room,
+            "first": rows[0][3],
+            "last": rows[-1][3],
+            "count": len(rows),
+        })
+        self._save_index(index)
+
+    def _load_index(self) -> list:
+        try:
+            with open(os.path.join(self.archive_dir, Retention.INDEX), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _save_index(self, index: list):
+        path = os.path.join(self.archive_dir, Retention.INDEX)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers see the old or the new list, never half of one
+        os.replace(tmp, path)
@@ -0,0 +1,131 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+
+class SearchError(ValueError):
+    """Raised for a malformed search"""
+
+
+class Search:
+    """
+    Full-text search over the chat history
+
+    A search is words plus optional filters, all words must match and a
+    trailing * matches a prefix:
+
+        from:<user>             Only messages of a user
+        in:<room>, in:all       Another room than the own one, or every room
+        after:<date>            Sent on or after a date (YYYY-MM-DD[THH:MM], UTC)
+        before:<date>           Sent before a date, a plain date includes that day
+        page:<n>                Page of the results, best matches come first
+                                (of the newest max_candidates matches)
+        archive:yes             Search the archived history instead, newest first
+
+    def parse (args: list, room: str):
+        Words and filters of a /search command, returns a query dict
+
+    def run (query: dict):
+        Results of a query, returns (rows, more)
+    """
+
+    FILTERS = ("from", "in", "after", "before", "page", "archive")
+
+    def __init__(self, db, page_size: int = 10, max_pages: int = 50, archive=None,
+                 max_candidates: int = 1000) -> None:
+        self.db = db
+        # Retention that holds the archive segments
+        self.archive = archive
+        self.page_size = page_size
+        self.max_pages = max_pages
+        # Matches ranked per search, a common word does not rank the whole history
+        self.max_candidates = max_candidates
+
+    def parse(self, args: list, room: str) -> dict:
+        query = {"words": [], "room": room, "username": None, "since": None, "until": None, "page": 1, "archive": False}
+
+        for arg in args:
+            name, sep, value = arg.partition(":")
+            if not sep or name.lower() not in Search.FILTERS or not value:
+                query["words"].append(arg)
+                continue
+
+            name = name.lower()
+            if name == "from":
+                query["username"] = value
+            elif name == "in":
+                query["room"] = None if value.lower() == "all" else value.lstrip("#").lower()
+            elif name == "after":
+                query["since"] = Search.timestamp(value)
+            elif name == "before":
+                until = Search.timestamp(value)
+                if len(value) == 10:
+                    # A plain date means up to the end of that day
+                    until = Search.timestamp(value, timedelta(days=1))
+                query["until"] = until
+            elif name == "archive":
+                query["archive"] = value.lower() in ("yes", "on", "true", "1")
+            elif name == "page":
+                try:
+                    query["page"] = int(value)
+                except ValueError:
+                    raise SearchError(f"Invalid page: {value}")
+                if not 1 <= query["page"] <= self.max_pages:
+                    raise SearchError(f"Pages go from 1 to {self.max_pages}")
+
+        if not query["words"]:
+            raise SearchError("Nothing to search for")
+        return query
+
+    def run(self, query: dict):
+        offset = (query["page"] - 1) * self.page_size
+        if query["archive"]:
+            if self.archive is None:
+                raise SearchError("There is no archive")
+            rows = self.archive.search(
+                query["words"],
+                room=query["room"],
+                username=query["username"],
+                since=query["since"],
+                until=query["until"],
+                limit=self.page_size + 1,
+                offset=offset,
+            )
+            return rows[:self.page_size], len(rows) > self.page_size
+
+        try:
+            # One row more than a page tells whether there is another page
+            rows = self.db.search(
+                Search.expression(query["words"]),
+                room=query["room"],
+                username=query["username"],
+                since=query["since"],
+                until=query["until"],
+                limit=self.page_size + 1,
+                offset=offset,
+                candidates=self.max_candidates,
+            )
+        except sqlite3.OperationalError as e:
+            raise SearchError(f"Search failed: {e}")
+        return rows[:self.page_size], len(rows) > self.page_size
+
+    def expression(words: list) -> str:
+        """FTS5 query of plain words, quoted so no word is read as an operator"""
+        terms = []
+        for word in words:
+            prefix = word.endswith("*")
+            word = word.rstrip("*")
+            if not word:
+                continue
+            term = '"' + word.replace('"', '""') + '"'
+            terms.append(term + "*" if prefix else term)
+        if not terms:
+            raise SearchError("Nothing to search for")
+        return " ".join(terms)
+
+    def timestamp(value: str, shift: timedelta = timedelta()) -> str:
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            raise SearchError(f"Invalid date: {value}")
+        # Same format as CURRENT_TIMESTAMP, so it compares as a string
+        return (moment + shift).strftime("%Y-%m-%d %H:%M:%S")
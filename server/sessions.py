@@ -0,0 +1,140 @@
+import threading
+
+
+class Session:
+    """One logged in client, kept in the SessionRegistry"""
+
+    __slots__ = ("connection", "nickname", "ip", "chat", "room")
+
+    def __init__(self, connection, nickname: str, ip: str, chat, room: str) -> None:
+        self.connection = connection
+        self.nickname = nickname
+        self.ip = ip
+        self.chat = chat
+        self.room = room
+
+
+class SessionRegistry:
+    """
+    Connected clients, indexed by connection, nickname and room
+
+    Every method holds the lock only for a few dict operations, so it is
+    safe from the connection threads and never stalls the event loop.
+
+    def add (connection, nickname: str, ip: str, chat, room: str):
+        Register a client in a room, returns None when the nickname is taken
+
+    def remove (connection):
+        Unregister a client, returns its Session only to the first caller
+
+    def move (connection, room: str):
+        Put a client in another room, returns the room it left
+
+    def members (room: str):
+        Tuple of the sessions in a room, the fan-out list of a message
+
+    def rooms:
+        {room: number of members} of the non-empty rooms
+
+    def find (nickname: str):
+        Session of a nickname, or None
+
+    def snapshot:
+        Tuple of all sessions to iterate over without the lock
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.by_connection = {}
+        self.by_nickname = {}
+        # room -> {connection: Session}
+        self.by_room = {}
+        # Rebuilt on the first snapshot after a join or leave
+        self._snapshot = ()
+        self._stale = False
+        # room -> tuple of members, dropped when the room changes
+        self._members = {}
+
+    def add(self, connection, nickname: str, ip: str, chat, room: str):
+        with self.lock:
+            # Checking and taking the nickname is one step, two clients
+            # racing for the same name cannot both get it
+            if nickname in self.by_nickname or connection in self.by_connection:
+                return None
+
+            session = Session(connection, nickname, ip, chat, room)
+            self.by_connection[connection] = session
+            self.by_nickname[nickname] = session
+            self._enter(session, room)
+            self._stale = True
+            return session
+
+    def remove(self, connection):
+        with self.lock:
+            session = self.by_connection.pop(connection, None)
+            if session is None:
+                return None
+
+            if self.by_nickname.get(session.nickname) is session:
+                del self.by_nickname[session.nickname]
+            self._leave(session)
+            self._stale = True
+            return session
+
+    def move(self, connection, room: str):
+        with self.lock:
+            session = self.by_connection.get(connection)
+            if session is None:
+                return None
+
+            previous = session.room
+            if previous != room:
+                self._leave(session)
+                self._enter(session, room)
+            return previous
+
+    def members(self, room: str):
+        members = self._members.get(room)
+        if members is None:
+            # Built under the lock, a join or leave meanwhile cannot leave a stale tuple behind
+            with self.lock:
+                members = tuple(self.by_room.get(room, {}).values())
+                if members:
+                    self._members[room] = members
+        return members
+
+    def rooms(self) -> dict:
+        with self.lock:
+            return {room: len(members) for room, members in self.by_room.items()}
+
+    def _enter(self, session, room: str):
+        """Caller holds the lock"""
+        session.room = room
+        self.by_room.setdefault(room, {})[session.connection] = session
+        self._members.pop(room, None)
+
+    def _leave(self, session):
+        """Caller holds the lock"""
+        members = self.by_room.get(session.room)
+        if members is not None:
+            members.pop(session.connection, None)
+            if not members:
+                del self.by_room[session.room]
+        self._members.pop(session.room, None)
+
+    def find(self, nickname: str):
+        return self.by_nickname.get(nickname)
+
+    def snapshot(self):
+        if self._stale:
+            with self.lock:
+                if self._stale:
+                    self._snapshot = tuple(self.by_connection.values())
+                    self._stale = False
+        return self._snapshot
+
+    def __len__(self) -> int:
+        return len(self.by_connection)
+
+    def __contains__(self, nickname: str) -> bool:
+        return nickname in self.by_nickname
@@ -0,0 +1,91 @@
+"""
+Query plans of the database on a filled history.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from database import Database  # noqa: E402
+
+USERS = 2000
+MESSAGES = 50000
+
+
+def fill(db):
+    """USERS users and MESSAGES messages spread over them, straight into the tables"""
+    random.seed(1)
+    db.cursor.executemany(
+        "INSERT INTO users (username, password) VALUES (?, ?)",
+        [(f"user{i}", "x") for i in range(USERS)]
+    )
+    db.cursor.executemany(
+        "INSERT INTO messages (user_id, content, timestamp, room) VALUES (?, ?, ?, ?)",
+        [
+            (random.randint(2, USERS + 1), f"message {i}",
+             f"2024-01-{i // 86400 + 1:02d} {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}",
+             random.choice(("lobby", "dev")))
+            for i in range(MESSAGES)
+        ]
+    )
+    db.conn.commit()
+
+
+def recent_messages_plan(db):
+    # Same statement as get_recent_messages without a room
+    rows = db.cursor.execute('''
+    EXPLAIN QUERY PLAN
+    SELECT users.username, messages.content, messages.timestamp
+    FROM messages
+    JOIN users ON messages.user_id = users.id
+    ORDER BY messages.timestamp DESC, messages.id DESC
+    LIMIT 50
+    ''').fetchall()
+    return [row[3] for row in rows]
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / "chat.db"))
+    yield database
+    database.close()
+
+
+def test_recent_messages_walk_the_timestamp_index(db):
+    # Started on an empty database, the history grows afterwards
+    db.optimize(startup=True)
+    fill(db)
+    assert len(db.get_recent_messages()) == 50
+    db.optimize()
+
+    plan = recent_messages_plan(db)
+    assert plan[0].startswith("SCAN messages USING INDEX idx_messages_timestamp")
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_statistics_of_the_empty_tables_are_refreshed(tmp_path):
+    path = str(tmp_path / "chat.db")
+    db = Database(path)
+    fill(db)
+    # What migration 1 used to leave behind: users analyzed with a single row
+    db.cursor.execute("ANALYZE users")
+    db.cursor.execute("UPDATE sqlite_stat1 SET stat = '1 1' WHERE tbl = 'users'")
+    db.cursor.execute("PRAGMA user_version = 5")
+    db.conn.commit()
+    db.close()
+
+    db = Database(path)
+    try:
+        db.optimize(startup=True)
+        plan = recent_messages_plan(db)
+        assert plan[0].startswith("SCAN messages USING INDEX idx_messages_timestamp")
+        assert not any("TEMP B-TREE" in step for step in plan)
+    finally:
+        db.close()
@@ -0,0 +1,211 @@
+"""
+File store and file requests, against a server running in a subprocess.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import hashlib
+import json
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "client"))
+
+from framing import FrameSocket, FILE, COMMAND, DATA  # noqa: E402
+from handshake import login  # noqa: E402
+
+PASSWORD = "test"
+CHUNK_HEADER = struct.Struct("!8sI8s")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server(tmp_path):
+    with open(os.path.join(ROOT, "server", "config.json")) as f:
+        config = json.load(f)
+    port = free_port()
+    config.update({
+        "ip": "127.0.0.1",
+        "port": port,
+        "password": PASSWORD,
+        "file_store_dir": "files",
+        "maintenance_interval_hours": None,
+        "key_pool_low_water": 1,
+        "key_pool_high_water": 2,
+        "workers": 1,
+    })
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump(config, f)
+
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server", "main.py")], cwd=tmp_path,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail("Server did not start")
+            time.sleep(0.1)
+
+    yield port
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+class Client:
+    """A logged in user, every frame it receives lands in a queue"""
+
+    def __init__(self, port, nickname):
+        self.nickname = nickname
+        self.conn = FrameSocket(socket.create_connection(("127.0.0.1", port)))
+        self.api = login(self.conn, nickname, hashlib.md5(PASSWORD.encode()).hexdigest())
+        self.frames = queue.Queue()
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        while True:
+            try:
+                self.frames.put(self.api.recv_frame())
+            except Exception:
+                break
+
+    def send(self, msg, frame_type=FILE):
+        self.api.send(msg, frame_type)
+
+    def expect(self, text, timeout=10):
+        """Next message containing text, the frames before it are skipped"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                frame_type, msg = self.frames.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                pytest.fail(f"{self.nickname} did not get {text!r}")
+            if frame_type != DATA and text in msg:
+                return msg
+
+    def chunks(self, count, timeout=10):
+        found = {}
+        deadline = time.monotonic() + timeout
+        while len(found) < count:
+            try:
+                frame_type, msg = self.frames.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                pytest.fail(f"{self.nickname} got {len(found)} of {count} chunks")
+            if frame_type == DATA:
+                _, index, _ = CHUNK_HEADER.unpack_from(msg)
+                found[index] = msg[CHUNK_HEADER.size:]
+        return b"".join(found[index] for index in range(count))
+
+    def transfer(self, text, timeout=10):
+        """Payloads of the DATA frames received before a message containing text"""
+        payloads = []
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                frame_type, msg = self.frames.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                pytest.fail(f"{self.nickname} did not get {text!r}")
+            if frame_type == DATA:
+                payloads.append(msg)
+            elif text in msg:
+                return payloads
+
+    def seen(self, text):
+        """Whether a message received so far contains text, the frames are used up"""
+        found = False
+        while not self.frames.empty():
+            frame_type, msg = self.frames.get()
+            found = found or (frame_type != DATA and text in msg)
+        return found
+
+
+def test_request_during_upload_is_answered_from_the_store(server):
+    data = os.urandom(200 * 1024)
+    content_hash = hashlib.sha256(data).hexdigest()[:32]
+    code = "abcd1234"
+
+    alice = Client(server, "alice")
+    bob = Client(server, "bob")
+    time.sleep(0.5)
+
+    alice.send(f"alice [b]Shared file:[/b] data.bin (200 KB) | Code: #{code}")
+    alice.send(f"/store #{code} {len(data)} {content_hash}", COMMAND)
+    alice.expect(f"[b]Requesting file:[/b] #{code}")
+
+    # The upload is in flight, the request must not reach alice
+    bob.send(f"bob [b]Requesting file:[/b] #{code}")
+    time.sleep(1)
+    assert not alice.seen("@bob")
+
+    chunk_size = 64 * 1024
+    chunk_count = (len(data) + chunk_size - 1) // chunk_size
+    alice.send(f"alice [b]File start:[/b] #{code}:data.bin:{len(data)}:{chunk_count}:{chunk_size}")
+    alice.expect(f"[b]File ack:[/b] #{code}:0")
+    for index in range(chunk_count):
+        chunk = data[index * chunk_size:(index + 1) * chunk_size]
+        digest = hashlib.blake2b(chunk, digest_size=8).digest()
+        alice.send(CHUNK_HEADER.pack(code.encode(), index, digest) + chunk, DATA)
+    alice.send(f"alice [b]File end:[/b] #{code}:{content_hash}")
+    alice.expect("kept on the server")
+
+    # Answered by the server once the upload is stored
+    start = bob.expect(f"[b]File start:[/b] #{code}")
+    assert start.startswith("[yellow]Server[/yellow]")
+    assert bob.chunks(chunk_count) == data
+    assert bob.expect(f"[b]File end:[/b] #{code}").endswith(content_hash)
+    assert not alice.seen("@bob")
+
+
+def test_concurrent_downloads_of_a_code_reach_their_own_requester(server):
+    code = "feed5678"
+    chunk_size = 1024
+    chunk_count = 16
+
+    alice = Client(server, "alice")
+    bob = Client(server, "bob")
+    carol = Client(server, "carol")
+    time.sleep(0.5)
+
+    alice.send(f"alice [b]Shared file:[/b] data.bin (16 KB) | Code: #{code}")
+    for client in (bob, carol):
+        client.send(f"{client.nickname} [b]Requesting file:[/b] #{code}")
+        alice.expect(f"@{client.nickname} {client.nickname} [b]Requesting file:[/b] #{code}")
+
+    # Both transfers run at once, each requester gets content of its own
+    data = {"bob": os.urandom(chunk_size * chunk_count), "carol": os.urandom(chunk_size * chunk_count)}
+    for nick in data:
+        alice.send(f"@{nick} alice [b]File start:[/b] #{code}:data.bin:{len(data[nick])}:{chunk_count}:{chunk_size}")
+    for index in range(chunk_count):
+        for nick in data:
+            chunk = data[nick][index * chunk_size:(index + 1) * chunk_size]
+            digest = hashlib.blake2b(chunk, digest_size=8).digest()
+            alice.send(f"@{nick} ".encode() + CHUNK_HEADER.pack(code.encode(), index, digest) + chunk, DATA)
+    for nick in data:
+        alice.send(f"@{nick} alice [b]File end:[/b] #{code}:{hashlib.sha256(data[nick]).hexdigest()[:32]}")
+
+    for client in (bob, carol):
+        client.expect(f"[b]File start:[/b] #{code}")
+        payloads = client.transfer(f"[b]File end:[/b] #{code}")
+        # Every chunk once, none of the other transfer
+        assert len(payloads) == chunk_count
+        assert b"".join(payload[CHUNK_HEADER.size:] for payload in payloads) == data[client.nickname]